@@ -0,0 +1,523 @@
+# ksp-compiler - a compiler for the Kontakt script language
+# Copyright (C) 2011  Nils Liberg
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Performance benchmarks for the compiler.
+
+Usage: python benchmarks.py [--repeat N] [benchmark name ...]
+
+Without any names all benchmarks are run. Each benchmark reports the best and the median time of N runs.'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+from collections import OrderedDict
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.dirname(here))
+
+benchmarks = OrderedDict()
+
+def benchmark(func):
+    benchmarks[func.__name__.replace('bench_', '', 1)] = func
+    return func
+
+def measure(func, repeat, setup=None):
+    '''Calls func repeat times (calling setup before each run if given) and returns a list of the elapsed times'''
+    timings = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+    return timings
+
+def report(label, timings):
+    timings = sorted(timings)
+    median = timings[len(timings) // 2]
+    print('  %-40s best %9.2f ms   median %9.2f ms' % (label, timings[0] * 1000, median * 1000))
+
+def generate_script(num_blocks):
+    '''Returns a synthetic script with num_blocks repetitions of typical code: UI controls created by macros,
+    defines, families, arrays and functions with loops and conditions that are inlined into the callbacks.'''
+    header = [
+        'define NUM_BLOCKS := %d' % num_blocks,
+        'macro make_knob(#name#, default)',
+        '    declare ui_knob #name#(0, 100, 1)',
+        '    set_text(#name#, "#name#")',
+        '    #name# := default',
+        '    make_persistent(#name#)',
+        'end macro',
+        'macro knob_callback(#name#, #idx#)',
+        '    on ui_control(#name#)',
+        '        settings.values[#idx#] := #name#',
+        '        update_block#idx#(#name#)',
+        '    end on',
+        'end macro',
+        'on init',
+        '    family settings',
+        '        declare values[NUM_BLOCKS]',
+        '        declare pers mode',
+        '    end family',
+        '    declare counter',
+        '    declare !names[NUM_BLOCKS]',
+    ]
+    init, functions, callbacks, note = [], [], [], []
+    for i in range(num_blocks):
+        init += [
+            '    make_knob(knob%d, %d)' % (i, i % 100),
+            '    declare table%d[8] := (0, 1, 2, 3, 4, 5, 6, 7)' % i,
+            '    declare const OFFSET%d := %d' % (i, i * 3),
+            '    names[%d] := "block%d"' % (i, i),
+            '    update_block%d(knob%d)' % (i, i),
+        ]
+        functions += [
+            'function update_block%d(value)' % i,
+            '    declare local j',
+            '    for j := 0 to 7',
+            '        if value > table%d[j] and j # 3' % i,
+            '            table%d[j] := (value + OFFSET%d) mod 128' % (i, i),
+            '        else',
+            '            inc(counter)',
+            '        end if',
+            '    end for',
+            '    select settings.mode',
+            '        case 0',
+            '            message(names[%d] & ": " & value)' % i,
+            '        case 1 to 3',
+            '            settings.values[%d] := value * 2' % i,
+            '    end select',
+            'end function',
+        ]
+        callbacks.append('knob_callback(knob%d, %d)' % (i, i))
+        note.append('    update_block%d(EVENT_VELOCITY)' % i)
+    lines = header + init + ['end on'] + functions + callbacks + ['on note'] + note + ['end on']
+    return '\n'.join(lines) + '\n'
+
+def generate_preprocessor_script(num_blocks):
+    '''Returns a synthetic script of about 40 * num_blocks lines which uses the syntax handled by the post macro preprocessor
+    functions: persistence keywords, UI arrays, multidimensional arrays, string arrays, const and list blocks, lists, UI property
+    functions and same line declarations, followed by callbacks with ordinary code.'''
+    init, callbacks = [], []
+    for i in range(num_blocks):
+        init += [
+            '    declare pers gain%d := %d' % (i, i),
+            '    declare read mode%d' % i,
+            '    declare ui_knob knobs%dx[4](0, 100, 1)' % i,
+            '    declare grid%d[3, 4]' % i,
+            '    declare !names%d[3] := ("a", "b", "c")' % i,
+            '    declare values%d[] := (1, 2, 3, 4)' % i,
+            '    declare sum%d := gain%d + 1' % (i, i),
+            '    const steps%d' % i,
+            '        LOW',
+            '        HIGH := 10',
+            '    end const',
+            '    list items%d[]' % i,
+            '        1',
+            '        values%d[0]' % i,
+            '    end list',
+            '    declare ui_label label%d(1, 1)' % i,
+            '    set_bounds(label%d, 10, 20, 30, 40)' % i,
+            '    set_label_properties(label%d, "text", "", 1, 0, 1)' % i,
+            '    message(names%d[0] & grid%d[1, 2])' % (i, i),
+        ]
+        callbacks += [
+            'on ui_control(knobs%dx0)' % i,
+            '    declare local j',
+            '    for j := 0 to 3',
+            '        if knobs%dx[j] > gain%d' % (i, i),
+            '            gain%d := knobs%dx[j]' % (i, i),
+            '        else',
+            '            mode%d := steps%d.HIGH' % (i, i),
+            '        end if',
+            '    end for',
+            '    while mode%d > 0' % i,
+            '        dec(mode%d)' % i,
+            '    end while',
+            '    select mode%d' % i,
+            '        case 0',
+            '            message(names%d[1])' % i,
+            '        case 1 to 3',
+            '            grid%d[1, 2] := sum%d' % (i, i),
+            '    end select',
+            '    message(items%d[0] & items%d[1])' % (i, i),
+            '    message(values%d[0] + values%d[1])' % (i, i),
+            'end on',
+        ]
+    lines = ['on init', '    declare x'] + init + ['end on'] + callbacks
+    return '\n'.join(lines) + '\n'
+
+@benchmark
+def bench_startup(repeat):
+    '''Time needed to build the lexer and parser, with and without the cached tables.'''
+    import ksp_parser
+    tmpdir = tempfile.mkdtemp()
+    try:
+        def clear_tables():
+            for filename in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, filename))
+        report('init (no table cache)', measure(lambda: ksp_parser.init(tmpdir, cache_tables=False), repeat))
+        report('init (generate and write tables)', measure(lambda: ksp_parser.init(tmpdir), repeat, setup=clear_tables))
+        report('init (load cached tables)', measure(lambda: ksp_parser.init(tmpdir), repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # import the compiler in a fresh interpreter, this is what each invocation of the command line compiler pays
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([here, os.path.dirname(here)] + [p for p in [env.get('PYTHONPATH')] if p])
+    cmd = [sys.executable, '-W', 'ignore', '-c', 'import ksp_compiler']
+    report('fresh interpreter: import ksp_compiler', measure(lambda: subprocess.check_call(cmd, cwd=here, env=env), repeat))
+
+@benchmark
+def bench_parse_long_callback(repeat):
+    '''Parsing a single init callback of 100000 statements (declarations and assignments).'''
+    import ksp_parser
+    lines = ['on init']
+    for i in range(50000):
+        lines += ['    declare v%d[2] := (%d, 1)' % (i, i), '    v%d[1] := v%d[0] + 1' % (i, i)]
+    lines.append('end on')
+    code = '\n'.join(lines) + '\n'
+    report('parse', measure(lambda: ksp_parser.parse(code), repeat))
+
+@benchmark
+def bench_parse_cache(repeat):
+    '''Parsing a script of ~60000 lines (300 callbacks and 300 functions) at once and with the parse cache, before and after
+    one of the callbacks has been edited (which moves all of the blocks after it).'''
+    from ksp_compiler import ParseCache
+    import ksp_parser
+    blocks = []
+    for i in range(300):
+        body = ['    if values[%d] > %d' % (j % 10, j) if j % 3 == 0 else '        values[%d] := values[%d] + %d' % (j % 10, (j + 1) % 10, i) if j % 3 == 1 else '    end if'
+                for j in range(96)]
+        blocks.append(['function f%d(a, b) -> result' % i, '    result := a * b + %d' % i] + body + ['end function'])
+        blocks.append(['on ui_control(knob%d)' % i, '    message(f%d(knob%d, %d))' % (i, i, i)] + body + ['end on'])
+    code = '\n\n'.join('\n'.join(block) for block in blocks) + '\n'
+    blocks[301].insert(1, '    message("edited")')
+    edited_code = '\n\n'.join('\n'.join(block) for block in blocks) + '\n'
+    report('parse', measure(lambda: ksp_parser.parse(code), repeat))
+    state = {}
+    def new_cache():
+        state['cache'] = ParseCache()
+    report('parse cache (empty)', measure(lambda: state['cache'].parse(code), repeat, setup=new_cache))
+    def filled_cache():
+        new_cache()
+        state['cache'].parse(code)
+    report('parse cache (one block edited)', measure(lambda: state['cache'].parse(edited_code), repeat, setup=filled_cache))
+
+@benchmark
+def bench_parse_jobs(repeat):
+    '''Parsing the script of the parse cache benchmark with an empty parse cache, in the main process and with the blocks
+    parsed by 2 and 4 worker processes.'''
+    from ksp_compiler import ParseCache
+    blocks = []
+    for i in range(300):
+        body = ['    if values[%d] > %d' % (j % 10, j) if j % 3 == 0 else '        values[%d] := values[%d] + %d' % (j % 10, (j + 1) % 10, i) if j % 3 == 1 else '    end if'
+                for j in range(96)]
+        blocks.append(['function f%d(a, b) -> result' % i, '    result := a * b + %d' % i] + body + ['end function'])
+        blocks.append(['on ui_control(knob%d)' % i, '    message(f%d(knob%d, %d))' % (i, i, i)] + body + ['end on'])
+    code = '\n\n'.join('\n'.join(block) for block in blocks) + '\n'
+    for jobs in (1, 2, 4):
+        cache = ParseCache(jobs=jobs)
+        try:
+            cache.parse('on init\nend on\n\non note\nend on\n')   # start the worker processes
+            report('%d job(s)' % jobs, measure(lambda: cache.parse(code), repeat, setup=cache.entries.clear))
+        finally:
+            cache.close()
+
+@benchmark
+def bench_lexer(repeat):
+    '''Tokenizing the code of the compile benchmark after macro expansion and preprocessing, with the table-driven and the PLY lexer.'''
+    from ksp_compiler import KSPCompiler
+    import ksp_parser
+    compiler = KSPCompiler(generate_script(200), None)
+    def callback(desc, percent):
+        if desc == 'parse code':
+            compiler.abort_compilation()
+    compiler.compile(callback=callback)
+    code = compiler.code.replace('\r', '')
+    for backend in ('table', 'ply'):
+        lexer = ksp_parser.parser_pools[backend].lexer.clone()
+        num_tokens = []
+        def tokenize():
+            lexer.input(code)
+            num_tokens[:] = [sum(1 for t in iter(lexer.token, None))]
+        timings = measure(tokenize, repeat)
+        report('tokenize (%s)' % backend, timings)
+        print('  %-40s best %9.0f tokens/s' % ('throughput (%s, %d tokens)' % (backend, num_tokens[0]), num_tokens[0] / min(timings)))
+
+@benchmark
+def bench_parse_threads(repeat):
+    '''Parsing 8 scripts of ~3000 lines each on a pool of 1, 2 and 4 threads (each thread uses its own lexer and parser).
+    Parsing holds the GIL, so the throughput stays about the same as on one thread, without the parses being serialized by a lock.'''
+    from concurrent.futures import ThreadPoolExecutor
+    import ksp_parser
+    lines = ['on init'] + ['    declare values%d[4] := (1, 2, 3, %d)' % (i, i) for i in range(500)] + ['end on']
+    for i in range(500):
+        lines += ['on ui_control(knob%d)' % i, '    if values%d[0] > %d and EVENT_NOTE # 0' % (i, i),
+                  '        message("value: " & values%d[1] * 2 + (3 mod 2))' % i, '    end if', 'end on']
+    scripts = ['\n'.join(lines) + '\n'] * 8
+    for num_threads in (1, 2, 4):
+        with ThreadPoolExecutor(num_threads) as executor:
+            report('parse (%d threads)' % num_threads, measure(lambda: list(executor.map(ksp_parser.parse, scripts)), repeat))
+
+@benchmark
+def bench_compile(repeat):
+    '''Full compilation of a generated script of ~6000 lines, followed by the per-task profile of the last run.'''
+    from ksp_compiler import KSPCompiler, format_profile
+    code = generate_script(200)
+    compilers = []
+    def compile_script():
+        compiler = KSPCompiler(code, None, compact=True, compactVars=True, extra_syntax_checks=True, optimize=True, profile=True)
+        compiler.compile()
+        compilers.append(compiler)
+    report('compile (optimize, compact variables)', measure(compile_script, repeat))
+    print(format_profile(compilers[-1].profile_results))
+
+@benchmark
+def bench_memory(repeat):
+    '''Peak memory (measured with tracemalloc) while compiling the generated ~6000 line script of the compile benchmark.'''
+    import tracemalloc
+    from ksp_compiler import KSPCompiler, count_ast_nodes
+    code = generate_script(200)
+    peaks = []
+    for i in range(repeat):
+        compiler = KSPCompiler(code, None, compact=True, extra_syntax_checks=True)
+        tracemalloc.start()
+        try:
+            compiler.compile()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    print('  %-40s %9.2f MB   (%d AST nodes after compilation)' % ('peak memory', min(peaks) / 1024.0 / 1024.0, count_ast_nodes(compiler.module)))
+
+@benchmark
+def bench_preprocessor(repeat):
+    '''The post macro preprocessor functions applied to a generated script of ~50000 lines.'''
+    import ksp_compiler
+    from preprocessor_plugins import post_macro_functions
+    code = generate_preprocessor_script(1250)
+    state = {}
+    def setup():
+        state['lines'] = ksp_compiler.parse_lines(code, {})
+    report('post macro functions (%d lines)' % code.count('\n'), measure(lambda: post_macro_functions(state['lines']), repeat, setup=setup))
+
+@benchmark
+def bench_preprocessor_scaling(repeat):
+    '''All of the preprocessor functions and the macro expansion (which unrolls iterate_macro and literate_macro) applied to
+    generated scripts of 25000 to 200000 lines, the time per line should stay the same.'''
+    import ksp_compiler
+    from preprocessor_plugins import pre_macro_functions, macro_iteration_handlers, post_macro_functions
+    header = ['define MAX_GAIN := 100', 'define HALF(x) := x / 2', 'define LABELS := a, b, c',
+              'macro make_knob(#n#)', '    message(#n#)', 'end macro', 'macro make_label(#l#)', '    message("#l#")', 'end macro']
+    def preprocess(lines, placeholders):
+        pre_macro_functions(lines)
+        lines, macros = ksp_compiler.extract_macros(lines)
+        normal_lines, callback_lines = ksp_compiler.expand_macros(lines, macros, placeholders, iteration_handlers=macro_iteration_handlers())
+        post_macro_functions(ksp_compiler.LineBuffer(normal_lines + callback_lines))
+    for num_lines in (25000, 50000, 100000, 200000):
+        code = '\n'.join(header) + '\n' + generate_preprocessor_script(num_lines // 40)
+        code = code.replace('    declare x\n', '    declare x\n    iterate_macro(make_knob) := 0 to 3\n    literate_macro(make_label) on LABELS\n')
+        state = {}
+        def setup():
+            state['placeholders'] = {}
+            state['lines'] = ksp_compiler.parse_lines(code, state['placeholders'])
+        timings = measure(lambda: preprocess(state['lines'], state['placeholders']), repeat, setup=setup)
+        report('%d lines (%.2f ms per 1000 lines)' % (code.count('\n'), min(timings) * 1000000 / code.count('\n')), timings)
+
+@benchmark
+def bench_define_constants(repeat):
+    '''Substitution of 3000 define constants (a tenth of them taking arguments) in a script of 5000 lines.'''
+    import ksp_compiler
+    from preprocessor_plugins import handleDefineConstants
+    lines = []
+    for i in range(3000):
+        if i % 10 == 9:
+            lines.append('define SCALE%d(x, y) := (x * CONST%d + y)' % (i, i - 1))
+        elif i % 2:
+            lines.append('define OFFSET%d := CONST%d + %d' % (i, i - 1, i))
+        else:
+            lines.append('define CONST%d := %d' % (i, i))
+    lines.append('on init')
+    for i in range(5000):
+        j = i % 300 * 10
+        lines.append('    value := CONST%d + OFFSET%d * SCALE%d(value, CONST%d) + other_%d' % (j, j + 1, j + 9, j + 2, i))
+    lines.append('end on')
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        state['lines'] = ksp_compiler.parse_lines(code, {})
+    report('define constants', measure(lambda: handleDefineConstants(state['lines']), repeat, setup=setup))
+
+@benchmark
+def bench_name_patterns(repeat):
+    '''The post macro preprocessor functions applied to 200 structs of 5 members declared 4 times each and 600 incrementers,
+    which use 1600 patterns built from names.'''
+    import ksp_compiler
+    from preprocessor_plugins import post_macro_functions, regexCacheInfo
+    lines = []
+    for i in range(200):
+        lines += ['struct s%d' % i] + ['    declare m%d_%d' % (i, j) for j in range(5)] + ['end struct']
+    lines += ['on init'] + ['    declare &s%d v%d_%d' % (i, i, j) for i in range(200) for j in range(4)]
+    for i in range(600):
+        lines += ['    START_INC(n%d, 0, 1)' % i] + ['    message(n%d)' % i] * 4 + ['    END_INC']
+    lines += ['end on']
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        state['lines'] = ksp_compiler.parse_lines(code, {})
+    report('post macro functions', measure(lambda: post_macro_functions(state['lines']), repeat, setup=setup))
+    print('  pattern cache: %s' % (regexCacheInfo(),))
+
+@benchmark
+def bench_array_concat(repeat):
+    '''The post macro preprocessor functions applied to a script declaring 3000 arrays, with 1000 concat calls and
+    1000 arrays added to multidimensional lists.'''
+    import ksp_compiler
+    from preprocessor_plugins import post_macro_functions
+    lines = ['on init', '    declare first[8]']
+    for i in range(1000):
+        lines += ['    declare a%d[4]' % i, '    declare b%d[N]' % i, '    declare !s%d[2]' % i]
+        lines.append('    declare c%d[] := concat(a%d, b%d, %s)' % (i, i, i, 'a%d' % (i // 2) if i > 1 else 'first'))
+        lines += ['    declare list l%d[2, 2]' % i, '    list_add(l%d, a%d)' % (i, i)]
+    lines.append('end on')
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        state['lines'] = ksp_compiler.parse_lines(code, {})
+    report('post macro functions', measure(lambda: post_macro_functions(state['lines']), repeat, setup=setup))
+
+@benchmark
+def bench_incrementers(repeat):
+    '''Incrementer substitution in a 5000 line START_INC block with 12 nested incrementers, two of them sharing a name.'''
+    import ksp_compiler
+    from preprocessor_plugins import runStages, IncrementerStage
+    lines = ['on init', '    START_INC(i, 0, 1)', '    START_INC(j, 100, -1)', '    START_INC(k, 0, 2)', '    START_INC(i, 10, 10)']
+    lines += ['    START_INC(unused%d, 0, 1)' % n for n in range(8)]
+    for n in range(5000):
+        lines.append('    values[i] := names_%d[j] + k * i + offset' % (n % 10))
+    lines += ['    END_INC'] * 12 + ['end on']
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        state['lines'] = ksp_compiler.parse_lines(code, {})
+    report('incrementers', measure(lambda: runStages(state['lines'], [IncrementerStage()]), repeat, setup=setup))
+
+@benchmark
+def bench_ui_arrays(repeat):
+    '''Full compilation of a script declaring 32 UI arrays of 512 controls each (some persistent, some inside of families).'''
+    from ksp_compiler import KSPCompiler
+    lines = ['on init']
+    for i in range(32):
+        if i % 4 == 0:
+            lines.append('    family group%d' % i)
+        lines.append('    declare %sui_knob bank%d_knobs[512](0, 100, 1)' % ('pers ' if i % 2 else '', i))
+        if i % 4 == 0:
+            lines.append('    end family')
+    lines.append('end on')
+    code = '\n'.join(lines) + '\n'
+    def compile_script():
+        KSPCompiler(code, None, compact=True, extra_syntax_checks=True, optimize=True).compile()
+    report('compile (16384 UI controls)', measure(compile_script, repeat))
+
+@benchmark
+def bench_macro_expansion(repeat):
+    '''Expansion of 10000 macro invocations nested 5 levels deep (2000 top-level invocations), some of which define callbacks.'''
+    from ksp_compiler import KSPCompiler
+    lines = []
+    for level in range(5):
+        lines += ['macro level%d(#name#)' % level, '    message("level %d #name#")' % level]
+        if level < 4:
+            lines.append('    level%d(#name#_%d)' % (level + 1, level + 1))
+        else:
+            lines += ['    declare ui_button #name#', '    on ui_control(#name#)', '        message(#name#)', '    end on']
+        lines.append('end macro')
+    lines += ['on init'] + ['    level0(b%d)' % i for i in range(2000)] + ['end on']
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        compiler = KSPCompiler(code, None)
+        compiler.do_imports_and_convert_to_line_objects()
+        compiler.extract_macros()
+        state['compiler'] = compiler
+    report('expand macros', measure(lambda: state['compiler'].expand_macros(), repeat, setup=setup))
+
+@benchmark
+def bench_iteration_macros(repeat):
+    '''iterate_macro and literate_macro used by 1000 macro invocations in a 3000 line script (9000 lines once expanded).'''
+    from ksp_compiler import KSPCompiler
+    lines = ['macro voice(#n#)', '    message("voice #n#")', 'end macro',
+             'macro group(#name#)', '    message("#name#")', '    literate_macro(message("#l#")) on #name#_a, #name#_b', '    iterate_macro(voice) := 0 to 3', 'end macro',
+             'on init']
+    lines += ['    group(g%d)' % i for i in range(1000)]
+    lines += ['    message(%d)' % i for i in range(2000)]
+    lines += ['end on']
+    code = '\n'.join(lines) + '\n'
+    state = {}
+    def setup():
+        compiler = KSPCompiler(code, None)
+        compiler.do_imports_and_convert_to_line_objects()
+        compiler.extract_macros()
+        state['compiler'] = compiler
+    report('expand macros', measure(lambda: state['compiler'].expand_macros(), repeat, setup=setup))
+
+@benchmark
+def bench_function_inlining(repeat):
+    '''Inlining a 200 line function with parameters, a local variable and a return value at 1000 call sites.'''
+    from ksp_compiler import KSPCompiler
+    lines = ['function big(a, b) -> result', '    declare local tmp', '    result := 0']
+    for i in range(196):
+        if i % 4 == 0:
+            lines.append('    tmp := a * %d + b' % i)
+        elif i % 4 == 1:
+            lines.append('    if tmp > %d and b # %d' % (i, i))
+        elif i % 4 == 2:
+            lines.append('        result := result + (tmp mod %d) - values[%d]' % (i, i % 10))
+        else:
+            lines.append('    end if')
+    lines += ['end function', 'on init', '    declare values[10]', '    declare x', 'end on', 'on note']
+    lines += ['    x := big(EVENT_NOTE, %d)' % i for i in range(1000)]
+    lines += ['end on']
+    code = '\n'.join(lines) + '\n'
+
+    def inline_functions():
+        # the progress callback is invoked before each task, use it to time the inlining and to stop right after it
+        compiler = KSPCompiler(code, None)
+        start_times = {}
+        def callback(desc, percent):
+            start_times[desc] = time.perf_counter()
+            if desc == 'handle taskfunc':
+                compiler.abort_compilation()
+        compiler.compile(callback=callback)
+        return start_times['handle taskfunc'] - start_times['inline functions']
+    report('inline functions', [inline_functions() for i in range(repeat)])
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Run compiler performance benchmarks.')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='number of runs per measurement (default: 5)')
+    arg_parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of %s)' % ', '.join(benchmarks))
+    args = arg_parser.parse_args(argv)
+
+    for name in args.names or list(benchmarks):
+        if name not in benchmarks:
+            arg_parser.error('unknown benchmark: %s' % name)
+        print('%s: %s' % (name, benchmarks[name].__doc__))
+        benchmarks[name](args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -105,7 +105,42 @@ class ParseException(SyntaxError):
         self.msg = msg
         SyntaxError.__init__(self, msg)
 
+_atomic_types = frozenset([type(None), bool, int, float, str])
+
+def _deepcopy_value(value, memo):
+    ''' deep copies an attribute value of an AST node (with fast paths for the most common types) '''
+    value_type = type(value)
+    if value_type in _atomic_types:
+        return value
+    result = memo.get(id(value))
+    if result is not None:
+        return result
+    if value_type is list:
+        result = memo[id(value)] = []
+        result.extend([_deepcopy_value(item, memo) for item in value])
+        return result
+    if isinstance(value, ASTNode):
+        return value.__deepcopy__(memo)
+    return copy.deepcopy(value, memo)
+
+_unset = object()
+_slot_names = {}
+
+def _get_slot_names(cls):
+    ''' returns the names of all attributes of instances of the given node class (except lexinfo) '''
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for klass in reversed(cls.__mro__):
+            names.extend(name for name in klass.__dict__.get('__slots__', ()) if name != 'lexinfo')
+        names = _slot_names[cls] = tuple(names)
+    return names
+
 class ASTNode:
+    ''' base class of all nodes. To keep the memory footprint of large scripts small all node classes use __slots__, so every
+        attribute (including the ones attached to the nodes by the compiler passes) has to be listed there '''
+    __slots__ = ('lexinfo', 'env')
+
     def __init__(self, lexinfo):
         self.lexinfo = None
         self.env = None
@@ -124,6 +159,25 @@ class ASTNode:
     def copy(self):
         return copy.deepcopy(self)
 
+    def __deepcopy__(self, memo):
+        ''' The same as the default deep copy, only much faster. The function call nodes listed in lexinfo[2] (which are only
+            used for reporting the chain of inlined function calls in error messages) are shared rather than copied. '''
+        cls = self.__class__
+        clone = cls.__new__(cls)
+        memo[id(self)] = clone
+        lexinfo = self.lexinfo
+        if type(lexinfo) is tuple:
+            value = memo.get(id(lexinfo))
+            if value is None:
+                value = memo[id(lexinfo)] = (lexinfo[0], lexinfo[1], lexinfo[2][:])
+            lexinfo = value
+        clone.lexinfo = lexinfo
+        for name in _get_slot_names(cls):
+            value = getattr(self, name, _unset)
+            if value is not _unset:
+                setattr(clone, name, _deepcopy_value(value, memo))
+        return clone
+
     def put_symbol(self, name, value):
         self.env.put(name, value)
 
@@ -144,6 +198,8 @@ class ASTNode:
         return self.__class__.__name__
 
 class Module(ASTNode):
+    __slots__ = ('blocks', 'on_init')
+
     def __init__(self, lexinfo, blocks):
         ASTNode.__init__(self, lexinfo)
         self.blocks = blocks
@@ -161,6 +217,8 @@ class Module(ASTNode):
         return self.blocks
 
 class TopLevelBlock(ASTNode):
+    __slots__ = ('name', 'lines')
+
     def __init__(self, lexinfo, name, lines=None):
         ASTNode.__init__(self, lexinfo)
         self.name = name
@@ -176,6 +234,8 @@ class TopLevelBlock(ASTNode):
         return self.lines # NOTE: name?
 
 class Import(TopLevelBlock):
+    __slots__ = ('filename', 'alias')
+
     def __init__(self, lexinfo, filename, alias=None):
         TopLevelBlock.__init__(self, lexinfo, 'import', [])
         self.filename = filename
@@ -191,6 +251,10 @@ class Import(TopLevelBlock):
         return []
 
 class FunctionDef(TopLevelBlock):
+    __slots__ = ('parameters', 'parameter_types', 'return_value', 'is_taskfunc', 'override',
+                 # attributes added by the compiler
+                 'used', 'locals', 'locals_name_subst_dict', 'global_declaration_statements', 'local_declaration_statements', 'taskfunc_declaration_statements')
+
     def __init__(self, lexinfo, name, parameters, return_value, lines, is_taskfunc=False, override=False):
         TopLevelBlock.__init__(self, lexinfo, name, lines)
         self.name = name
@@ -215,6 +279,15 @@ class FunctionDef(TopLevelBlock):
 ##    def copy(self):
 ##        return FunctionDef(lexinfo, name.copy(), [l.copy() for l in self.lines])
 
+    def copy_body(self):
+        ''' returns a copy of the function definition where only the lines of the body (and the lexinfo) are copied and all other
+            attributes are shared with the original, for inlining where only the body is modified '''
+        memo = {}
+        clone = copy.copy(self)
+        clone.lexinfo = memo[id(self.lexinfo)] = (self.lexinfo[0], self.lexinfo[1], self.lexinfo[2][:])
+        clone.lines = copy.deepcopy(self.lines, memo)
+        return clone
+
     def get_childnodes(self):
         children = []
         children.append(self.name)
@@ -231,6 +304,8 @@ class FunctionDef(TopLevelBlock):
         out.writeln('end function')
 
 class Callback(TopLevelBlock):
+    __slots__ = ('variable',)
+
     def __init__(self, lexinfo, name, lines=None, variable=None):
         TopLevelBlock.__init__(self, lexinfo, name, lines)
         self.variable = None
@@ -253,6 +328,8 @@ class Callback(TopLevelBlock):
         out.writeln('end on')
 
 class Stmt(ASTNode):
+    __slots__ = ()
+
     def __init__(self, lexinfo):
         ASTNode.__init__(self, lexinfo)
 
@@ -265,6 +342,8 @@ class Stmt(ASTNode):
         pass
 
 class PropertyDef(Stmt):
+    __slots__ = ('name', 'get_func_def', 'set_func_def', 'functiondefs')
+
 
     def __init__(self, lexinfo, name, indices=None, functions=None, alias_varref=None):
         Stmt.__init__(self, lexinfo)
@@ -291,23 +370,58 @@ class PropertyDef(Stmt):
         return []
 
 class DeclareStmt(Stmt):
+    __slots__ = ('variable', 'modifiers', 'size', 'parameters', 'initial_value', 'ui_array_size', 'persistence')
 
-    def __init__(self, lexinfo, variable, modifiers, size=None, parameters=None, initial_value=None):
+    # the functions invoked on each control of a UI array declared with pers, instpers or read
+    persistence_functions = {'pers': ('make_persistent',),
+                             'instpers': ('make_instr_persistent',),
+                             'read': ('make_persistent', 'read_persistent_var')}
+
+    def __init__(self, lexinfo, variable, modifiers, size=None, parameters=None, initial_value=None, ui_array_size=None, persistence=None):
         Stmt.__init__(self, lexinfo)
         self.variable = variable
         self.modifiers = modifiers
         self.size = size
         self.parameters = parameters or []
         self.initial_value = initial_value
+        # if ui_array_size is given this statement declares that many controls of a UI array (see UIArrayStage in preprocessor_plugins.py).
+        # They are only declared one by one when the code is emitted, so until then variable is the first of them (the one with index 0).
+        self.ui_array_size = ui_array_size
+        self.persistence = persistence
 
     def isUIDeclaration(self):
         return any([m for m in self.modifiers if m.startswith('ui_')])
 
+    def get_ui_array_names(self):
+        ''' returns the names of the controls declared by a UI array declaration '''
+        name = str(self.variable)[:-1]  # strip the index of the first control
+        return [name + str(i) for i in range(self.ui_array_size)]
+
+    def expand_ui_array(self):
+        ''' returns a list of the statements declaring the controls of a UI array declaration one by one '''
+        result = []
+        for name in self.get_ui_array_names():
+            result.append(DeclareStmt(self.lexinfo, self.variable.copy(name), self.modifiers[:], copy.deepcopy(self.size),
+                                      copy.deepcopy(self.parameters)))
+            for function_name in self.persistence_functions.get(self.persistence, ()):
+                result.append(FunctionCall(self.lexinfo, ID(self.lexinfo, function_name), [VarRef(self.lexinfo, self.variable.copy(name))],
+                                           is_procedure=True))
+        return result
+
     def emit(self, out):
+        if self.ui_array_size is None:
+            self.emit_declaration(out, str(self.variable))
+        else:
+            for name in self.get_ui_array_names():
+                self.emit_declaration(out, name)
+                for function_name in self.persistence_functions.get(self.persistence, ()):
+                    out.writeln('%s(%s)' % (function_name, name))
+
+    def emit_declaration(self, out, name):
         out.write('declare ')
         if self.modifiers:
             out.write(' '.join(self.modifiers), ' ')
-        out.write(str(self.variable))
+        out.write(name)
         if self.size:
             out.write('[%s]' % self.size)
         if self.parameters:
@@ -359,6 +473,8 @@ class DeclareStmt(Stmt):
         return '<DeclareStmt %s>' % (str(self.variable.identifier))
 
 class AssignStmt(Stmt):
+    __slots__ = ('varref', 'expression')
+
     def __init__(self, lexinfo, varref, expression):
         Stmt.__init__(self, lexinfo)
         self.varref = varref
@@ -378,6 +494,8 @@ class AssignStmt(Stmt):
         return (self.varref, self.expression)
 
 class PreprocessorCondition(Stmt):
+    __slots__ = ('set_or_reset_name', 'parameter')
+
     def __init__(self, lexinfo, set_or_reset_name, parameter):
         Stmt.__init__(self, lexinfo)
         self.set_or_reset_name = set_or_reset_name
@@ -393,6 +511,8 @@ class PreprocessorCondition(Stmt):
         return []
 
 class FunctionCall(Stmt):
+    __slots__ = ('function_name', 'parameters', 'is_procedure', 'using_call_keyword', 'type')
+
     def __init__(self, lexinfo, function_name, parameters, is_procedure=False, using_call_keyword=False):
         Stmt.__init__(self, lexinfo)
         self.function_name = function_name
@@ -423,9 +543,11 @@ class FunctionCall(Stmt):
         return children
 
 class CompoundStmt(Stmt):
-    pass
+    __slots__ = ()
 
 class WhileStmt(CompoundStmt):
+    __slots__ = ('condition', 'statements')
+
     def __init__(self, lexinfo, condition, statements):
         CompoundStmt.__init__(self, lexinfo)
         self.condition = condition
@@ -443,6 +565,8 @@ class WhileStmt(CompoundStmt):
         return (self.condition,) + tuple(self.statements)
 
 class ForStmt(CompoundStmt):
+    __slots__ = ('loopvar', 'start', 'end', 'statements', 'step', 'downto')
+
     def __init__(self, lexinfo, loopvar, start, end, statements, step=None, downto=False):
         CompoundStmt.__init__(self, lexinfo)
         self.loopvar = loopvar
@@ -479,6 +603,8 @@ class ForStmt(CompoundStmt):
         return children
 
 class FamilyStmt(CompoundStmt):
+    __slots__ = ('name', 'statements')
+
     def __init__(self, lexinfo, name, statements):
         CompoundStmt.__init__(self, lexinfo)
         self.name = name
@@ -493,6 +619,8 @@ class FamilyStmt(CompoundStmt):
         return tuple(self.statements)
 
 class IfStmt(CompoundStmt):
+    __slots__ = ('condition_stmts_tuples',)
+
     def __init__(self, lexinfo, condition_stmts_tuples):
         CompoundStmt.__init__(self, lexinfo)
         self.condition_stmts_tuples = condition_stmts_tuples  # list of (condition, statement-list)-tuples. In the case of just "else" the condition will be None.
@@ -524,6 +652,8 @@ class IfStmt(CompoundStmt):
         self.condition_stmts_tuples = [(func(condition), stmts) for (condition, stmts) in self.condition_stmts_tuples]
 
 class SelectStmt(CompoundStmt):
+    __slots__ = ('expression', 'range_stmts_tuples')
+
     def __init__(self, lexinfo, expression, range_stmts_tuples):
         CompoundStmt.__init__(self, lexinfo)
         self.expression = expression
@@ -558,10 +688,14 @@ class SelectStmt(CompoundStmt):
         self.range_stmts_tuples = [((func(start), func(stop)), stmts) for ((start, stop), stmts) in self.range_stmts_tuples]
 
 class Expr(ASTNode):
+    __slots__ = ('type',)
+
     def __init__(self, lexinfo):
         ASTNode.__init__(self, lexinfo)
 
 class BinOp(Expr):
+    __slots__ = ('left', 'right', 'op')
+
     def __init__(self, lexinfo, left, op, right):
         Expr.__init__(self, lexinfo)
         self.left = left
@@ -589,6 +723,8 @@ class BinOp(Expr):
         return (self.left, self.right)
 
 class UnaryOp(Expr):
+    __slots__ = ('right', 'op')
+
     def __init__(self, lexinfo, op, right):
         Expr.__init__(self, lexinfo)
         self.right = right
@@ -613,6 +749,8 @@ class UnaryOp(Expr):
         return (self.right,)
 
 class Integer(Expr):
+    __slots__ = ('value',)
+
     def __init__(self, lexinfo, value):
         Expr.__init__(self, lexinfo)
         self.value = toint(value)
@@ -627,6 +765,8 @@ class Integer(Expr):
         return ()
 
 class Real(Expr):
+    __slots__ = ('value',)
+
     def __init__(self, lexinfo, value):
         Expr.__init__(self, lexinfo)
         self.value = Decimal(value)
@@ -651,6 +791,8 @@ class Real(Expr):
         return ()
 
 class String(Expr):
+    __slots__ = ('value',)
+
     def __init__(self, lexinfo, value):
         Expr.__init__(self, lexinfo)
         self.value = value
@@ -665,6 +807,8 @@ class String(Expr):
 # KSP doesn't support booleans, but this node type is used as an intermediary
 # in the optimization phase
 class Boolean(Expr):
+    __slots__ = ('value',)
+
     def __init__(self, lexinfo, value):
         Expr.__init__(self, lexinfo)
         self.value = bool(value)
@@ -679,6 +823,8 @@ class Boolean(Expr):
         return ()
 
 class ID(Expr):
+    __slots__ = ('_identifier', 'prefix', 'identifier_first_part', 'identifier_last_part', 'namespace_prefix_done')
+
     def __init__(self, lexinfo, identifier):
         Expr.__init__(self, lexinfo)
         if identifier[0] in '$%@!?~':
@@ -726,6 +872,8 @@ class ID(Expr):
         return ()
 
 class VarRef(Expr):
+    __slots__ = ('identifier', 'subscripts')
+
     def __init__(self, lexinfo, identifier, subscripts=None):
         Expr.__init__(self, lexinfo)
         if subscripts is None:
@@ -746,6 +894,8 @@ class VarRef(Expr):
         return children
 
 class RawArrayInitializer(Expr):
+    __slots__ = ('raw_text',)
+
     def __init__(self, lexinfo, raw_text):
         Expr.__init__(self, lexinfo)
         self.raw_text = raw_text
@@ -22,15 +22,26 @@ import ksp_ast_processing
 from ksp_compiler_extras import flatten
 import ksp_compiler_extras as comp_extras
 import ksp_builtins
-from ksp_parser import parse
+from ksp_parser import parse, parse_part
+import ksp_parser
 from taskfunc import taskfunc_code
 from collections import OrderedDict
 import hashlib
+import pickle
+import io
+import codecs
+import glob
+import multiprocessing
 import ply.lex as lex
 # NOTE(Sam): include preprocessor and logger
 from logger import logger_code
 import time
-from preprocessor_plugins import pre_macro_functions, macro_iter_functions, post_macro_functions
+import sys
+# when run as a script, make the preprocessor plugins (which import ksp_compiler) see this module instead of importing a second copy.
+# Worker processes started with spawn (the default on Windows and macOS) import the script again as __mp_main__.
+if __name__ in ('__main__', '__mp_main__'):
+    sys.modules.setdefault('ksp_compiler', sys.modules[__name__])
+from preprocessor_plugins import pre_macro_functions, macro_iteration_handlers, post_macro_functions
 import json
 import copy
 
@@ -50,28 +61,35 @@ macro_start_re = re.compile(r'^\s*macro(?=\W)')
 macro_end_re = re.compile(r'^\s*end\s+macro')
 line_continuation_re = re.compile(r'\.\.\.\s*\n', re.MULTILINE)
 
-placeholders = {}           # mapping from placeholder number to contents (placeholders used for comments, strings and ...)
-functions = OrderedDict()   # maps from function name to AST node corresponding to the function definition
-variables = set()           # a set of the names of the declared variables (prefixed with $, %, !, ? or @)
-ui_variables = set()        # a set of the names of the declared variables of UI type, like ui_knob, ui_value_edit, etc. (prefixed with $, %, !, ? or @)
-families = set()            # a set of the family names (prefixed with namespaces)
-properties = set()
-functions_invoking_wait = set()
-true_conditions = set()     # the conditions set using SET_CONDITION
-called_functions = set()    # functions that are somewhere in the script invoked using the Kontakt 4.1 "call" keyword
-call_graph = collections.defaultdict(list)  # an item (a, b) is included if function a invokes function b using the "call" keyword
-
-def init_globals():
-    variables.clear()
-    ui_variables.clear()
-    functions.clear()
-    placeholders.clear()
-    families.clear()
-    properties.clear()
-    functions_invoking_wait.clear()
-    true_conditions.clear()
-    called_functions.clear()
-    call_graph.clear()
+class CompilationContext(object):
+    ''' Holds the state of a single compilation (tables built up and consulted by the various compilation passes).
+        Each KSPCompiler instance has its own context so that several compilations can run in parallel threads. '''
+
+    def __init__(self):
+        self.placeholders = {}            # mapping from placeholder number to contents (placeholders used for comments, strings and ...)
+        self.functions = OrderedDict()    # maps from function name to AST node corresponding to the function definition
+        self.variables = set()            # a set of the names of the declared variables (prefixed with $, %, !, ? or @)
+        self.ui_variables = set()         # a set of the names of the declared variables of UI type, like ui_knob, ui_value_edit, etc. (prefixed with $, %, !, ? or @)
+        self.families = set()             # a set of the family names (prefixed with namespaces)
+        self.properties = set()
+        self.functions_invoking_wait = set()
+        self.true_conditions = set()      # the conditions set using SET_CONDITION
+        self.called_functions = set()     # functions that are somewhere in the script invoked using the Kontakt 4.1 "call" keyword
+        self.call_graph = collections.defaultdict(list)  # an item (a, b) is included if function a invokes function b using the "call" keyword
+
+        # tables used by the extra syntax checks and optimizations (see ksp_compiler_extras)
+        self.symbol_table = {}
+        self.nckp_table = []
+        self.user_defined_functions = {}
+        self.key_ids = {}
+
+    def clear_symbol_table(self):
+        self.symbol_table.clear()
+        self.key_ids.clear()
+        self.user_defined_functions.clear()
+
+    def add_nckp_var_to_nckp_table(self, nckp_ui_variable):
+        self.nckp_table.append(nckp_ui_variable.lower())
 
 # simple class to work-around the problem that cStringIO cannot handle certain unicode input
 class StringIO:
@@ -160,32 +178,88 @@ class ParseException(ExceptionWithMessage):
         self.line = line
         self.message = msg
 
+def make_name_subst_func(name_subst_dict):
+    ''' returns a function for use with varname_re.sub/varname_dot_re.sub which replaces the names found in name_subst_dict '''
+    def repl_func(match):
+        n = match.group(0)
+        if n.endswith('.'):
+            suffix = '.'
+            n = n[:-1]
+        else:
+            suffix = ''
+        if n in name_subst_dict:
+            return name_subst_dict[n] + suffix
+        else:
+            return n + suffix
+    return repl_func
+
+class Location:
+    ''' One link of the chain of source locations of a line. The first link (the origin) is where the text of the line comes from,
+        each macro expansion adds a link for the place of the invocation. Links are immutable and shared by all copies of a line,
+        and links added to the same chain for the same place are interned, so that eg. the lines of a macro invoked
+        from within another macro share their location chain across all invocations of the outer macro. '''
+    __slots__ = ('filename', 'lineno', 'parent', 'origin', 'children')
+
+    def __init__(self, filename, lineno, parent=None):
+        self.filename = sys.intern(filename) if filename else filename
+        self.lineno = lineno
+        self.parent = parent     # the link for the locations before this one
+        self.origin = parent.origin if parent else self
+        self.children = None     # maps (filename, lineno) to the interned links added to this one
+
+    def add(self, filename, lineno):
+        ''' returns the chain made of this one followed by the given location '''
+        if self.children is None:
+            self.children = {}
+        key = (filename, lineno)
+        location = self.children.get(key)
+        if location is None:
+            location = self.children[key] = Location(filename, lineno, self)
+        return location
+
+    def __iter__(self):
+        ''' yields the (filename, lineno) tuples of the chain, the most recently added location first '''
+        location = self
+        while location:
+            yield (location.filename, location.lineno)
+            location = location.parent
+
+unknown_location = Location(None, -1)
+
 class Line:
-    def __init__(self, s, locations=None, namespaces=None):
-        # locations should be a list of (filename, lineno) tuples
+    __slots__ = ('command', 'location', 'namespaces')
+
+    def __init__(self, s, location=None, namespaces=None):
+        # location is the last link of a chain of Location objects
         self.command = s
-        self.locations = locations or [(None, -1)]
+        self.location = location or unknown_location
         self.namespaces = namespaces or []   # a list of the namespaces (each import appends the as-name onto the stack)
 
     def get_lineno(self):
-        return self.locations[0][1]
+        return self.location.origin.lineno
     lineno = property(get_lineno)
 
     def get_filename(self):
-        return self.locations[0][0]
+        return self.location.origin.filename
     filename = property(get_filename)
 
+    def get_locations(self):
+        ''' returns the location chain as a list of (filename, lineno) tuples, starting with the origin '''
+        return list(self.location)[::-1]
+    locations = property(get_locations)
+
     def get_locations_string(self):
         return '\n'.join(
-            ('%s%s:%d \r\n' % (' ' * (i * 4), filename or '<main script>', lineno)) for (i, (filename, lineno)) in enumerate(reversed(self.locations)))
+            ('%s%s:%d \r\n' % (' ' * (i * 4), filename or '<main script>', lineno)) for (i, (filename, lineno)) in enumerate(self.location))
 
     def copy(self, new_command=None, add_location=None):
         """ returns a copy of the line.
             If the new_command parameter is specified that will be the command of the new line
-            and it will get the same indentation as the old line. """
-        line = Line(self.command, self.locations, self.namespaces)
+            and it will get the same indentation as the old line.
+            If add_location (a (filename, lineno) tuple) is given it's appended to the location chain of the new line. """
+        line = Line(self.command, self.location, self.namespaces)
         if add_location:
-            line.locations = line.locations + [add_location]
+            line.location = self.location.add(*add_location)
         if new_command:
             line.command = new_command
         return line
@@ -194,22 +268,12 @@ class Line:
         if not name_subst_dict:
             return self
 
-        def repl_func(match):
-            n = match.group(0)
-            if n.endswith('.'):
-                suffix = '.'
-                n = n[:-1]
-            else:
-                suffix = ''
-            if n in name_subst_dict:
-                return name_subst_dict[n] + suffix
-            else:
-                return n + suffix
+        repl_func = make_name_subst_func(name_subst_dict)
         s = varname_re.sub(repl_func, self.command)
         s = varname_dot_re.sub(repl_func, s)
         return self.copy(new_command=s)
 
-    def replace_placeholders(self):
+    def replace_placeholders(self, placeholders):
         replace_func = lambda matchobj: placeholders[int(matchobj.group(1))]
         self.command = re.sub(r'\{(\d+?)\}', replace_func, self.command)
 
@@ -219,10 +283,26 @@ class Line:
     def __repr__(self):
         return self.command
 
+class LineBuffer(list):
+    ''' The Line objects of a script, as passed through the import handling and the preprocessor. Unlike a deque it supports
+        indexing in O(1), which the preprocessor functions rely on as they loop over the line indices.
+        Functions generating many lines should build a new list and pass it to replace (which is linear in the total number of lines),
+        splice is for inserting or replacing a few blocks of lines. '''
+    __slots__ = ()
+
+    def splice(self, start, stop, lines):
+        ''' replaces the lines start to stop (exclusive) by the given lines '''
+        self[start:stop] = lines
+
+    def replace(self, lines):
+        ''' replaces all the lines in place by the given lines '''
+        self[:] = lines
+
 class Macro:
     def __init__(self, lines):
         self.lines = lines
         self.name, self.parameters = self.get_macro_name_and_parameters()
+        self.template = None   # built on first use by get_template
 
     def get_name_prefixed_by_namespace(self):
         return prefix_with_ns(self.name, self.lines[0].namespaces)
@@ -247,12 +327,12 @@ class Macro:
             lines = self.lines[:]
         return Macro([l.copy(add_location=add_location) for l in lines])
 
-    def substitute_names(self, name_subst_dict):
+    def substitute_names(self, name_subst_dict, placeholders):
         """ returns a copy of the block with the specified name substitutions made """
         new_macro = self.copy(lines=[line.substitute_names(name_subst_dict) for line in self.lines])
 
         for line in new_macro.lines:
-            line.replace_placeholders()
+            line.replace_placeholders(placeholders)
 
         # handle raw replacements (arguments like #var# should be substituted irrespectively of context)
         for name1, name2 in list(name_subst_dict.items()):
@@ -262,12 +342,56 @@ class Macro:
 
         return new_macro
 
+    def get_template(self):
+        """ returns the body of the macro as a list of (line, parts) tuples, where parts alternates between literal text (even indices)
+            and names of parameters (odd indices). This is where varname_re would find the parameters, so it only needs to be done once. """
+        if self.template is None:
+            parameters = set(self.parameters)
+            self.template = []
+            for line in self.lines[1:-1]:
+                parts = []
+                pos = 0
+                for m in varname_re.finditer(line.command):
+                    if m.group(0) in parameters:
+                        parts.extend([line.command[pos:m.start()], m.group(0)])
+                        pos = m.end()
+                parts.append(line.command[pos:])
+                self.template.append((line, parts))
+        return self.template
+
+    def expand(self, name_subst_dict, placeholders, add_location):
+        """ returns the lines of the macro body (excluding the macro/end macro lines) with the parameters substituted. The result is the same
+            as that of self.copy(add_location=add_location).substitute_names(name_subst_dict, placeholders).lines[1:-1] but the parameters
+            are filled into the template instead of searching each line for them again. """
+        dot_repl_func = make_name_subst_func(name_subst_dict)
+        raw_substitutions = [(name1, name2) for (name1, name2) in name_subst_dict.items() if name1.startswith('#')]
+        replace_func = lambda matchobj: placeholders[int(matchobj.group(1))]
+        lines = []
+        for (line, parts) in self.get_template():
+            if len(parts) == 1:
+                s = parts[0]
+            else:
+                parts = parts[:]
+                parts[1::2] = [name_subst_dict[name] for name in parts[1::2]]
+                s = ''.join(parts)
+            if name_subst_dict:
+                if '.' in s:
+                    s = varname_dot_re.sub(dot_repl_func, s)
+                if not s:
+                    s = line.command   # like Line.copy, which ignores an empty new command
+            if '{' in s:
+                s = placeholder_ref_re.sub(replace_func, s)
+            for name1, name2 in raw_substitutions:
+                s = s.replace(name1, name2)
+            lines.append(Line(s, line.location.add(*add_location), line.namespaces))
+        return lines
+
 def merge_lines(lines):
     """ converts a list of Line objects to a source code string """
     return '\n'.join([line.command for line in lines])
 
-def parse_lines(s, filename=None, namespaces=None):
-    """ converts a source code string to a list of Line objects """
+def parse_lines(s, placeholders, filename=None, namespaces=None):
+    """ converts a source code string to a list of Line objects (strings are replaced by placeholders stored in the given dict) """
 
     if namespaces is None:
         namespaces = []
@@ -309,24 +433,292 @@ def parse_lines(s, filename=None, namespaces=None):
     for line in s.split('\n'):
         lineno, line = int(line[3:3+5]), line[3+5+3:]
         line = placeholder_re.sub('', line)
-        lines.append(Line(line, [(filename, lineno)], namespaces))
-    return collections.deque(lines)
+        lines.append(Line(line, Location(filename, lineno), namespaces))
+    return LineBuffer(lines)
+
+placeholder_ref_re = re.compile(r'\{(\d+)\}')
+
+class ImportCache(object):
+    ''' Caches the result of parse_lines for imported files so that files which have not changed since the last
+        compilation don't have to be tokenized again. Entries are keyed by (filename, namespaces) and only reused if the
+        hash of the file contents matches. If cache_dir is given the entries are also pickled to that directory so that
+        they can be reused by other processes. '''
+
+    version = 1
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.entries = {}     # maps (filename, namespaces) to (content hash, entry) - only the latest version of each file is kept
+        self.hits = 0
+        self.misses = 0
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+
+    def parse_lines(self, code, placeholders, filename=None, namespaces=None):
+        ''' same as the parse_lines function, but returns a copy of the cached result if available '''
+        if namespaces is None:
+            namespaces = []
+        key = (filename, tuple(namespaces))
+        content_hash = hashlib.sha1(code.encode('utf-8', 'surrogatepass')).hexdigest()
+        entry = self.get_entry(key, content_hash)
+        if entry is None:
+            self.misses += 1
+            first_placeholder = len(placeholders)
+            lines = parse_lines(code, placeholders, filename, namespaces)
+            self.store_entry(key, content_hash, lines, placeholders, first_placeholder)
+            return lines
+        self.hits += 1
+
+        # the entry refers to its placeholders relative to the first one, so renumber them to follow the current ones
+        line_tuples, placeholder_values = entry
+        first_placeholder = len(placeholders)
+        for i, value in enumerate(placeholder_values):
+            placeholders[first_placeholder + i] = value
+        renumber = lambda m: '{%d}' % (int(m.group(1)) + first_placeholder)
+        return LineBuffer(Line(placeholder_ref_re.sub(renumber, command), Location(filename, lineno), namespaces)
+                          for (command, lineno) in line_tuples)
+
+    def get_cache_file_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf-8', 'surrogatepass')).hexdigest() + '.pickle')
+
+    def get_entry(self, key, content_hash):
+        if key in self.entries and self.entries[key][0] == content_hash:
+            return self.entries[key][1]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.get_cache_file_path(key), 'rb') as f:
+                version, stored_key, stored_hash, entry = pickle.load(f)
+        except Exception:
+            return None
+        if (version, stored_key, stored_hash) != (self.version, key, content_hash):
+            return None
+        self.entries[key] = (content_hash, entry)
+        return entry
+
+    def store_entry(self, key, content_hash, lines, placeholders, first_placeholder):
+        renumber = lambda m: '{%d}' % (int(m.group(1)) - first_placeholder)
+        line_tuples = tuple((placeholder_ref_re.sub(renumber, line.command), line.lineno) for line in lines)
+        placeholder_values = tuple(placeholders[i] for i in range(first_placeholder, len(placeholders)))
+        entry = (line_tuples, placeholder_values)
+        self.entries[key] = (content_hash, entry)
+        if self.cache_dir:
+            path = self.get_cache_file_path(key)
+            tmp_path = '%s.%d' % (path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump((self.version, key, content_hash, entry), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except (IOError, OSError):
+                pass
 
-def parse_lines_and_handle_imports(code, filename=None, namespaces=None, read_file_function=None, preprocessor_func=None):
-    """ reads one block from the lines deque """
+class ParseCache(object):
+    ''' Caches the ASTs of the top-level blocks (callbacks, functions and imports) of the parsed code so that after an edit
+        only the blocks which have changed are parsed again. The code is split into blocks at the lines where they begin and
+        end, each block is parsed on its own and its AST is stored keyed by the hash of its text. The entries are only kept in
+        memory, the least recently used ones are dropped when there are more than max_entries.
+        If jobs is more than one the blocks which aren't cached are parsed concurrently by a pool of that many worker
+        processes (call close when the cache isn't needed anymore), started using mp_context if given. '''
+
+    block_begin_re = re.compile(r'(?P<callback>%s)|(?P<keyword>function|taskfunc|import)(?![A-Za-z0-9_.])' % ksp_parser.t_BEGIN_CALLBACK.__doc__)
+    block_end_res = {'callback': re.compile(ksp_parser.t_END_CALLBACK.__doc__),
+                     'function': re.compile(r'end[ \t]+function(?![A-Za-z0-9_.])'),
+                     'taskfunc': re.compile(r'end[ \t]+taskfunc(?![A-Za-z0-9_.])')}
+    # comments are removed from the lines before parsing, if there were any left they could span several blocks
+    comment_begin_re = re.compile(r'%s|(?P<comment>\{|\(\*)' % ksp_parser.t_STRING)
+
+    def __init__(self, max_entries=10000, jobs=None, mp_context=None):
+        self.max_entries = max_entries
+        self.jobs = jobs
+        self.mp_context = mp_context
+        self.pool = None
+        self.entries = OrderedDict()   # maps the hash of the text of a block to (pickled AST, number of lines)
+        self.hits = 0
+        self.misses = 0
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        ''' stops the worker processes, if any '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def split_blocks(self, lines):
+        ''' returns the (first, last) line index of each top-level block, or None if the lines can't be split safely '''
+        blocks = []
+        kind = None   # the kind of block the current line belongs to (None if it's between blocks)
+        for i, line in enumerate(lines):
+            line = line.lstrip(' \t')
+            if not line:
+                continue
+            if any(m.group('comment') for m in self.comment_begin_re.finditer(line)):
+                return None
+            m = self.block_begin_re.match(line)
+            if kind is None:
+                if not m:
+                    return None
+                kind = m.group('keyword') or 'callback'
+                if kind == 'import':
+                    blocks.append((i, i))
+                    kind = None
+                else:
+                    first = i
+                    depth = 0
+            elif kind == 'function' and m and m.group('keyword') == 'function':
+                depth += 1   # the get/set function of a property declared within the function
+            elif self.block_end_res[kind].match(line):
+                if depth == 0:
+                    blocks.append((first, i))
+                    kind = None
+                else:
+                    depth -= 1
+        if kind is not None:
+            return None
+        return blocks
+
+    def parse(self, code):
+        ''' same as the parse function, but only parses the blocks which aren't cached '''
+        code = code.replace('\r', '')
+        lines = code.split('\n')
+        blocks = self.split_blocks(lines)
+        if blocks is None:
+            return parse(code)
+        texts = ['\n'.join(lines[first:last+1]) for first, last in blocks]
+        module_blocks = []
+        line_index = lineno = 0   # the line index and the line number of the lexer at the beginning of the current line
+        try:
+            parsed_keys = self.parse_blocks_in_pool(texts) if self.jobs and self.jobs > 1 else set()
+            if parsed_keys is None:
+                return parse(code)
+            for (first, last), text in zip(blocks, texts):
+                lineno += first - line_index
+                key = self.block_key(text)
+                if key in parsed_keys:
+                    block, lineno = self.load_block(key, lineno)
+                else:
+                    block, lineno = self.parse_block(text, lineno)
+                module_blocks.append(block)
+                line_index = last
+        except Exception:
+            # report the error in the same way as when parsing all of the code at once
+            return parse(code)
+        finally:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return ksp_ast.Module(('current file', 0, []), module_blocks)
+
+    def block_key(self, text):
+        return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def parse_blocks_in_pool(self, texts):
+        ''' parses the blocks which aren't cached in the worker processes and stores them, returns the keys of the stored blocks
+            or None if some block couldn't be parsed '''
+        missing = OrderedDict()
+        for text in texts:
+            key = self.block_key(text)
+            if key not in self.entries:
+                missing[key] = text
+        if len(missing) < 2:
+            return set()
+        if self.pool is None:
+            self.pool = (self.mp_context or multiprocessing).Pool(self.jobs)
+        results = self.pool.map(parse_block_to_pickle, list(missing.values()))
+        if None in results:
+            return None
+        self.misses += len(missing)
+        self.entries.update(zip(missing.keys(), results))
+        return set(missing.keys())
+
+    def parse_block(self, text, lineno):
+        ''' returns the AST of the block and the line number at the end of it '''
+        key = self.block_key(text)
+        if key not in self.entries:
+            self.misses += 1
+            module, end_lineno = parse_part(text, lineno)
+            if len(module.blocks) != 1:
+                raise ksp_parser.ParseException(module, 'not a single block')
+            # the compiler modifies the AST it is given, so a pickled copy is stored (unpickling is much faster than copying)
+            f = io.BytesIO()
+            ASTPickler(f, -lineno).dump(module.blocks[0])
+            self.entries[key] = (f.getvalue(), end_lineno - lineno)
+            return module.blocks[0], end_lineno
+        self.hits += 1
+        return self.load_block(key, lineno)
+
+    def load_block(self, key, lineno):
+        ''' returns a new copy of the cached AST of a block starting at line lineno and the line number at the end of it '''
+        self.entries.move_to_end(key)
+        data, num_lines = self.entries[key]
+        return ASTUnpickler(io.BytesIO(data), lineno).load(), lineno + num_lines
+
+def parse_block_to_pickle(text):
+    ''' parses a top-level block in a worker process of a ParseCache, returns the AST of the block pickled by ASTPickler
+        and the number of lines of the block, or None if it couldn't be parsed (the error is reported by parsing all of the
+        code again in the main process) '''
+    try:
+        module, num_lines = parse_part(text, 0)
+        if len(module.blocks) != 1:
+            return None
+        f = io.BytesIO()
+        ASTPickler(f, 0).dump(module.blocks[0])
+        return (f.getvalue(), num_lines)
+    except Exception:
+        return None
+
+class ASTPickler(pickle.Pickler):
+    ''' pickles an AST with the line numbers in its lexinfo tuples shifted by line_offset '''
+
+    def __init__(self, f, line_offset):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.line_offset = line_offset
+        self.lexinfo_ids = {}
+
+    def persistent_id(self, obj):
+        # the lexinfo tuples of a newly parsed AST don't refer to any function calls yet, a tuple can be shared by several nodes
+        if obj.__class__ is tuple and len(obj) == 3 and obj[1].__class__ is int and obj[2].__class__ is list and not obj[2]:
+            pid = self.lexinfo_ids.get(id(obj))
+            if pid is None:
+                pid = self.lexinfo_ids[id(obj)] = (len(self.lexinfo_ids), obj[0], obj[1] + self.line_offset)
+            return pid
+        return None
+
+class ASTUnpickler(pickle.Unpickler):
+    ''' unpickles an AST pickled by ASTPickler, adding line_offset to its line numbers '''
+
+    def __init__(self, f, line_offset):
+        pickle.Unpickler.__init__(self, f)
+        self.line_offset = line_offset
+        self.lexinfos = {}
+
+    def persistent_load(self, pid):
+        lexinfo = self.lexinfos.get(pid[0])
+        if lexinfo is None:
+            lexinfo = self.lexinfos[pid[0]] = (pid[1], pid[2] + self.line_offset, [])
+        return lexinfo
+
+def parse_lines_and_handle_imports(code, placeholders, filename=None, namespaces=None, read_file_function=None, preprocessor_func=None, import_cache=None):
+    """ returns the lines of the code as a LineBuffer, with the import lines replaced by the lines of the imported files """
 
     if preprocessor_func:
         code = preprocessor_func(code, namespaces)
 
-    lines = parse_lines(code, filename, namespaces)
+    if import_cache is not None and filename is not None:
+        lines = import_cache.parse_lines(code, placeholders, filename, namespaces)
+    else:
+        lines = parse_lines(code, placeholders, filename, namespaces)
 
-    new_lines = collections.deque()
-    while lines:
-        line = lines.popleft()
+    new_lines = LineBuffer()
+    for line in lines:
 
         # if line seems to be an import line
         if import_basic_re.match(line.command):
-            line.replace_placeholders()
+            line.replace_placeholders(placeholders)
 
             # check if it matches a more elaborate syntax
             m = import_re.match(str(line))
@@ -349,14 +741,14 @@ def parse_lines_and_handle_imports(code, filename=None, namespaces=None, read_fi
             if preprocessor_func:
                 code = preprocessor_func(code, namespaces)
 
-            new_lines.extend(parse_lines_and_handle_imports(code, filename, namespaces, read_file_function))
+            new_lines.extend(parse_lines_and_handle_imports(code, placeholders, filename, namespaces, read_file_function, import_cache=import_cache))
         # non-import line so just add it to result line list:
         else:
             new_lines.append(line)
 
     return new_lines
 
-def handle_conditional_lines(lines):
+def handle_conditional_lines(lines, true_conditions):
     ''' handle SET_CONDITION, RESET_CONDITION, USE_CODE_IF and USE_CODE_IF_NOT '''
     use_code_conds = []
     false_index = -1
@@ -409,20 +801,18 @@ def handle_conditional_lines(lines):
         if clear_this_line:
             line_obj.command = re.sub(r'[^\r\n]', '', line)
 
-def extract_macros(lines_deque):
+def extract_macros(lines):
     ''' returns (cleaned_lines, macros) '''
     macros = []
-    lines = lines_deque
-    cleaned_lines = []
+    lines = iter(lines)
+    cleaned_lines = LineBuffer()
 
-    while lines:
-        line = lines.popleft()
+    for line in lines:
         # if macro definition found, read lines up until the next "end macro"
         if macro_start_re.match(line.command):
             found_end = False
             macro_lines = [line]
-            while lines:
-                line = lines.popleft()
+            for line in lines:
                 macro_lines.append(line)
                 if macro_end_re.match(line.command):
                     found_end = True
@@ -458,9 +848,20 @@ def extract_callback_lines(lines):
     return (normal_lines, callback_lines)
 
 
-def expand_macros(lines, macros, level=0):
+def expand_macros(lines, macros, placeholders, level=0, expanded_lines=None, iteration_handlers=()):
     ''' inline macro invocations by the body of the macro definition (with parameters properly replaced)
-        returns tuple (normal_lines, callback_lines) where the latter are callbacks'''
+        returns tuple (normal_lines, callback_lines) where the latter are callbacks
+
+        Expansion happens in generations: the lines produced by the substitutions of one generation are scanned in the next one,
+        and the callbacks taken out of the macro bodies of a generation are placed after all the other lines of the next one.
+        Lines which have been scanned without finding a macro invocation are never scanned again, and neither are the lines in
+        expanded_lines (an optional set of lines known to contain no macro invocations). Each line is therefore matched against
+        the macro invocation pattern once, instead of once per generation.
+
+        iteration_handlers is a sequence of (pattern, unroll) pairs (see preprocessor_plugins.macro_iteration_handlers). The lines
+        matching one of the patterns are set aside when scanned. When a generation makes no substitutions the lines of the first
+        pair having any are replaced by unroll(line, match) and expansion starts over (at level 0) from there, the other lines
+        being passed on as they are.'''
     macro_call_re = re.compile(r'^\s*([\w_.]+)\s*(\(.*\))?%s$' % white_space)
     name2macro = {}
 
@@ -469,21 +870,60 @@ def expand_macros(lines, macros, level=0):
         if not (name == 'tcm.init' and name in name2macro):
             name2macro[name] = m
     #name2macro = dict([(m.get_name_prefixed_by_namespace(), m) for m in macros])
-    orig_lines = lines
-    lines = collections.deque(orig_lines)
-    new_lines = []
-    new_callback_lines = []
-    num_substitutions = 0
-    while lines:
-        line = lines.popleft()
-        new_lines.append(line)
-        m = macro_call_re.match(line.command)
-        if m:
-            macro_name, args = m.group(1), m.group(2)
-            macro_name = prefix_with_ns(macro_name, line.namespaces)
 
-            if macro_name in name2macro:
-                new_lines.pop()
+    # the lines of the current generation are kept as a list of segments, each being a tuple (kind, lines). The lines of a SCANNED segment
+    # are known to not contain macro invocations, those of an UNSCANNED one have yet to be scanned, and a segment whose kind is an index
+    # into iteration_handlers holds lines waiting to be unrolled. Only UNSCANNED segments are looked at by a generation.
+    SCANNED, UNSCANNED = 'scanned', 'unscanned'
+    if expanded_lines:
+        segments = [(SCANNED if line in expanded_lines else UNSCANNED, [line]) for line in lines]
+    else:
+        segments = [(UNSCANNED, list(lines))]
+
+    def add_segment(segments, kind, lines):
+        if not lines:
+            return
+        if segments and segments[-1][0] == kind:
+            segments[-1][1].extend(lines)
+        else:
+            segments.append((kind, lines))
+
+    def iteration_kind(line):
+        command = line.command.strip()
+        for (index, (pattern, unroll)) in enumerate(iteration_handlers):
+            if pattern.match(command):
+                return index
+        return SCANNED
+
+    while True:
+        new_segments = []
+        callback_segments = []
+        num_substitutions = 0
+        for (kind, segment_lines) in segments:
+            if kind != UNSCANNED:
+                add_segment(new_segments, kind, segment_lines)
+                continue
+            scanned_lines = []
+            for line in segment_lines:
+                m = macro_call_re.match(line.command)
+                if m:
+                    macro_name, args = m.group(1), m.group(2)
+                    macro_name = prefix_with_ns(macro_name, line.namespaces)
+                else:
+                    macro_name = None
+
+                if macro_name not in name2macro:
+                    line_kind = iteration_kind(line) if iteration_handlers else SCANNED
+                    if line_kind == SCANNED:
+                        scanned_lines.append(line)
+                    else:
+                        add_segment(new_segments, SCANNED, scanned_lines)
+                        scanned_lines = []
+                        add_segment(new_segments, line_kind, [line])
+                    continue
+
+                add_segment(new_segments, SCANNED, scanned_lines)
+                scanned_lines = []
 
                 macro = name2macro[macro_name]
                 if args:
@@ -501,28 +941,43 @@ def expand_macros(lines, macros, level=0):
                 # build a substitution mapping parameters to arguments, and substitute
                 name_subst_dict = dict(list(zip(macro.parameters, args)))
 
-                macro = macro.copy(add_location=line.locations[0])
-                macro = macro.substitute_names(name_subst_dict)
-
-                # add macro body
-                if args:
-                    macro_call_str = '%s(%s)' % (macro_name, ', '.join([re.sub(white_space, '', a).strip() for a in args]))
-                else:
-                    macro_call_str = '%s' % (macro_name)
-                macro_call_str = re.sub(white_space, '', macro_call_str) # erase any inner comments to not disturb outer
-                normal_lines, callback_lines = extract_callback_lines(macro.lines[1:-1])
-                new_lines.extend(normal_lines)
-                new_callback_lines.extend(callback_lines)
+                # add macro body (to be scanned in the next generation)
+                normal_lines, callback_lines = extract_callback_lines(macro.expand(name_subst_dict, placeholders, (line.filename, line.lineno)))
+                add_segment(new_segments, UNSCANNED, normal_lines)
+                add_segment(callback_segments, UNSCANNED, callback_lines)
 
                 num_substitutions += 1
-    if num_substitutions:
-        return expand_macros(new_lines + new_callback_lines, macros, level+1)
-    else:
-        return (new_lines, new_callback_lines)
+            add_segment(new_segments, SCANNED, scanned_lines)
+
+        for (kind, segment_lines) in callback_segments:
+            add_segment(new_segments, kind, segment_lines)
+        segments = new_segments
+        if num_substitutions:
+            level += 1
+            continue
+
+        # no more macro invocations, unroll the lines of the first kind of iteration there are any of (their lines are scanned next)
+        waiting = set(kind for (kind, segment_lines) in segments if kind not in (SCANNED, UNSCANNED))
+        if not waiting:
+            break
+        unroll_kind = min(waiting)
+        pattern, unroll = iteration_handlers[unroll_kind]
+        new_segments = []
+        for (kind, segment_lines) in segments:
+            if kind != unroll_kind:
+                add_segment(new_segments, kind, segment_lines)
+                continue
+            for line in segment_lines:
+                add_segment(new_segments, UNSCANNED, unroll(line, pattern.match(line.command.strip())))
+        segments = new_segments
+        level = 0
+
+    return ([line for (kind, segment_lines) in segments for line in segment_lines], [])
 
 class ASTModifierBase(ksp_ast_processing.ASTModifier):
-    def __init__(self, modify_expressions=False):
+    def __init__(self, modify_expressions=False, context=None):
         ksp_ast_processing.ASTModifier.__init__(self, modify_expressions=modify_expressions)
+        self.context = context   # the CompilationContext (only needed by modifiers that use the tables built during compilation)
 
     def modifyFunctionCall(self, node, *args, **kwargs):
         # there are some functions/preprocessor directives for which the first parameter should always be left as is
@@ -544,8 +999,8 @@ class ASTModifierBase(ksp_ast_processing.ASTModifier):
             return node
 
 class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
-    def __init__(self, ast, line_map):
-        ASTModifierBase.__init__(self, modify_expressions=True)
+    def __init__(self, ast, line_map, context):
+        ASTModifierBase.__init__(self, modify_expressions=True, context=context)
         self.line_map = line_map
         self.traverse(ast, parent_function=None, function_params=[], parent_families=[])
 
@@ -570,7 +1025,7 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
         ASTModifierBase.modifyModule(self, node, *args, **kwargs)
 
         # in case some function definition has been overriden, keep only the version among functions.value()
-        node.blocks = [b for b in node.blocks if not (isinstance(b, ksp_ast.FunctionDef) and functions[b.name.identifier] != b)]
+        node.blocks = [b for b in node.blocks if not (isinstance(b, ksp_ast.FunctionDef) and self.context.functions[b.name.identifier] != b)]
         return node
 
     def modifyForStmt(self, node, *args, **kwargs):
@@ -659,7 +1114,7 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
             node.set_func_def = self.modify(node.set_func_def, parent_function=None, function_params=[], parent_families=[], add_name_prefix=False)
 
         # add property to list
-        properties.add(node.name.identifier)
+        self.context.properties.add(node.name.identifier)
         return []
 
     def modifyFunctionDef(self, node, parent_function=None, function_params=None, parent_families=None, add_name_prefix=True):
@@ -683,14 +1138,14 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
             node.name = self.modify(node.name, parent_function=node, function_params=params, parent_families=parent_families)
 
         # add function to table of available functions
-        if node.name.identifier in functions and not node.override:
+        if node.name.identifier in self.context.functions and not node.override:
             # if this function is overriden
-            if functions[node.name.identifier].override:
+            if self.context.functions[node.name.identifier].override:
                 node.lines = []  # clear the lines so we don't accidentally introduce some performance cost by handling these later
             else:
                 raise ksp_ast.ParseException(node, 'Function already declared')
         else:
-            functions[node.name.identifier] = node
+            self.context.functions[node.name.identifier] = node
 
         # modify the body of the function
         node.lines = flatten([self.modify(l, parent_function=node, function_params=params, parent_families=parent_families) for l in node.lines])
@@ -708,7 +1163,7 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
 
         # add family name to the table of all used families
         global_family_name = '.'.join(parent_families + [node.name.identifier])
-        families.add(global_family_name)
+        self.context.families.add(global_family_name)
 
         # then modify statements and pass along information to nodes further down the tree of the chain of family definitions so far
         node.statements = flatten([self.modify(n, parent_function=parent_function,
@@ -720,10 +1175,10 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
         is_ui_declaration = any([m for m in modifiers if m.startswith('ui_')])
 
         # add variable to list of variables
-        variables.add(global_varname.lower())
+        self.context.variables.add(global_varname.lower())
 
         if is_ui_declaration:
-            ui_variables.add(global_varname.lower())
+            self.context.ui_variables.add(global_varname.lower())
 
     def handleLocalDeclaration(self, node, func):
         ''' Handle variable declaration made inside the function node given as parameter.
@@ -774,7 +1229,7 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
                 # change name of variable to be a combination of the function name and the declared name (and make sure it's unique)
                 global_varname = '%s_%s' % (node.variable.prefix, local_varname)
                 i = 2
-                while global_varname.lower() in variables:
+                while global_varname.lower() in self.context.variables:
                     global_varname = '%s_%s%d' % (node.variable.prefix, local_varname, i)
                     i += 1
 
@@ -827,6 +1282,10 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
             lines = self.handleLocalDeclaration(node, kwargs['parent_function'])
             lines = flatten([self.modify(n, *args, **kwargs) for n in lines])
             return lines
+        elif node.ui_array_size is not None:
+            for vname in node.get_ui_array_names():
+                self.add_global_var(vname, node.modifiers)
+            return [node]
         else:
             vname = node.variable.prefix + node.variable.identifier.lower()
             self.add_global_var(vname, node.modifiers)
@@ -873,8 +1332,8 @@ class ASTModifierFixReferencesAndFamilies(ASTModifierBase):
         return id
 
 class ASTModifierFixPrefixes(ASTModifierBase):
-    def __init__(self, ast):
-        ASTModifierBase.__init__(self, modify_expressions=True)
+    def __init__(self, ast, context):
+        ASTModifierBase.__init__(self, modify_expressions=True, context=context)
         self.traverse(ast)
 
     def modifyFunctionDef(self, node, parent_function=None, parent_varref=None):
@@ -889,14 +1348,14 @@ class ASTModifierFixPrefixes(ASTModifierBase):
         first_part = name.split('.')[0]
 
         # if prefix is missing and this is not a function or family and does not start with a function parameter (eg. if a parameter is passed as param and then referenced as param__member)
-        if node.prefix == '' and not (name in functions or
+        if node.prefix == '' and not (name in self.context.functions or
                                       name in ksp_builtins.functions or
-                                      name in families or
-                                      name in properties or
+                                      name in self.context.families or
+                                      name in self.context.properties or
                                       (parent_function and (first_part in parent_function.parameters or
                                                             parent_function.return_value and first_part == parent_function.return_value.identifier))):
             possible_prefixes = [prefix for prefix in '$%@!?~'
-                                 if prefix + name.lower() in variables or prefix + name in ksp_builtins.variables]
+                                 if prefix + name.lower() in self.context.variables or prefix + name in ksp_builtins.variables]
 
             # if there is a subscript then only array types are possible
             if parent_varref and parent_varref.subscripts:
@@ -909,14 +1368,14 @@ class ASTModifierFixPrefixes(ASTModifierBase):
             node.prefix = possible_prefixes[0]
             return node
 
-        elif node.prefix and not (name.lower() in variables or name in ksp_builtins.variables):
+        elif node.prefix and not (name.lower() in self.context.variables or name in ksp_builtins.variables):
             raise ksp_ast.ParseException(node, "%s has not been declared." % name)
         else:
             return node
 
 class ASTModifierFixPrefixesIncludingLocalVars(ASTModifierFixPrefixes):
-    def __init__(self, ast):
-        ASTModifierFixPrefixes.__init__(self, ast)
+    def __init__(self, ast, context):
+        ASTModifierFixPrefixes.__init__(self, ast, context)
 
     def modifyFunctionDef(self, node, parent_function=None):
         # pass along a reference to what function we're currently inside
@@ -938,6 +1397,12 @@ class ASTModifierIDSubstituter(ASTModifierBase):
         self.force_lower_case = force_lower_case
         ASTModifierBase.__init__(self, modify_expressions=True)
 
+    def modifyDeclareStmt(self, node, *args, **kwargs):
+        # the new names of the controls of a UI array need not follow the pattern of the old ones, so declare them one by one
+        if node.ui_array_size is not None:
+            return flatten([self.modify(n, *args, **kwargs) for n in node.expand_ui_array()])
+        return ASTModifierBase.modifyDeclareStmt(self, node, *args, **kwargs)
+
     def modifyID(self, node, *args, **kwargs):
         ''' Translate identifiers according to the translation table '''
 
@@ -1059,8 +1524,8 @@ class ASTModifierNameFixer(ASTModifierBase):
 
 
 class ASTModifierFunctionExpander(ASTModifierBase):
-    def __init__(self, ast):
-        ASTModifierBase.__init__(self, modify_expressions=True)
+    def __init__(self, ast, context):
+        ASTModifierBase.__init__(self, modify_expressions=True, context=context)
         self.traverse(ast, parent_toplevel=None, function_stack=[])
 
     def modifyModule(self, node, *args, **kwargs):
@@ -1101,9 +1566,9 @@ class ASTModifierFunctionExpander(ASTModifierBase):
         ''' Convert a property reference like myprop to a function call like myprop.get() '''
         assert(isinstance(node, ksp_ast.VarRef))
         func_name = '%s.get' % node.identifier.identifier
-        if func_name not in functions:
+        if func_name not in self.context.functions:
             raise ksp_ast.ParseException(node, 'The property %s has no get-function and can therefore not be written to.' % str(node.identifier.identifier))
-        get_function = functions[func_name]
+        get_function = self.context.functions[func_name]
 
         # if there is a subscript, pass it as a parameter to the get function
         parameters = node.subscripts[:]
@@ -1112,7 +1577,7 @@ class ASTModifierFunctionExpander(ASTModifierBase):
 
     def modifyVarRef(self, node, *args, **kwargs):
         ''' If the varref is a property, then convert it to a call to the get-function of the property '''
-        if node.identifier.identifier in properties:
+        if node.identifier.identifier in self.context.properties:
             return self.modifyFunctionCall(self.convert_property_access_to_function_call(node),
                                            *args, **kwargs)
         else:
@@ -1131,11 +1596,11 @@ class ASTModifierFunctionExpander(ASTModifierBase):
             raise ksp_ast.ParseException(node, 'The left hand side of the assignment needs to be a variable reference.')
 
         # if this is a property assignment, eg. myproperty := 5, convert it to a function call, eg. myproperty.set(5)
-        if node.varref.identifier.identifier in properties:
+        if node.varref.identifier.identifier in self.context.properties:
             func_name = '%s.set' % node.varref.identifier.identifier
-            if func_name not in functions:
+            if func_name not in self.context.functions:
                 raise ksp_ast.ParseException(node.varref, 'The property %s has no set-function and is therefore read-only.' % str(node.varref.identifier.identifier))
-            set_function = functions[func_name]
+            set_function = self.context.functions[func_name]
             parameters = node.varref.subscripts + [node.expression]
             function_call = ksp_ast.FunctionCall(node.lexinfo, set_function.name, parameters, is_procedure=True)
             return self.modifyFunctionCall(function_call,
@@ -1145,7 +1610,7 @@ class ASTModifierFunctionExpander(ASTModifierBase):
         expression = node.expression
 
         # if the right-hand-side is a property access, convert it to a function call to the get-function of the property
-        if isinstance(expression, ksp_ast.VarRef) and expression.identifier.identifier in properties:
+        if isinstance(expression, ksp_ast.VarRef) and expression.identifier.identifier in self.context.properties:
             expression = self.convert_property_access_to_function_call(node.expression)
 
         # if the right-hand-side is function call
@@ -1205,12 +1670,12 @@ class ASTModifierFunctionExpander(ASTModifierBase):
 
         function_name = node.function_name.identifier
         if function_name not in ksp_builtins.functions:  # and not (isinstance(parent_toplevel, ksp_ast.FunctionCall) and function_name in parent_toplevel.locals_name_subst_dict):
-            if function_name not in functions:
+            if function_name not in self.context.functions:
                 raise ksp_ast.ParseException(node.function_name, "Unknown function: %s" % function_name)
-            call_graph[parent_function_name].append(function_name)  # enter a link from the caller to the callee in the call graph
-            call_graph[function_name] = call_graph[function_name]   # add target node if it doesn't already exist
+            self.context.call_graph[parent_function_name].append(function_name)  # enter a link from the caller to the callee in the call graph
+            self.context.call_graph[function_name] = self.context.call_graph[function_name]   # add target node if it doesn't already exist
             if node.using_call_keyword:
-                called_functions.add(function_name)
+                self.context.called_functions.add(function_name)
 
     def getTaskFuncCallPrologueAndEpilogue(self, node, func, assign_stmt_lhs):
         # if the function call is of the format "x := myfunc(...)" then treat it like myfunc(..., x), i.e. insert the left hand side of the assignment as the last parameter
@@ -1247,17 +1712,17 @@ class ASTModifierFunctionExpander(ASTModifierBase):
         # invocations of built-in functions are not checked at this compilation stage
         if function_name in ksp_builtins.functions and not node.using_call_keyword:
             if function_name == 'wait' and isinstance(parent_toplevel, ksp_ast.FunctionDef):
-                functions_invoking_wait.add(parent_toplevel.name.identifier)
+                self.context.functions_invoking_wait.add(parent_toplevel.name.identifier)
             return ASTModifierBase.modifyFunctionCall(self, node, parent_toplevel=parent_toplevel, function_stack=function_stack, assign_stmt_lhs=assign_stmt_lhs)
 
         # get a reference to the function node and run error checks
-        func = functions.get(function_name, None)
+        func = self.context.functions.get(function_name, None)
         is_inside_init_callback = isinstance(parent_toplevel, ksp_ast.Callback) and parent_toplevel.name == 'init'
         self.doFunctionCallChecks(node, function_name, func, is_inside_init_callback, function_stack, assign_stmt_lhs)
 
         # if function invoked from within a callback, mark it as used
         if isinstance(parent_toplevel, ksp_ast.Callback):
-            functions[function_name].used = True
+            self.context.functions[function_name].used = True
 
         # if it's a call to a taskfunc function
         if func.is_taskfunc:
@@ -1268,7 +1733,7 @@ class ASTModifierFunctionExpander(ASTModifierBase):
             node.parameters = []
             node.using_call_keyword = True
             node.is_procedure = True
-            called_functions.add(node.function_name.identifier)
+            self.context.called_functions.add(node.function_name.identifier)
 
         # if 'call' keyword is used
         elif node.using_call_keyword:
@@ -1291,8 +1756,8 @@ class ASTModifierFunctionExpander(ASTModifierBase):
             # also add the mapping from local variable names to their new globally unique counterpart
             name_subst_dict.update(func.locals_name_subst_dict)
 
-            # apply name substitutions to a copy of the function
-            func = ASTModifierVarRefSubstituter(name_subst_dict, inlining_function_node=node).modify(func.copy())
+            # apply name substitutions to a copy of the function body
+            func = ASTModifierVarRefSubstituter(name_subst_dict, inlining_function_node=node).modify(func.copy_body())
 
             # recursively modify each line in the function body and add them to the return value
             result = result + flatten([self.modify(line, parent_toplevel=parent_toplevel, function_stack=function_stack + [function_name]) for line in func.lines])
@@ -1307,8 +1772,8 @@ class ASTModifierFunctionExpander(ASTModifierBase):
         return result
 
 class ASTModifierTaskfuncFunctionHandler(ASTModifierBase):
-    def __init__(self, ast):
-        ASTModifierBase.__init__(self, modify_expressions=False)
+    def __init__(self, ast, context):
+        ASTModifierBase.__init__(self, modify_expressions=False, context=context)
         self.traverse(ast, parent_taskfunc_function=None)
 
     def modifyCallback(self, node, *args, **kwargs):
@@ -1348,11 +1813,11 @@ class ASTModifierTaskfuncFunctionHandler(ASTModifierBase):
         node.lines.insert(0, line0)
         node.lines.insert(1, line1)
         node.lines.insert(2, line2)
-        if 'TCM_DEBUG' in true_conditions:
+        if 'TCM_DEBUG' in self.context.true_conditions:
             line3 = FunctionCall(li, function_name=ID(li, 'check_full'), parameters=[], is_procedure=True, using_call_keyword=True)
             node.lines.insert(3, line3)
-            call_graph[node.name.identifier].append('check_full')
-            called_functions.add('check_full')
+            self.context.call_graph[node.name.identifier].append('check_full')
+            self.context.called_functions.add('check_full')
 
         # epilogue
         line0 = AssignStmt(li, VarRef(li, ID(li, '$sp')), VarRef(li, ID(li, '$fp')))
@@ -1368,8 +1833,8 @@ class ASTModifierTaskfuncFunctionHandler(ASTModifierBase):
         return func
 
 class ASTModifierFixPrefixesAndFixControlPars(ASTModifierFixPrefixes):
-    def __init__(self, ast):
-        ASTModifierFixPrefixes.__init__(self, ast)
+    def __init__(self, ast, context):
+        ASTModifierFixPrefixes.__init__(self, ast, context)
 
     def modifyVarRef(self, node, *args, **kwargs):
         ''' Check that there is not more than one subscript '''
@@ -1389,7 +1854,7 @@ class ASTModifierFixPrefixesAndFixControlPars(ASTModifierFixPrefixes):
         # if it's a builtin function that sets or gets a control par and the first parameter is not an integer ID, but rather a UI variable
         if function_name in ksp_builtins.functions and not node.using_call_keyword and \
            (function_name.startswith('set_control_par') or function_name.startswith('get_control_par')) and \
-           len(node.parameters) > 0 and isinstance(node.parameters[0], ksp_ast.VarRef) and str(node.parameters[0].identifier).lower() in ui_variables:
+           len(node.parameters) > 0 and isinstance(node.parameters[0], ksp_ast.VarRef) and str(node.parameters[0].identifier).lower() in self.context.ui_variables:
 
             # then wrap the UI variable in a get_ui_id call, eg. myknob is converted into get_ui_id(myknob)
             func_call_inner = ksp_ast.FunctionCall(node.lexinfo, ksp_ast.ID(node.parameters[0].lexinfo, 'get_ui_id'), [node.parameters[0]], is_procedure=False)
@@ -1400,7 +1865,7 @@ class ASTModifierFixPrefixesAndFixControlPars(ASTModifierFixPrefixes):
         else:
             return node
 
-def mark_used_functions_using_depth_first_traversal(call_graph, start_node=None, visited=None):
+def mark_used_functions_using_depth_first_traversal(call_graph, functions, start_node=None, visited=None):
     ''' Make a depth-first traversal of call graph and set the used attribute of functions invoked directly or indirectly from some callback.
         The graph is represented by a dictionary where graph[f1] == f1 means that the function with name f1 calls the function with name f2 (the names are strings).'''
     if visited is None:
@@ -1416,7 +1881,7 @@ def mark_used_functions_using_depth_first_traversal(call_graph, start_node=None,
             nodes_to_visit = set([x for x in call_graph[start_node] if x is not None])
 
     for n in nodes_to_visit:
-        mark_used_functions_using_depth_first_traversal(call_graph, n, visited)
+        mark_used_functions_using_depth_first_traversal(call_graph, functions, n, visited)
 
 def find_node(start_node, search_node, visited=None, path=None):
     if visited is None:
@@ -1546,7 +2011,7 @@ def parse_nckp(path):
     for i,p in enumerate(ui_controls_names):
         yield cur_prefix[i]+p
 
-def open_nckp(lines, basedir):
+def open_nckp(lines, basedir, context):
     source = merge_lines(lines) # for checking purposes
     nckp_path = '' # predeclared to avoid errors if the import_nckp ksp function is not used
     ui_to_import = []
@@ -1555,7 +2020,7 @@ def open_nckp(lines, basedir):
         if 'import_nckp' in line:
             if 'load_performance_view' in source:
                 if 'make_perfview' in source:
-                    raise ParseException(Line(line, [(None, index + 1)], None), 'If \'load_performance_view\' is used \'make_perfview\' is not necessary, please remove it!\n')
+                    raise ParseException(Line(line, Location(None, index + 1), None), 'If \'load_performance_view\' is used \'make_perfview\' is not necessary, please remove it!\n')
 
                 nckp_path = line[line.find('(')+1:line.find(')')][1:-1]
                 if nckp_path:
@@ -1568,20 +2033,20 @@ def open_nckp(lines, basedir):
                         ui_to_import = list(parse_nckp(nckp_path))
 
                         for i,v in enumerate(ui_to_import):
-                            variables.add(v.lower())
-                            ui_variables.add(v.lower())
-                            comp_extras.add_nckp_var_to_nckp_table(v)
+                            context.variables.add(v.lower())
+                            context.ui_variables.add(v.lower())
+                            context.add_nckp_var_to_nckp_table(v)
 
                             # Support the use of '.' variables in the compiler to reference controls with double underscores
-                            variables.add(v.lower().replace('__', '.'))
-                            ui_variables.add(v.lower().replace('__', '.'))
-                            comp_extras.add_nckp_var_to_nckp_table(v.replace('__', '.'))
+                            context.variables.add(v.lower().replace('__', '.'))
+                            context.ui_variables.add(v.lower().replace('__', '.'))
+                            context.add_nckp_var_to_nckp_table(v.replace('__', '.'))
 
                     else:
-                        raise ParseException(Line(line, [(None, index + 1)], None), '.nkcp file not found at: <' + os.path.abspath(nckp_path) + '> !\n')
+                        raise ParseException(Line(line, Location(None, index + 1), None), '.nkcp file not found at: <' + os.path.abspath(nckp_path) + '> !\n')
 
             else:
-                raise ParseException(Line(line, [(None, index + 1)], None), 'import_nckp used but no load_performance_view found in the script!\n')                
+                raise ParseException(Line(line, Location(None, index + 1), None), 'import_nckp used but no load_performance_view found in the script!\n')                
 
     return bool(ui_to_import)
 
@@ -1592,8 +2057,47 @@ def strip_import_nckp_function_from_source(lines):
         if 'import_nckp' in ls_line:
             line_obj.command = re.sub(r'[^\r\n]', '', ls_line)
 
+def count_ast_nodes(node):
+    ''' returns the number of AST nodes in the tree rooted at node '''
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(child for child in node.get_childnodes() or [] if isinstance(child, ksp_ast.ASTNode))
+    return count
+
+class TaskProfile(object):
+    ''' the resources used by one task of KSPCompiler.compile (only recorded when profiling is turned on) '''
+    def __init__(self, desc, wall_time, cpu_time, memory_peak=None, num_lines=None, num_nodes=None):
+        self.desc = desc
+        self.wall_time = wall_time       # seconds
+        self.cpu_time = cpu_time         # seconds
+        self.memory_peak = memory_peak   # peak number of bytes allocated during the task (only if tracemalloc was used)
+        self.num_lines = num_lines       # number of lines after the task
+        self.num_nodes = num_nodes       # number of AST nodes after the task (None before the code has been parsed)
+
+    def as_dict(self):
+        return OrderedDict([('task', self.desc), ('wall_time', self.wall_time), ('cpu_time', self.cpu_time),
+                            ('memory_peak', self.memory_peak), ('lines', self.num_lines), ('nodes', self.num_nodes)])
+
+def format_profile(profile, as_json=False):
+    ''' returns the list of TaskProfile objects recorded by KSPCompiler.compile either as JSON or as a table '''
+    if as_json:
+        return json.dumps([task.as_dict() for task in profile], indent=2)
+    total_wall = sum(task.wall_time for task in profile) or 1.0
+    optional = lambda fmt, value: fmt % value if value is not None else '-'
+    lines = ['%-30s %10s %6s %10s %13s %8s %8s' % ('Task', 'Wall (ms)', '%', 'CPU (ms)', 'Peak mem (KB)', 'Lines', 'Nodes')]
+    lines.append('-' * len(lines[0]))
+    for task in profile:
+        memory_peak = task.memory_peak / 1024.0 if task.memory_peak is not None else None
+        lines.append('%-30s %10.2f %6.1f %10.2f %13s %8s %8s' % (task.desc, task.wall_time * 1000, 100 * task.wall_time / total_wall, task.cpu_time * 1000,
+                                                                optional('%.1f', memory_peak), optional('%d', task.num_lines), optional('%d', task.num_nodes)))
+    lines.append('%-30s %10.2f %6.1f %10.2f' % ('total', total_wall * 1000, 100.0, sum(task.cpu_time for task in profile) * 1000))
+    return '\n'.join(lines)
+
 class KSPCompiler(object):
-    def __init__(self, source, basedir, compact=True, compactVars=False, comments_on_expansion=True, read_file_func=default_read_file_func, extra_syntax_checks=False, optimize=False, check_empty_compound_statements=False, add_compiled_date_comment=False):
+    def __init__(self, source, basedir, compact=True, compactVars=False, comments_on_expansion=True, read_file_func=default_read_file_func, extra_syntax_checks=False, optimize=False, check_empty_compound_statements=False, add_compiled_date_comment=False, import_cache=None, profile=False, profile_memory=False, parse_cache=None):
         self.source = source
         self.basedir = basedir
         self.compact = compact
@@ -1604,6 +2108,12 @@ class KSPCompiler(object):
         self.check_empty_compound_statements = check_empty_compound_statements
         self.add_compiled_date_comment = add_compiled_date_comment
         self.extra_syntax_checks = extra_syntax_checks or optimize
+        self.import_cache = import_cache   # an optional ImportCache instance shared between compilations
+        self.parse_cache = parse_cache     # an optional ParseCache instance shared between compilations
+        self.profile = profile or profile_memory
+        self.profile_memory = profile_memory   # also measure the peak memory use of each task using tracemalloc (slows down compilation)
+        self.profile_results = []              # list of TaskProfile objects, filled in by compile() if profiling is turned on
+        self.progress = 0                      # the percent done passed to the callback of compile() for the current task
         self.abort_requested = False
 
         self.lines = []
@@ -1614,15 +2124,22 @@ class KSPCompiler(object):
         self.short2original = {}
 
         self.output_file = None
+        self.compiled_code = None
         self.variable_names_to_preserve = set()
+        self.context = CompilationContext()
 
-    def do_imports_and_convert_to_line_objects(self):
+    def do_imports_and_convert_to_line_objects(self, callback=None):
         # Import files
-        self.lines = parse_lines_and_handle_imports(self.source,
+        if self.import_cache is not None:
+            self.import_cache.reset_statistics()
+        self.lines = parse_lines_and_handle_imports(self.source, self.context.placeholders,
                                                     read_file_function=self.read_file_func,
-                                                    preprocessor_func=self.examine_pragmas)
+                                                    preprocessor_func=self.examine_pragmas,
+                                                    import_cache=self.import_cache)
+        if self.import_cache is not None and callback:
+            callback('import cache: %d hit(s), %d miss(es)' % (self.import_cache.hits, self.import_cache.misses), self.progress)
 
-        handle_conditional_lines(self.lines) # Parse conditionals and remove lines if appropriate
+        handle_conditional_lines(self.lines, self.context.true_conditions) # Parse conditionals and remove lines if appropriate
 
     # PAST THIS FUNCTION, ALL IMPORTED AND UPDATED CODE LIVES IN SELF.LINES, NOT SOURCE. DO NOT ATTEMPT TO REPRODUCE LINE OBJECTS FROM SOURCE
     # TO PRESERVE LINE PROPERTIES, SELF.LINES CAN NOT BE REMERGED INTO SOURCE
@@ -1630,7 +2147,7 @@ class KSPCompiler(object):
     def extensions_with_macros(self):
         check_lines = [copy.copy(l) for l in self.lines]
         for line in check_lines:
-            line.replace_placeholders()
+            line.replace_placeholders(self.context.placeholders)
 
         check_source = merge_lines(check_lines) # only for checking purposes, not for reproducing lines
 
@@ -1638,7 +2155,7 @@ class KSPCompiler(object):
 
         # Add tcm code if tcm.init() is found
         if re.search(r'(?m)^\s*tcm.init', check_source):
-            self.lines += parse_lines_and_handle_imports(taskfunc_code,
+            self.lines += parse_lines_and_handle_imports(taskfunc_code, self.context.placeholders,
                                             read_file_function=self.read_file_func,
                                             preprocessor_func=self.examine_pragmas)
 
@@ -1653,7 +2170,7 @@ class KSPCompiler(object):
             activate_line = re.sub(new_comment_re, '', activate_line)
             filepath_m = re.search(r"(\"|\').*(\"|\')", str(activate_line))
             if not filepath_m:
-                raise ParseException(Line("", [(None, 1)], None), 'No filepath in activate_logger.\n')
+                raise ParseException(Line("", Location(None, 1), None), 'No filepath in activate_logger.\n')
             filepath_m_string = filepath_m.group(0)
             quote_type_str = filepath_m_string[0]
             filepath = filepath_m.group(0)[1:-1]
@@ -1669,7 +2186,7 @@ class KSPCompiler(object):
                 new_logger_str = "logger_filepath := filepath & %slogger.nka%s" % (quote_type_str, quote_type_str)
                 amended_logger_code = amended_logger_code.replace("#name#", "logger").replace("logger_filepath := filepath", new_logger_str)
             if valid_file_path_flag == False:
-                raise ParseException(Line("", [(None, 1)], None), 'Filepath of activate_logger is invalid.\nFilepaths must be in this format: "C:/Users/Name/LogFile.nka" or "/Users/Name/LogFile.nka"')
+                raise ParseException(Line("", Location(None, 1), None), 'Filepath of activate_logger is invalid.\nFilepaths must be in this format: "C:/Users/Name/LogFile.nka" or "/Users/Name/LogFile.nka"')
 
             # A persistance_changed callback function needs to be inserted if the script has one.
             # Insert *directly* into self.lines if there is, or just add it to the new source block if there isn't.
@@ -1689,39 +2206,34 @@ class KSPCompiler(object):
                         pccb_end = i
                         break
 
-                insert_function_line_obj = parse_lines_and_handle_imports("checkPrintFlag()",
+                insert_function_line_obj = parse_lines_and_handle_imports("checkPrintFlag()", self.context.placeholders,
                                                     read_file_function=self.read_file_func,
                                                     preprocessor_func=self.examine_pragmas)
 
-                replace_lines = collections.deque([])
-                for i in range(0, len(self.lines)):
-                    if i == pccb_end:
-                        replace_lines.append(insert_function_line_obj[0])
-                    replace_lines.append(self.lines[i])
-
-                self.lines = replace_lines
+                if pccb_end != -1:
+                    self.lines.splice(pccb_end, pccb_end, insert_function_line_obj[:1])
             else:
                 # if there is no persistence_changed callback then generate one
                 amended_logger_code = amended_logger_code + "\non persistence_changed\ncheckPrintFlag()\nend on\n"
 
-            self.lines += parse_lines_and_handle_imports(amended_logger_code,
+            self.lines += parse_lines_and_handle_imports(amended_logger_code, self.context.placeholders,
                                                     read_file_function=self.read_file_func,
                                                     preprocessor_func=self.examine_pragmas)
         ###
 
         # Run conditional stage a second time to catch the new source additions.
-        handle_conditional_lines(self.lines)
+        handle_conditional_lines(self.lines, self.context.true_conditions)
 
     def search_for_nckp(self):
         # Import nckp if import_nckp() found
-        if open_nckp(self.lines, self.basedir):
+        if open_nckp(self.lines, self.basedir, self.context):
             strip_import_nckp_function_from_source(self.lines)
 
         ###
 
     def replace_string_placeholders(self):
         for line in self.lines:
-            line.replace_placeholders()
+            line.replace_placeholders(self.context.placeholders)
 
     # NOTE(Sam): Previously done in the expand_macros function, the lines are converted into a block in separately
     # because the preprocessor needs to be called after the macros and before this.
@@ -1734,14 +2246,9 @@ class KSPCompiler(object):
 
     # Run stored macros on the code
     def expand_macros(self):
-        # Initial Expansion
-        normal_lines, callback_lines = expand_macros(self.lines, self.macros)
-        self.lines = normal_lines + callback_lines
-
-        # Nested Expansion
-        while macro_iter_functions(self.lines):
-            normal_lines, callback_lines = expand_macros(self.lines, self.macros)
-            self.lines = normal_lines + callback_lines
+        # iterate_macro/literate_macro lines are unrolled by expand_macros once the macro invocations around them have been expanded
+        normal_lines, callback_lines = expand_macros(self.lines, self.macros, self.context.placeholders, iteration_handlers=macro_iteration_handlers())
+        self.lines = LineBuffer(normal_lines + callback_lines)
 
     def examine_pragmas(self, code, namespaces):
         # find info about output file
@@ -1773,22 +2280,28 @@ class KSPCompiler(object):
                 self.variable_names_to_preserve.add(variable_name_pattern)
         return code
 
-    def parse_code(self):
-        self.module = parse(self.code)
+    def parse_code(self, callback=None):
+        if self.parse_cache is None:
+            self.module = parse(self.code)
+            return
+        self.parse_cache.reset_statistics()
+        self.module = self.parse_cache.parse(self.code)
+        if callback:
+            callback('parse cache: %d hit(s), %d miss(es)' % (self.parse_cache.hits, self.parse_cache.misses), self.progress)
 
     def sort_functions_and_insert_local_variables_into_on_init(self):
         # make sure that used function that uses others set the used flag of those secondary ones as well
         used_functions = set()
 
-        mark_used_functions_using_depth_first_traversal(call_graph, visited=used_functions)
+        mark_used_functions_using_depth_first_traversal(self.context.call_graph, self.context.functions, visited=used_functions)
 
         # check that there is no recursion among functions invoked using 'call'
-        find_cycles(call_graph)
+        find_cycles(self.context.call_graph)
 
         # make a topological sorting of the call graph filter out the functions invoked using 'call'
         function_definition_order = [function_name
-                                     for function_name in reversed(topological_sort(call_graph))
-                                     if function_name in called_functions and function_name in used_functions]
+                                     for function_name in reversed(topological_sort(self.context.call_graph))
+                                     if function_name in self.context.called_functions and function_name in used_functions]
 
         # create a lookup table from function name to function definition, remove all function definitions and then add the ones used back in the right order (as determined by the topological sorting)
         function_table = dict([(func.name.identifier, func) for func in self.module.blocks if isinstance(func, ksp_ast.FunctionDef)])
@@ -1796,14 +2309,13 @@ class KSPCompiler(object):
         self.module.blocks = [self.module.on_init] + [function_table[func_name] for func_name in function_definition_order] + self.module.blocks[1:]
 
         # add local variable declarations to 'on init' in case they have not already been inserted (they could have been inserted earlier if the function was invoked from the init callback)
-        for f in reversed(list(functions.values())):
+        for f in reversed(list(self.context.functions.values())):
             if f.used and (f.global_declaration_statements or f.local_declaration_statements):
                 self.module.on_init.lines = f.global_declaration_statements + self.module.on_init.lines + f.local_declaration_statements
                 f.global_declaration_statements = []
                 f.local_declaration_statements = []
 
     def convert_dots_to_double_underscore(self):
-        global variables
         # convert all dots into '__' (and update the list of variables accordingly)
         # Note: for historical reasons the ksp_compiler_extras functions assume
         # pure KSP as input and therefor cannot handle '.' in names.
@@ -1811,15 +2323,13 @@ class KSPCompiler(object):
         # updated the AST
         name_fixer = ASTModifierNameFixer(self.module)
         # updated the global list of variables similarly
-        variables = set(name_fixer.replace_dots_in_name(v) for v in variables)
+        self.context.variables = set(name_fixer.replace_dots_in_name(v) for v in self.context.variables)
 
     def compact_names(self):
-        global variables
-
         # build regular expression that can later tell which names to preserve (these should not undergo compaction)
         preserve_pattern = re.compile(r'[$%@!?~]?(' + '|'.join(self.variable_names_to_preserve) + ')$', re.I)
 
-        for v in variables:
+        for v in self.context.variables:
             if self.variable_names_to_preserve and preserve_pattern.match(v):
                 #self.original2short[v] = v
                 #self.short2original[v] = v
@@ -1834,7 +2344,7 @@ class KSPCompiler(object):
         ASTModifierIDSubstituter(self.original2short, force_lower_case=True).modify(self.module)
 
     def init_extra_syntax_checks(self):
-        comp_extras.clear_symbol_table()
+        self.context.clear_symbol_table()
         self.used_variables = set()
 
     def generate_compiled_code(self):
@@ -1858,8 +2368,9 @@ class KSPCompiler(object):
         return varname_re.sub(sub_func, compiled_code)
 
     def compile(self, callback=None):
-        global variables
-        init_globals()
+        self.context = CompilationContext()
+        self.compiled_code = None
+        self.module = None
         try:
             used_functions = set()
             used_variables = set()
@@ -1867,55 +2378,74 @@ class KSPCompiler(object):
             do_extra = self.extra_syntax_checks
             do_optim = do_extra and self.optimize
             do_emptycheck = self.check_empty_compound_statements and not do_optim
+            # the time-weights are rough constants for the relative time used by each task, they are only used for the progress
+            # percentage passed to the callback
             #     (description,                  function,                                                                    condition, time-weight)
             tasks = [
-                 ('scanning and importing code', lambda: self.do_imports_and_convert_to_line_objects(),                       True,      1),
-                 ('extensions (w/ macros)',      lambda: self.extensions_with_macros(),                                       True,      1),
+                 ('scanning and importing code', lambda: self.do_imports_and_convert_to_line_objects(callback),               True,     12),
+                 ('extensions (w/ macros)',      lambda: self.extensions_with_macros(),                                       True,      8),
                  # NOTE(Sam): Call the pre-macro section of the preprocessor
-                 ('pre-macro processes',         lambda: pre_macro_functions(self.lines),                                     True,      1),
+                 ('pre-macro processes',         lambda: pre_macro_functions(self.lines),                                     True,     13),
                  ('parsing macros',              lambda: self.extract_macros(),                                               True,      1),
-                 ('expanding macros',            lambda: self.expand_macros(),                                                True,      1),
+                 ('expanding macros',            lambda: self.expand_macros(),                                                True,     22),
                  # NOTE(Sam): Call the post-macro section of the preprocessor
-                 ('post-macro processes',        lambda: post_macro_functions(self.lines),                                    True,      1),
-                 ('replace string placeholders', lambda: self.replace_string_placeholders(),                                  True,      1),
-                 ('search for nckp import',      lambda: self.search_for_nckp(),                                              True,      1),
+                 ('post-macro processes',        lambda: post_macro_functions(self.lines),                                    True,     26),
+                 ('replace string placeholders', lambda: self.replace_string_placeholders(),                                  True,      3),
+                 ('search for nckp import',      lambda: self.search_for_nckp(),                                              True,      0),
                  # NOTE(Sam): Convert the lines to a block in a separate function
-                 ('convert lines to code block', lambda: self.convert_lines_to_code(),                                        True,      1),
-                 ('parse code',                  lambda: self.parse_code(),                                                   True,      1),
-                 ('various tasks',               lambda: ASTModifierFixReferencesAndFamilies(self.module, self.lines),        True,      1),
-                 ('add variable name prefixes',  lambda: ASTModifierFixPrefixesIncludingLocalVars(self.module),               True,      1),
-                 ('inline functions',            lambda: ASTModifierFunctionExpander(self.module),                            True,      1),
-                 ('handle taskfunc',             lambda: ASTModifierTaskfuncFunctionHandler(self.module),                     True,      1),
+                 ('convert lines to code block', lambda: self.convert_lines_to_code(),                                        True,      0),
+                 ('parse code',                  lambda: self.parse_code(callback),                                           True,    120),
+                 ('various tasks',               lambda: ASTModifierFixReferencesAndFamilies(self.module, self.lines, self.context), True, 34),
+                 ('add variable name prefixes',  lambda: ASTModifierFixPrefixesIncludingLocalVars(self.module, self.context), True,     27),
+                 ('inline functions',            lambda: ASTModifierFunctionExpander(self.module, self.context),              True,    329),
+                 ('handle taskfunc',             lambda: ASTModifierTaskfuncFunctionHandler(self.module, self.context),       True,      0),
                  ('handle local variables',      lambda: self.sort_functions_and_insert_local_variables_into_on_init(),       True,      1),
-                 ('add variable name prefixes',  lambda: ASTModifierFixPrefixesAndFixControlPars(self.module),                True,      1),
-                 ('convert dots to underscore',  lambda: self.convert_dots_to_double_underscore(),                            True,      1),
-                 ('init extra syntax checks',    lambda: self.init_extra_syntax_checks(),                                     do_extra,  1),
-                 ('check types',                 lambda: comp_extras.ASTVisitorDetermineExpressionTypes(self.module),         do_extra,  1),
-                 ('check types',                 lambda: comp_extras.ASTVisitorCheckStatementExprTypes(self.module),          do_extra,  1),
-                 ('check declarations',          lambda: comp_extras.ASTVisitorCheckDeclarations(self.module),                do_extra,  1),
-                 ('simplying expressions',       lambda: comp_extras.ASTModifierSimplifyExpressions(self.module, True),       do_optim,  1),
-                 ('removing unused branches',    lambda: comp_extras.ASTModifierRemoveUnusedBranches(self.module),            do_optim,  1),
-                 ('removing unused functions',   lambda: comp_extras.ASTVisitorFindUsedFunctions(self.module, used_functions),      do_optim, 1),
-                 ('removing unused functions',   lambda: comp_extras.ASTModifierRemoveUnusedFunctions(self.module, used_functions), do_optim, 1),
-                 ('removing unused variables',   lambda: comp_extras.ASTVisitorFindUsedVariables(self.module, used_variables),      do_optim, 1),
-                 ('removing unused variables',   lambda: comp_extras.ASTModifierRemoveUnusedVariables(self.module, used_variables), do_optim, 1),
-                 ('checking empty if-stmts',     lambda: comp_extras.ASTVisitorCheckNoEmptyIfCaseStatements(self.module),     do_emptycheck, 1),
-                 ('compact variable names',      self.compact_names,                                                          self.compactVars, 1),
-                 ('generate code',               self.generate_compiled_code,                                                 True,      1),
+                 ('add variable name prefixes',  lambda: ASTModifierFixPrefixesAndFixControlPars(self.module, self.context),  True,     41),
+                 ('convert dots to underscore',  lambda: self.convert_dots_to_double_underscore(),                            True,     33),
+                 ('init extra syntax checks',    lambda: self.init_extra_syntax_checks(),                                     do_extra,  0),
+                 ('check types',                 lambda: comp_extras.ASTVisitorDetermineExpressionTypes(self.module),         do_extra, 40),
+                 ('check types',                 lambda: comp_extras.ASTVisitorCheckStatementExprTypes(self.module),          do_extra,  9),
+                 ('check declarations',          lambda: comp_extras.ASTVisitorCheckDeclarations(self.module, self.context),  do_extra, 37),
+                 ('simplying expressions',       lambda: comp_extras.ASTModifierSimplifyExpressions(self.module, self.context, True), do_optim, 62),
+                 ('removing unused branches',    lambda: comp_extras.ASTModifierRemoveUnusedBranches(self.module, self.context),   do_optim, 34),
+                 ('removing unused functions',   lambda: comp_extras.ASTVisitorFindUsedFunctions(self.module, used_functions),      do_optim, 7),
+                 ('removing unused functions',   lambda: comp_extras.ASTModifierRemoveUnusedFunctions(self.module, used_functions), do_optim, 0),
+                 ('removing unused variables',   lambda: comp_extras.ASTVisitorFindUsedVariables(self.module, used_variables),      do_optim, 29),
+                 ('removing unused variables',   lambda: comp_extras.ASTModifierRemoveUnusedVariables(self.module, used_variables), do_optim, 28),
+                 ('checking empty if-stmts',     lambda: comp_extras.ASTVisitorCheckNoEmptyIfCaseStatements(self.module),     do_emptycheck, 6),
+                 ('compact variable names',      self.compact_names,                                                          self.compactVars, 45),
+                 ('generate code',               self.generate_compiled_code,                                                 True,     38),
             ]
 
             # keep only tasks where the execution-condition is true
-            tasks = [(desc, func, time) for (desc, func, condition, time) in tasks if condition]
-
-            total_time = float(sum(t[-1] for t in tasks))
-            time_so_far = 0
-            for (desc, func, time) in tasks:
-                if callback:
-                    callback(desc, 100 * time_so_far/total_time) # parameters are: description, percent done
-                func()
-                time_so_far += time
-                if self.abort_requested:
-                    return False
+            tasks = [(desc, func, weight) for (desc, func, condition, weight) in tasks if condition]
+
+            self.profile_results = []
+            started_tracing = False
+            if self.profile_memory:
+                import tracemalloc
+                started_tracing = not tracemalloc.is_tracing()
+                if started_tracing:
+                    tracemalloc.start()
+            self.started_tracing = started_tracing
+
+            total_weight = float(sum(t[-1] for t in tasks))
+            weight_so_far = 0
+            try:
+                for (desc, func, weight) in tasks:
+                    self.progress = 100 * weight_so_far/total_weight
+                    if callback:
+                        callback(desc, self.progress) # parameters are: description, percent done
+                    if self.profile:
+                        self.run_profiled_task(desc, func)
+                    else:
+                        func()
+                    weight_so_far += weight
+                    if self.abort_requested:
+                        return False
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
             return True
         except ksp_ast.ParseException as e:
             #raise  # TEMPORARY
@@ -1930,14 +2460,125 @@ class KSPCompiler(object):
             message = '\n'.join(messages)
             raise ParseException(line, message)
 
+    def run_profiled_task(self, desc, func):
+        ''' runs one compilation task and appends a TaskProfile with the resources it used to self.profile_results '''
+        memory_peak = None
+        if self.profile_memory:
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            elif self.started_tracing:
+                # restarting the tracing resets the peak (tracemalloc.reset_peak is only available in Python 3.9+), but the
+                # traces of a caller which was already tracing mustn't be thrown away
+                tracemalloc.stop()
+                tracemalloc.start()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        if self.profile_memory:
+            # without reset_peak the peak of a caller's tracing may be from before the task, so this is only an upper bound then
+            memory_peak = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+        num_lines = len(self.compiled_code.split('\n')) if self.compiled_code is not None else len(self.lines)
+        num_nodes = count_ast_nodes(self.module) if self.module is not None else None
+        self.profile_results.append(TaskProfile(desc, wall_time, cpu_time, memory_peak, num_lines, num_nodes))
+
     def abort_compilation(self):
         self.abort_requested = True
 
+def make_read_file_func(basedir):
+    ''' returns a function for reading imported modules (relative paths are resolved against basedir) '''
+    def read_file_func(filepath):
+        if not os.path.isabs(filepath):
+            if basedir is None:
+                raise Exception('Relative import paths not supported when the base path of the source file is unknown')
+            else:
+                filepath = os.path.join(basedir, filepath)
+        return codecs.open(filepath, 'r', 'latin-1').read()
+    return read_file_func
+
+def compile_file(source_path, options, import_cache=None, output_path=None):
+    ''' compiles the file at source_path using the given KSPCompiler keyword arguments and writes the result to output_path,
+        or if that is not given to the file specified using the save_compiled_source pragma. Returns the path written to. '''
+    basedir = os.path.dirname(os.path.abspath(source_path))
+    with codecs.open(source_path, 'r', 'latin-1') as f:
+        code = f.read()
+    compiler = KSPCompiler(code, basedir, comments_on_expansion=False, read_file_func=make_read_file_func(basedir),
+                           check_empty_compound_statements=False, import_cache=import_cache, **options)
+    compiler.compile()
+    output_path = output_path or compiler.output_file
+    if not output_path:
+        raise Exception('No output file given (use the save_compiled_source pragma)')
+    with codecs.open(output_path, 'w', encoding='latin-1') as f:
+        f.write(compiler.compiled_code.replace('\r', ''))
+    return output_path
+
+# each worker process of a batch compilation keeps its own import cache so that library files are only parsed once per worker
+batch_import_cache = None
+
+def init_batch_worker(import_cache_dir):
+    global batch_import_cache
+    batch_import_cache = ImportCache(import_cache_dir)
+
+def batch_compile_file(job):
+    ''' compiles one file of a batch, returns a tuple (source_path, output_path, error message or None, seconds) '''
+    source_path, options = job
+    start_time = time.time()
+    output_path, error = None, None
+    try:
+        output_path = compile_file(source_path, options, batch_import_cache)
+    except ParseException as e:
+        error = e.message
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    return (source_path, output_path, error, time.time() - start_time)
+
+def find_batch_sources(patterns):
+    ''' expands a list of glob patterns and manifest files (text files listing one script path per line, relative to
+        the manifest, with # starting a comment) into a list of source file paths '''
+    source_paths = []
+    for pattern in patterns:
+        if os.path.isfile(pattern) and not pattern.lower().endswith('.ksp'):
+            manifest_dir = os.path.dirname(os.path.abspath(pattern))
+            with codecs.open(pattern, 'r', 'utf-8') as f:
+                entries = [line.split('#')[0].strip() for line in f]
+            source_paths.extend(find_batch_sources([os.path.join(manifest_dir, entry) for entry in entries if entry]))
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise Exception('No files matching: %s' % pattern)
+            source_paths.extend(matches)
+    # remove duplicates but keep the order
+    return list(OrderedDict.fromkeys(os.path.abspath(p) for p in source_paths))
+
+def batch_compile(source_paths, options, jobs=None, import_cache_dir=None, mp_context=None):
+    ''' compiles the given files in parallel using a pool of worker processes and returns a list of result tuples (see batch_compile_file),
+        mp_context is an optional multiprocessing context used to start the workers (e.g. multiprocessing.get_context('spawn')) '''
+    jobs = min(jobs or multiprocessing.cpu_count(), len(source_paths)) or 1
+    pool = (mp_context or multiprocessing).Pool(jobs, initializer=init_batch_worker, initargs=(import_cache_dir,))
+    try:
+        return pool.map(batch_compile_file, [(path, options) for path in source_paths], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def format_batch_summary(results):
+    ''' returns a table with the time used and the outcome of each compiled file '''
+    rows = [('Source file', 'Time (ms)', 'Result')]
+    for (source_path, output_path, error, seconds) in results:
+        rows.append((source_path, '%.0f' % (seconds * 1000), 'FAILED: %s' % error.strip().split('\n')[0] if error else output_path))
+    widths = [max(len(row[i]) for row in rows) for i in range(2)]
+    lines = ['%-*s  %*s  %s' % (widths[0], row[0], widths[1], row[1], row[2]) for row in rows]
+    lines.insert(1, '-' * max(len(l) for l in lines))
+    num_failed = len([r for r in results if r[2]])
+    total_time = sum(r[3] for r in results)
+    lines.append('%d file(s) compiled, %d failed, %.2f s total compile time' % (len(results) - num_failed, num_failed, total_time))
+    return '\n'.join(lines)
+
 if __name__ == "__main__":
     import sys
     import os
     import os.path
-    import codecs
     import argparse
 
     # definition of argsparse.FileType in Python 3.4 (with support for encoding) - in case we're running Python 3.3
@@ -1977,48 +2618,68 @@ if __name__ == "__main__":
 
     # parse command line arguments
     arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('--compact', dest='compact', action='store_true', default='false', help='Minimize whitespace in compiled code')
-    arg_parser.add_argument('--compact_variables', dest='compact_variables', action='store_true', default='false', help='Shorten and obfuscate variable names')
-    arg_parser.add_argument('--extra_syntax_checks', dest='extra_syntax_checks', action='store_true', default='false', help='Additional syntax checks')
-    arg_parser.add_argument('--optimize', dest='optimize', action='store_true', default='false', help='Optimize the generated code')
-    arg_parser.add_argument('--nocompiledate', dest='add_compiled_date_comment', action='store_true', default='true', help='Remove the compiler date argument')
-    arg_parser.add_argument('source_file', type=FileType('r', encoding='latin-1'))
+    arg_parser.add_argument('--compact', dest='compact', action='store_true', default=False, help='Minimize whitespace in compiled code')
+    arg_parser.add_argument('--compact_variables', dest='compact_variables', action='store_true', default=False, help='Shorten and obfuscate variable names')
+    arg_parser.add_argument('--extra_syntax_checks', dest='extra_syntax_checks', action='store_true', default=False, help='Additional syntax checks')
+    arg_parser.add_argument('--optimize', dest='optimize', action='store_true', default=False, help='Optimize the generated code')
+    arg_parser.add_argument('--nocompiledate', dest='add_compiled_date_comment', action='store_false', default=True, help='Remove the compiler date argument')
+    arg_parser.add_argument('--import_cache_dir', dest='import_cache_dir', default=None, help='Directory in which parsed imported files are cached between runs')
+    arg_parser.add_argument('--batch', dest='batch', nargs='+', metavar='MANIFEST_OR_GLOB', help='Compile many scripts in parallel. Each argument is a glob pattern or a manifest file listing one script per line. The output of each script is written to its save_compiled_source target')
+    arg_parser.add_argument('--profile', dest='profile', action='store_true', default=False, help='Print the time used by each compilation task to stderr')
+    arg_parser.add_argument('--profile_format', dest='profile_format', choices=['table', 'json'], default='table', help='Format of the --profile report (default: table)')
+    arg_parser.add_argument('--profile_memory', dest='profile_memory', action='store_true', default=False, help='Also measure the peak memory use of each compilation task when profiling (slower)')
+    arg_parser.add_argument('--jobs', dest='jobs', type=int, default=None, help='Number of worker processes used for --batch (default: number of CPUs)')
+    arg_parser.add_argument('--parse_jobs', dest='parse_jobs', type=int, default=None, help='Parse the top-level blocks of the script concurrently using this many worker processes')
+    arg_parser.add_argument('source_file', type=FileType('r', encoding='latin-1'), nargs='?')
     arg_parser.add_argument('output_file', type=FileType('w', encoding='latin-1'), nargs='?')
     args = arg_parser.parse_args()
 
+    # make sure that extra syntax checks are enabled if --optimize argument is used
+    if args.optimize == True and args.extra_syntax_checks == False:
+        args.extra_syntax_checks = True
+
+    if args.batch:
+        if args.source_file:
+            arg_parser.error('source_file cannot be used together with --batch')
+        options = dict(compact=args.compact, compactVars=args.compact_variables, extra_syntax_checks=args.extra_syntax_checks,
+                       optimize=args.optimize, add_compiled_date_comment=args.add_compiled_date_comment)
+        results = batch_compile(find_batch_sources(args.batch), options, args.jobs, args.import_cache_dir)
+        print(format_batch_summary(results))
+        sys.exit(1 if any(error for (source_path, output_path, error, seconds) in results) else 0)
+    elif not args.source_file:
+        arg_parser.error('either source_file or --batch is required')
+
     # determine the base directory of the source file
     if args.source_file.name != '<stdin>':
         basedir = os.path.dirname(args.source_file.name)
     else:
         basedir = None
 
-    # function for reading imported modules
-    def read_file_func(filepath):
-        if not os.path.isabs(filepath):
-            if basedir is None:
-                raise Exception('Relative import paths not supported when the base path of the source file is unknown')
-            else:
-                filepath = os.path.join(basedir, filepath)
-        return codecs.open(filepath, 'r', 'latin-1').read()
-
-    # make sure that extra syntax checks are enabled if --optimize argument is used
-    if args.optimize == True and args.extra_syntax_checks == False:
-        args.extra_syntax_checks = True
-        
     # read the source and compile it
     code = args.source_file.read()
+    parse_cache = ParseCache(jobs=args.parse_jobs) if args.parse_jobs and args.parse_jobs > 1 else None
     compiler = KSPCompiler(
         code,
         basedir,
         compact=args.compact,
         compactVars=args.compact_variables,
         comments_on_expansion=False,
-        read_file_func=read_file_func,
+        read_file_func=make_read_file_func(basedir),
         extra_syntax_checks=args.extra_syntax_checks,
         optimize=args.optimize,
         check_empty_compound_statements=False,
-        add_compiled_date_comment=(not args.nocompiledate))
-    compiler.compile()
+        add_compiled_date_comment=args.add_compiled_date_comment,
+        import_cache=ImportCache(args.import_cache_dir) if args.import_cache_dir else None,
+        profile=args.profile,
+        profile_memory=args.profile_memory,
+        parse_cache=parse_cache)
+    try:
+        compiler.compile()
+    finally:
+        if parse_cache is not None:
+            parse_cache.close()
+    if compiler.profile:
+        sys.stderr.write(format_profile(compiler.profile_results, as_json=(args.profile_format == 'json')) + '\n')
 
     # write the compiled code to output
     code = compiler.compiled_code.replace('\r', '')
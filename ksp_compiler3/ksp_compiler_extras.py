@@ -18,25 +18,12 @@ import ksp_builtins
 import re
 import math
 
-symbol_table = {}
-nckp_table = []
-user_defined_functions = {}
-key_ids = {}
-
 pgs_functions = set(['_pgs_create_key', '_pgs_key_exists', '_pgs_set_key_val', '_pgs_get_key_val',
                      'pgs_create_key',  'pgs_key_exists',  'pgs_set_key_val', 'pgs_get_key_val',
                      'pgs_create_str_key', 'pgs_str_key_exists', 'pgs_set_str_key_val', 'pgs_get_str_key_val'])
 
 mark_constant_re = re.compile(r'MARK_\d+')
 
-def clear_symbol_table():
-    symbol_table.clear()
-    key_ids.clear()
-    user_defined_functions.clear()
-
-def add_nckp_var_to_nckp_table(nckp_ui_variable):
-        nckp_table.append(nckp_ui_variable.lower())
-
 class ValueUndefinedException(ParseException):
     def __init__(self, node, msg='Value of variable undefined'):
         ParseException.__init__(self, node, msg)
@@ -85,10 +72,10 @@ def normalize_numeric(x):
     else:
         return x
 
-def evaluate_expression(expr):
+def evaluate_expression(expr, symbol_table):
     if isinstance(expr, BinOp):
         # TODO: handle Decimal numbers here:
-        a, b = evaluate_expression(expr.left), evaluate_expression(expr.right)
+        a, b = evaluate_expression(expr.left, symbol_table), evaluate_expression(expr.right, symbol_table)
         op = expr.op
         if op in ['+', '-', '*', '/', '<', '<=', '>', '>=', '=', '#']:
             #a, b = int(a), int(b)
@@ -145,8 +132,8 @@ def evaluate_expression(expr):
             else:
                 return a or b
     elif isinstance(expr, UnaryOp):
-        #a = int(evaluate_expression(expr.right))
-        a = evaluate_expression(expr.right)
+        #a = int(evaluate_expression(expr.right, symbol_table))
+        a = evaluate_expression(expr.right, symbol_table)
         if expr.op == '-':
             return normalize_numeric(-a)
         elif expr.op == '.not.':
@@ -163,7 +150,7 @@ def evaluate_expression(expr):
         if len(expr.subscripts) > 1:
             raise ParseException(expr, 'More than one subscript: %s' % str(expr))
         if expr.subscripts:
-            subscript = int(evaluate_expression(expr.subscripts[0]))
+            subscript = int(evaluate_expression(expr.subscripts[0], symbol_table))
         else:
             subscript = None
         if (expr.identifier.prefix in '%!?') != (subscript is not None):
@@ -178,7 +165,7 @@ def evaluate_expression(expr):
             return value
     elif isinstance(expr, FunctionCall):
         name = str(expr.function_name)
-        parameters = [evaluate_expression(param) for param in expr.parameters]
+        parameters = [evaluate_expression(param, symbol_table) for param in expr.parameters]
         funcs2numparameters = {'abs': 1, 'in_range': 3, 'sh_left': 2, 'sh_right': 2, 'by_marks': 1, 'int_to_real': 1, 'real_to_int': 1}
         if name in list(funcs2numparameters.keys()):
             if len(parameters) != funcs2numparameters[name]:
@@ -451,8 +438,9 @@ class ASTVisitorFindUsedFunctions(ASTVisitor):
             self.mark_used_functions_using_depth_first_traversal(call_graph, n, visited)
 
 class ASTVisitorCheckDeclarations(ASTVisitor):
-    def __init__(self, ast):
+    def __init__(self, ast, context):
         ASTVisitor.__init__(self)
+        self.context = context
         self.traverse(ast)
 
     def assert_true(self, condition, node, msg):
@@ -468,9 +456,9 @@ class ASTVisitorCheckDeclarations(ASTVisitor):
             return False
 
     def visitFunctionDef(self, parent, node, *args):
-        if node.name.identifier in user_defined_functions:
+        if node.name.identifier in self.context.user_defined_functions:
             raise ParseException(node, 'There is already a variable/function defined with the same name')
-        user_defined_functions[node.name.identifier] = node
+        self.context.user_defined_functions[node.name.identifier] = node
         return True
 
     def visitDeclareStmt(self, parent, node, *args):
@@ -491,11 +479,13 @@ class ASTVisitorCheckDeclarations(ASTVisitor):
             self.assert_true(node.parameters and len(node.parameters) == 3, node, 'Expected three parameters: width, height, max')
         elif 'ui_waveform' in node.modifiers:
             self.assert_true(node.parameters and len(node.parameters) == 2, node, 'Expected two parameters: width, height')
-        if name.lower() in symbol_table:
-            raise ParseException(node.variable, 'Redeclaration of %s' % name)
+        names = [name] if node.ui_array_size is None else node.get_ui_array_names()
+        for name in names:
+            if name.lower() in self.context.symbol_table:
+                raise ParseException(node.variable, 'Redeclaration of %s' % name)
         if node.size:
             try:
-                size = evaluate_expression(node.size)
+                size = evaluate_expression(node.size, self.context.symbol_table)
             except ValueUndefinedException:
                 raise ParseException(node.size, 'Array size is non-constant or uses undefined variables')
         else:
@@ -509,7 +499,7 @@ class ASTVisitorCheckDeclarations(ASTVisitor):
                 if not node.initial_value:
                     raise ParseException(node.variable, 'A constant value has to be assigned to the constant')
                 try:
-                    initial_value = evaluate_expression(node.initial_value)
+                    initial_value = evaluate_expression(node.initial_value, self.context.symbol_table)
                 except ValueUndefinedException:
                     raise ParseException(node.initial_value, 'Expression uses non-constant values or undefined constant variables')
 
@@ -521,7 +511,7 @@ class ASTVisitorCheckDeclarations(ASTVisitor):
                                                           or param.identifier.prefix+param.identifier.identifier in ksp_builtins.variables):
                     params.append(param)
                 else:
-                    params.append(evaluate_expression(param))
+                    params.append(evaluate_expression(param, self.context.symbol_table))
         except ValueUndefinedException:
             raise ParseException(node, 'Expression uses non-constant values or undefined constant variables')
         #name, size=1, params=None, control_type=None, is_constant=False, value=None):
@@ -532,19 +522,21 @@ class ASTVisitorCheckDeclarations(ASTVisitor):
 
         is_constant = ('const' in node.modifiers and initial_value is not None)
         is_polyphonic = 'polyphonic' in node.modifiers
-        symbol_table[name.lower()] = Variable(node.variable, size, params, control_type, is_constant, is_polyphonic, initial_value)
+        for name in names:
+            self.context.symbol_table[name.lower()] = Variable(node.variable, size, params, control_type, is_constant, is_polyphonic, initial_value)
         self.visit_children(parent, node, *args)
         return False
 
     def visitID(self, parent, node, *args):
         name = str(node)
         special_names = ['NO_SYS_SCRIPT_RLS_TRIG', 'NO_SYS_SCRIPT_PEDAL', 'NO_SYS_SCRIPT_GROUP_START', 'NO_SYS_SCRIPT_ALL_NOTES_OFF']
-        if not name in ksp_builtins.variables and not name in ksp_builtins.functions and not name.lower() in symbol_table and not name in special_names and not name in user_defined_functions and not name.lower() in nckp_table:
+        if not name in ksp_builtins.variables and not name in ksp_builtins.functions and not name.lower() in self.context.symbol_table and not name in special_names and not name in self.context.user_defined_functions and not name.lower() in self.context.nckp_table:
             raise ParseException(node, 'Undeclared variable/function: %s' % name)
 
 class ASTModifierSimplifyExpressions(ASTModifier):
-    def __init__(self, module_ast, replace_constants=True):
+    def __init__(self, module_ast, context, replace_constants=True):
         ASTModifier.__init__(self)
+        self.context = context
         self.replace_constants = replace_constants
         self.traverse(module_ast)
 
@@ -552,7 +544,7 @@ class ASTModifierSimplifyExpressions(ASTModifier):
         if expr is None:
             return None
         try:
-            result = evaluate_expression(expr)
+            result = evaluate_expression(expr, self.context.symbol_table)
             if type(result) is int and not isinstance(expr, Integer):
                 return Integer(expr.lexinfo, result)
             if type(result) is Decimal and not isinstance(expr, Real):
@@ -663,8 +655,9 @@ class ASTModifierSimplifyExpressions(ASTModifier):
             return [node]
 
 class ASTModifierRemoveUnusedBranches(ASTModifier):
-    def __init__(self, module_ast):
+    def __init__(self, module_ast, context):
         ASTModifier.__init__(self)
+        self.context = context
         self.traverse(module_ast)
 
     def is1equals1(self, node):
@@ -679,7 +672,7 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
                 try:
                     value = None
                     if condition:
-                        value = evaluate_expression(condition)
+                        value = evaluate_expression(condition, self.context.symbol_table)
                 except ParseException:
                     pass
                 if value is True:
@@ -708,12 +701,12 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
         if len(statements) == 1:
             node = statements[0]
             try:
-                value = evaluate_expression(node.expression)
+                value = evaluate_expression(node.expression, self.context.symbol_table)
                 if value is None:
                     return [node]
                 for ((start, stop), stmts) in node.range_stmts_tuples:
-                    start = evaluate_expression(start)
-                    stop = evaluate_expression(stop)
+                    start = evaluate_expression(start, self.context.symbol_table)
+                    stop = evaluate_expression(stop, self.context.symbol_table)
                     if (stop is not None and start <= value <= stop) or (start == value):
                         return stmts
             except ParseException:
@@ -727,7 +720,7 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
         if len(statements) == 1:
             node = statements[0]
             try:
-                value = evaluate_expression(node.condition)
+                value = evaluate_expression(node.condition, self.context.symbol_table)
                 if value is False:
                     return []
             except ParseException:
@@ -818,8 +811,8 @@ class ASTModifierFixCallbug(ASTModifier):
             node.lines = self.fixStatementList(node.lines)
         return node
 
-def check_code(module, optimize=False, check_empty_compound_statements=False, call_bug_work_around=True):
-    clear_symbol_table()
+def check_code(module, context, optimize=False, check_empty_compound_statements=False, call_bug_work_around=True):
+    context.clear_symbol_table()
     used_variables = set()
 
     if optimize:
@@ -834,7 +827,7 @@ def check_code(module, optimize=False, check_empty_compound_statements=False, ca
     ASTVisitorCheckStatementExprTypes(module)
 
     yield ('progress', 'checking declarations', int(60*rescaler))
-    ASTVisitorCheckDeclarations(module)
+    ASTVisitorCheckDeclarations(module, context)
 
     ##if call_bug_work_around:
     ##    yield ('progress', 'automatically introducing work-around for call bug', int(68*rescaler))
@@ -842,10 +835,10 @@ def check_code(module, optimize=False, check_empty_compound_statements=False, ca
 
     if optimize:
         yield ('progress', 'optimizing - simplying expressions', 70)
-        ASTModifierSimplifyExpressions(module, replace_constants=True)
+        ASTModifierSimplifyExpressions(module, context, replace_constants=True)
 
         yield ('progress', 'optimizing - removing unused code branches', 80)
-        ASTModifierRemoveUnusedBranches(module)
+        ASTModifierRemoveUnusedBranches(module, context)
 
         yield ('progress', 'optimizing - removing unused variables', 90)
         ASTVisitorFindUsedVariables(module, used_variables)
@@ -14,12 +14,17 @@
 
 import ply.lex as lex
 import ply.yacc as yacc
+from ply.lex import LexToken
 import re
 from parser_utils import *
 from ksp_ast import *
 from ksp_ast_processing import *
 import os
 import os.path
+import sys
+import types
+import hashlib
+import copy
 
 # *********************************** LEXER *******************************************
 
@@ -40,7 +45,7 @@ tokens = reserved + (
     'LPAREN', 'RPAREN', 'LBRACK', 'RBRACK',
     'REAL', 'INTEGER', 'STRING',
     'ID',
-    'INIT_ARRAY',
+    'INIT_ARRAY', 'UI_ARRAY',
     'COMMA', 'DOT', 'LINECONT', 'NEWLINE', 'COMMENT',
 )
 
@@ -108,24 +113,31 @@ def t_REAL(t):
 
 def t_ID(t):
     r'[$%!@~?][A-Za-z0-9_.]+|[A-Za-z_][A-Za-z0-9_.]*|\d+[A-Za-z_][A-Za-z0-9_]*'
-    if t.value == 'mod': # mod operator
-        t.type = 'MOD'
-    elif t.value.lower().startswith('0x') and hex_number_re1.match(t.value): # hex number, eg. 0x10
-        t.type = 'INTEGER'
-        t.value = int(t.value, 16)
-    elif t.value.lower().endswith('h') and hex_number_re2.match(t.value): # hex number, eg. 010h
-        t.type = 'INTEGER'
-        t.value = int(t.value[1:-1], 16)
-    elif t.value.lower().startswith('b') and lsb_left_bin_re1.match(t.value): # hex number, eg. 010h
-        t.type = 'INTEGER'
-        t.value = int(t.value.lower().replace('b','')[::-1], 2)
-    elif t.value.lower().endswith('b') and lsb_right_bin_re1.match(t.value): # hex number, eg. 010h
-        t.type = 'INTEGER'
-        t.value = int(t.value.lower().replace('b',''), 2)
-    else:
-        t.type = reserved_map.get(t.value, "ID")
+    t.type, t.value = classify_id(t.value)
     return t
 
+# the token types of the identifiers which aren't IDs (other than numbers)
+id_types = dict(reserved_map)
+id_types['mod'] = 'MOD' # mod operator
+number_id_start = frozenset('0123456789bB')
+
+def classify_id(value):
+    '''Returns the token type and value of a token matched by t_ID'''
+    token_type = id_types.get(value)
+    if token_type is not None:
+        return token_type, value
+    if value[0] not in number_id_start:
+        return 'ID', value
+    if value.lower().startswith('0x') and hex_number_re1.match(value): # hex number, eg. 0x10
+        return 'INTEGER', int(value, 16)
+    elif value.lower().endswith('h') and hex_number_re2.match(value): # hex number, eg. 010h
+        return 'INTEGER', int(value[1:-1], 16)
+    elif value.lower().startswith('b') and lsb_left_bin_re1.match(value): # binary number with the least significant bit to the left, eg. b001
+        return 'INTEGER', int(value.lower().replace('b','')[::-1], 2)
+    elif value.lower().endswith('b') and lsb_right_bin_re1.match(value): # binary number, eg. 100b
+        return 'INTEGER', int(value.lower().replace('b',''), 2)
+    return 'ID', value
+
 def t_INTEGER(t):
     r'\d+\.\d*(e\d+)|\d+'
     try:
@@ -143,6 +155,13 @@ def t_INIT_ARRAY(t):
     t.value = re.sub(r'[^-0-9,]', '', t.value)
     return t
 
+def t_UI_ARRAY(t):
+    r'\[\[\s*\d+(\s+(pers|instpers|read))?\s*\]\]'
+    # the number of controls (and the persistence) of a UI array, eg. [[8 pers]] (see UIArrayStage in preprocessor_plugins.py)
+    parts = t.value[2:-2].split()
+    t.value = (int(parts[0]), parts[1] if len(parts) > 1 else None)
+    return t
+
 def InitArrayToList(lexinfo, init_array_token):
     return [Integer(lexinfo, int(num)) for num in number_re.findall(init_array_token)]
 
@@ -174,6 +193,133 @@ def t_LINECONT(t):
 
 ##lex.lex()
 
+class KSPLexer(object):
+    '''A lexer which produces the same tokens as the PLY lexer built from the t_ rules above, but which is faster.
+    The rules which may match at a position are looked up in a table by the character at that position, so most
+    tokens are found with a single match (or no match at all for the one character tokens), and identifiers are
+    classified with a dict lookup. The rules are tried in the same order as by PLY, so the first one which matches wins.'''
+
+    # the rules which can match at a character, in the order PLY tries them
+    rules_by_first_char = [
+        ('.', ('BITWISE_AND', 'BITWISE_OR', 'BITWISE_NOT', 'LINECONT', 'DOT')),
+        ('o', ('BEGIN_CALLBACK', 'ID')),
+        ('e', ('END_CALLBACK', 'ID')),
+        ('0123456789', ('REAL', 'ID', 'INTEGER')),
+        ('$%!@~?ABCDEFGHIJKLMNOPQRSTUVWXYZabcdfghijklmnpqrstuvwxyz_', ('ID',)),
+        ('-', ('RIGHTARROW', 'MINUS')),
+        ('(', ('INIT_ARRAY', 'COMMENT', 'LPAREN')),
+        ('[', ('UI_ARRAY', 'LBRACK')),
+        ('{', ('COMMENT',)),
+        ('\'"', ('STRING',)),
+        ('<>#=', ('COMPARE',)),
+        (':', ('ASSIGN',)),
+    ]
+    single_char_tokens = {'\n': 'NEWLINE', ')': 'RPAREN', ']': 'RBRACK', '+': 'PLUS', '*': 'TIMES', ',': 'COMMA', '&': 'CONCAT', '/': 'DIVIDE'}
+    # rules which need more than the matched text as value (the ID, INTEGER, NEWLINE, COMMENT and LINECONT rules are handled inline)
+    token_funcs = {'BEGIN_CALLBACK': t_BEGIN_CALLBACK, 'INIT_ARRAY': t_INIT_ARRAY, 'UI_ARRAY': t_UI_ARRAY}
+
+    def __init__(self):
+        current_module = sys.modules[__name__]
+        self.table = {}
+        for chars, token_types in self.rules_by_first_char:
+            rules = []
+            for token_type in token_types:
+                rule = getattr(current_module, 't_' + token_type)
+                rules.append('(?P<%s>%s)' % (token_type, rule if isinstance(rule, str) else rule.__doc__))
+            # PLY compiles the rules in verbose mode
+            regex = re.compile('|'.join(rules), re.VERBOSE)
+            for char in chars:
+                self.table[char] = regex
+            if chars.isdigit():
+                self.digit_rules = regex
+        for char, token_type in self.single_char_tokens.items():
+            self.table[char] = token_type
+        # PLY sets the lexer attribute of the tokens made by function rules
+        self.func_types = set(name[2:] for name in dir(current_module) if name.startswith('t_') and callable(getattr(current_module, name)))
+        self.lexdata = None
+        self.lexpos = 0
+        self.lexlen = 0
+        self.lineno = 1
+
+    def clone(self):
+        return copy.copy(self)
+
+    def input(self, s):
+        self.lexdata = s
+        self.lexpos = 0
+        self.lexlen = len(s)
+
+    def skip(self, n):
+        self.lexpos += n
+
+    def token(self):
+        lexdata = self.lexdata
+        lexpos = self.lexpos
+        lexlen = self.lexlen
+        table = self.table
+        while lexpos < lexlen:
+            char = lexdata[lexpos]
+            rule = table.get(char)
+            if rule is None:
+                if char.isdecimal() and char > '\x7f':
+                    rule = self.digit_rules # \d also matches the non-ASCII digits
+                else:
+                    # whitespace is ignored and illegal characters are skipped (like t_error does)
+                    lexpos += 1
+                    continue
+            tok = LexToken()
+            tok.lineno = self.lineno
+            tok.lexpos = lexpos
+            if rule.__class__ is str:
+                tok.type = rule
+                tok.value = lexdata[lexpos]
+                self.lexpos = lexpos + 1
+                if rule == 'NEWLINE':
+                    tok.lexer = self
+                    self.lineno += 1
+                return tok
+            m = rule.match(lexdata, lexpos)
+            if m is None:
+                lexpos += 1
+                continue
+            token_type = m.lastgroup
+            value = m.group()
+            self.lexpos = lexpos = m.end()
+            if token_type == 'ID':
+                token_type, value = classify_id(value)
+                tok.lexer = self
+            elif token_type == 'INTEGER':
+                value = int(value) # the real numbers matched by t_INTEGER are matched by t_REAL first
+                tok.lexer = self
+            elif token_type == 'COMMENT':
+                self.lineno += value.count('\n')
+                continue
+            elif token_type == 'LINECONT':
+                self.lineno += 1
+                continue
+            elif token_type in self.token_funcs:
+                tok.type = token_type
+                tok.value = value
+                tok.lexer = self
+                return self.token_funcs[token_type](tok)
+            elif token_type in self.func_types:
+                tok.lexer = self
+            tok.type = token_type
+            tok.value = value
+            return tok
+        self.lexpos = lexpos + 1
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = self.token()
+        if t is None:
+            raise StopIteration
+        return t
+
+
 # *********************************** PARSER *******************************************
 
 precedence = (
@@ -196,8 +342,13 @@ precedence = (
 # grammar:
 # ---------------------------------------------------------------------------------
 
+# The lists are built by right recursive rules, so the last item is reduced first. To avoid copying the list for every item
+# the rules for the tail of a list (eg. stmts, more-args-opt) append their item, which gives the list in reverse order, and
+# the rule which uses the complete list (eg. stmts-opt, args) reverses it once.
+
 def p_script(p):
     'script               : newlines-opt toplevels'
+    p[2].reverse()
     p[0] = Module(p, blocks=p[2])
 
 def p_script_error(p):
@@ -206,7 +357,8 @@ def p_script_error(p):
 
 def p_toplevels(p):
     'toplevels             : toplevel toplevels'
-    p[0] = [p[1]] + p[2]
+    p[2].append(p[1])
+    p[0] = p[2]
 
 def p_toplevels_empty(p):
     'toplevels             : empty'
@@ -261,6 +413,7 @@ def p_override_opt_empty(p):
 
 def p_stmts_opt(p):
     'stmts-opt             : stmts'
+    p[1].reverse()
     p[0] = p[1]
 
 def p_stmts_opt_empty(p):
@@ -276,10 +429,9 @@ def p_stmts(p):
 
 def p_stmts_more(p):
     'stmts                 : stmt stmts'
-    if p[1] is None:
-        p[0] = p[2]
-    else:
-        p[0] = [p[1]] + p[2]
+    if p[1] is not None:
+        p[2].append(p[1])
+    p[0] = p[2]
 
 def p_stmt(p):
     '''stmt                : declaration NEWLINE
@@ -310,7 +462,9 @@ def p_preprocessor_stmt_reset_condition(p):
 
 def p_if_stmt(p):
     'if-stmt               : IF expression NEWLINE stmts-opt else-if-opt END IF'
-    p[0] = IfStmt(p, condition_stmts_tuples=[(p[2], p[4])] + p[5])
+    p[5].append((p[2], p[4]))
+    p[5].reverse()
+    p[0] = IfStmt(p, condition_stmts_tuples=p[5])
 
 def p_if_stmt_error(p):
     'if-stmt               : IF expression NEWLINE stmts-opt else-if-opt error'
@@ -318,7 +472,8 @@ def p_if_stmt_error(p):
 
 def p_else_if_opt(p):
     'else-if-opt           : ELSE else-if-condition-opt NEWLINE stmts-opt else-if-opt'
-    p[0] = [(p[2], p[4])] + p[5] # [(condition, stmts), ...
+    p[5].append((p[2], p[4])) # [(condition, stmts), ... in reverse order
+    p[0] = p[5]
 
 def p_else_if_opt_empty(p):
     'else-if-opt           : empty'
@@ -359,6 +514,7 @@ def p_updownto(p):
 
 def p_select_stmt(p):
     'select-stmt           : SELECT expression NEWLINE select-cases END SELECT'
+    p[4].reverse()
     p[0] = SelectStmt(p, p[2], p[4])
 
 def p_select_stmt_error(p):
@@ -367,7 +523,8 @@ def p_select_stmt_error(p):
 
 def p_select_cases(p):
     'select-cases          : select-case select-cases'
-    p[0] = [p[1]] + p[2]
+    p[2].append(p[1])
+    p[0] = p[2]
 
 def p_select_cases_empty(p):
     'select-cases          : empty'
@@ -395,7 +552,9 @@ def p_params_opt_empty(p):
 
 def p_params(p):
     'params                : LPAREN ID more-params-opt RPAREN'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[3].reverse()
+    p[0] = p[3]
 
 def p_params_none(p):
     'params                : LPAREN RPAREN'
@@ -407,7 +566,8 @@ def p_params_init_array(p):
 
 def p_more_params_opt(p):
     'more-params-opt       : COMMA ID more-params-opt'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[0] = p[3]
 
 def p_more_params_opt_empty(p):
     'more-params-opt       : empty'
@@ -423,11 +583,15 @@ def p_taskfunc_params_opt_empty(p):
 
 def p_taskfunc_params(p):
     'taskfunc-params       : LPAREN    ID more-taskfunc-params-opt RPAREN'
-    p[0] = [(None, p[2])] + p[3]
+    p[3].append((None, p[2]))
+    p[3].reverse()
+    p[0] = p[3]
 
 def p_taskfunc_params_with_modifier(p):
     'taskfunc-params       : LPAREN ID ID more-taskfunc-params-opt RPAREN'
-    p[0] = [(p[2], p[3])] + p[4]
+    p[4].append((p[2], p[3]))
+    p[4].reverse()
+    p[0] = p[4]
 
 def p_taskfunc_params_none(p):
     'taskfunc-params       : LPAREN RPAREN'
@@ -435,11 +599,13 @@ def p_taskfunc_params_none(p):
 
 def p_more_taskfunc_params_opt(p):
     'more-taskfunc-params-opt : COMMA    ID more-taskfunc-params-opt'
-    p[0] = [(None, p[2])] + p[3]
+    p[3].append((None, p[2]))
+    p[0] = p[3]
 
 def p_more_taskfunc_params_with_modifier_opt(p):
     'more-taskfunc-params-opt : COMMA ID ID more-taskfunc-params-opt'
-    p[0] = [(p[2], p[3])] + p[4]
+    p[4].append((p[2], p[3]))
+    p[0] = p[4]
 
 def p_more_taskfunc_params_opt_empty(p):
     'more-taskfunc-params-opt : empty'
@@ -455,7 +621,9 @@ def p_args_opt_empty(p):
 
 def p_args(p):
     'args                  : LPAREN expression more-args-opt RPAREN'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[3].reverse()
+    p[0] = p[3]
 
 def p_args_int_array(p):
     'args                  : INIT_ARRAY'
@@ -467,7 +635,8 @@ def p_args_none(p):
 
 def p_more_args_opt(p):
     'more-args-opt         : COMMA expression more-args-opt'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[0] = p[3]
 
 def p_more_args_opt_empty(p):
     'more-args-opt         : empty'
@@ -491,6 +660,7 @@ def p_procedure_call_with_call(p):
 
 def p_propertydef(p):
     'propertydef           : PROPERTY ident NEWLINE newlines-opt functiondefs END PROPERTY'
+    p[5].reverse()
     p[0] = PropertyDef(p, p[2], functions=p[5])
 
 def p_propertydef_simplified(p):
@@ -506,10 +676,9 @@ def p_functiondefs1(p):
 
 def p_functiondefs2(p):
     'functiondefs          : functiondef newlines-opt functiondefs'
-    if p[1] is None:
-        p[0] = p[3]
-    else:
-        p[0] = [p[1]] + p[3]
+    if p[1] is not None:
+        p[3].append(p[1])
+    p[0] = p[3]
 
 def p_declaration1(p):
     'declaration           : DECLARE global-modifier-opt decl-modifier-opt ident args-opt initial-value-opt'
@@ -519,6 +688,14 @@ def p_declaration2(p):
     'declaration           : DECLARE global-modifier-opt decl-modifier-opt ident array-size args-opt initial-array-opt'
     p[0] = DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=p[5], parameters=p[6], initial_value=p[7])
 
+def p_declaration_ui_array1(p):
+    'declaration           : DECLARE global-modifier-opt decl-modifier-opt ident UI_ARRAY args-opt'
+    p[0] = DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=None, parameters=p[6], ui_array_size=p[5][0], persistence=p[5][1])
+
+def p_declaration_ui_array2(p):
+    'declaration           : DECLARE global-modifier-opt decl-modifier-opt ident UI_ARRAY array-size args-opt'
+    p[0] = DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=p[6], parameters=p[7], ui_array_size=p[5][0], persistence=p[5][1])
+
 def p_family_declaration(p):
     'family-declaration    : FAMILY ident NEWLINE stmts-opt END FAMILY'
     p[0] = FamilyStmt(p, name=p[2], statements=p[4])
@@ -595,11 +772,14 @@ def p_get_ui_par_expr(p):
 
 def p_subscripts(p):
     'subscripts            : LBRACK expression more-subscripts-opt RBRACK'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[3].reverse()
+    p[0] = p[3]
 
 def p_more_subscripts_opt(p):
     'more-subscripts-opt   : COMMA expression more-subscripts-opt'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[0] = p[3]
 
 def p_more_subscripts_opt_empty(p):
     'more-subscripts-opt   : empty'
@@ -615,11 +795,14 @@ def p_id_subscripts_opt_empty(p):
 
 def p_id_subscripts(p):
     'id-subscripts          : LBRACK ident more-id-subscripts-opt RBRACK'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[3].reverse()
+    p[0] = p[3]
 
 def p_more_id_subscripts_opt(p):
     'more-id-subscripts-opt : COMMA ident more-id-subscripts-opt'
-    p[0] = [p[2]] + p[3]
+    p[3].append(p[2])
+    p[0] = p[3]
 
 def p_more_id_subscripts_opt_empty(p):
     'more-id-subscripts-opt : empty'
@@ -812,6 +995,8 @@ def p_error(p):
 
 # g('declaration           : DECLARE global-modifier-opt decl-modifier-opt ident args-opt initial-value-opt', lambda p: DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=None, parameters=p[5], initial_value=p[6]))
 # g('                      | DECLARE global-modifier-opt decl-modifier-opt ident array-size args-opt initial-array-opt', lambda p: DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=p[5], parameters=p[6], initial_value=p[7]))
+# g('                      | DECLARE global-modifier-opt decl-modifier-opt ident UI_ARRAY args-opt', lambda p: DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=None, parameters=p[6], ui_array_size=p[5][0], persistence=p[5][1]))
+# g('                      | DECLARE global-modifier-opt decl-modifier-opt ident UI_ARRAY array-size args-opt', lambda p: DeclareStmt(p, variable=p[4], modifiers=p[2] + p[3], size=p[6], parameters=p[7], ui_array_size=p[5][0], persistence=p[5][1]))
 # g('family-declaration    : FAMILY ident NEWLINE stmts-opt END FAMILY', lambda p: FamilyStmt(p, name=p[2], statements=p[4]))
 # g('                      | FAMILY ident NEWLINE stmts-opt error     ', RaiseParseException("Expected 'end family'"))
 # g('global-modifier-opt   : LOCAL | GLOBAL', AddToEmptyList())
@@ -878,13 +1063,82 @@ def p_error(p):
 # g('empty                 :                   ', ReturnParam(0))
 # g('error                 :                   ', RaiseParseException())
 
-def init(outputdir=None):
-    outputdir = outputdir or os.path.dirname(__file__)  # os.getcwd()
+lextab_prefix = 'ksp_lextab_'
+parsetab_prefix = 'ksp_parser_tab_'
+
+def grammar_signature():
+    '''Returns a hex digest of the token list, precedence, lexer rules and grammar productions.
+    Any change to these yields a different signature and therefore different table file names.'''
+    current_module = sys.modules[__name__]
+    sig = hashlib.md5()
+    sig.update(repr((lex.__tabversion__, yacc.__tabversion__, tokens, precedence)).encode('utf-8'))
+    string_rules = []
+    func_rules = []
+    for name in dir(current_module):
+        if not (name.startswith('t_') or name.startswith('p_')):
+            continue
+        obj = getattr(current_module, name)
+        if isinstance(obj, str):
+            string_rules.append((name, obj))
+        elif callable(obj):
+            # the order of function rules matters to the lexer (they are tried in definition order)
+            func_rules.append((obj.__code__.co_firstlineno, name, obj.__doc__ or ''))
+    for name, rule in sorted(string_rules):
+        sig.update(('%s=%s\n' % (name, rule)).encode('utf-8'))
+    for lineno, name, doc in sorted(func_rules):
+        sig.update(('%s:%s\n' % (name, doc)).encode('utf-8'))
+    return sig.hexdigest()
+
+def _remove_stale_tables(outputdir, keep):
+    try:
+        for filename in os.listdir(outputdir):
+            if (filename.startswith(lextab_prefix) or filename.startswith(parsetab_prefix)) and filename not in keep:
+                os.remove(os.path.join(outputdir, filename))
+    except OSError:
+        pass
+
+def _load_lextab(path):
+    '''Loads a lexer table file written by PLY as a module object (without requiring its directory to be on sys.path).'''
+    module = types.ModuleType(os.path.splitext(os.path.basename(path))[0])
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), module.__dict__)
+    return module
+
+def init(outputdir=None, cache_tables=True):
+    '''Builds the lexer and the LALR parser. If cache_tables is True the generated tables are stored in outputdir
+    (keyed by the grammar signature) and loaded from there on subsequent calls instead of being regenerated.
+    If outputdir is not writable (eg. when running from a zipped package) the tables are generated in memory.'''
+    outputdir = outputdir or os.path.dirname(os.path.abspath(__file__))  # os.getcwd()
     current_module = sys.modules[__name__]
     #print (outputdir, current_module)
     debug = 0
     optimize = 0
-    lexer = lex.lex(optimize=0, debug=debug)
+
+    if cache_tables:
+        signature = grammar_signature()
+        lextab_name = lextab_prefix + signature
+        lextab_path = os.path.join(outputdir, lextab_name + '.py')
+        picklefile = os.path.join(outputdir, parsetab_prefix + signature + '.pickle')
+        writable = os.path.isdir(outputdir) and os.access(outputdir, os.W_OK)
+        if not os.path.exists(picklefile) and not writable:
+            cache_tables = False
+
+    lexer = None
+    if cache_tables and os.path.exists(lextab_path):
+        try:
+            lexer = lex.lex(module=current_module, optimize=1, lextab=_load_lextab(lextab_path), debug=debug)
+        except Exception:
+            lexer = None
+    if lexer is None:
+        lexer = lex.lex(module=current_module, optimize=0, debug=debug)
+        if cache_tables and writable:
+            # write to a temporary name first so that concurrent processes never see a partially written file
+            tmp_name = '%s_%d' % (lextab_name, os.getpid())
+            try:
+                lexer.writetab(tmp_name, outputdir)
+                os.replace(os.path.join(outputdir, tmp_name + '.py'), lextab_path)
+            except (IOError, OSError):
+                pass
 
     # lexer.input('on init\n   declare shared parameter cutoff')
     # while True:
@@ -893,18 +1147,76 @@ def init(outputdir=None):
     #         break
     #     print (tok)
 
-    return yacc.yacc(method="LALR", optimize=optimize, debug=debug,
-                     write_tables=0, module=current_module, start='script',
-                     outputdir=outputdir, tabmodule='ksp_parser_tab')
+    if not cache_tables:
+        return yacc.yacc(method="LALR", optimize=optimize, debug=debug,
+                         write_tables=0, module=current_module, start='script',
+                         outputdir=outputdir, tabmodule='ksp_parser_tab')
+
+    if os.path.exists(picklefile):
+        # yacc verifies the signature stored in the file and regenerates it on mismatch
+        target = picklefile
+    else:
+        target = '%s.%d' % (picklefile, os.getpid())
+    try:
+        parser = yacc.yacc(method="LALR", optimize=optimize, debug=debug,
+                           module=current_module, start='script', picklefile=target)
+    except (IOError, OSError):
+        return init(outputdir, cache_tables=False)
+    if target != picklefile:
+        try:
+            os.replace(target, picklefile)
+            _remove_stale_tables(outputdir, keep=(os.path.basename(picklefile), lextab_name + '.py'))
+        except OSError:
+            pass
+    return parser
 
 parser = init()
 
-def parse(script_code):
-    lex.lexer.lineno = 0
-    lex.lexer.filename = 'current file'  # filepath
-    data = script_code.replace('\r', '')
-    result = parser.parse(data, tracking=True)
-    return result
+class ParserPool(object):
+    '''Hands out lexer/parser pairs for parsing. The pairs are copies of a prototype lexer and parser, so they share
+    its (read-only) tables but keep their own state while parsing, and each pair is only used by one parse at a time.
+    This makes it safe to parse on several threads at once, or to parse again from within a parse.'''
+
+    def __init__(self, lexer, parser):
+        self.lexer = lexer
+        self.parser = parser
+        self.free_pairs = []
+
+    def acquire(self):
+        '''Returns a (lexer, parser) pair which isn't used by anyone else until it is given back with release.'''
+        try:
+            return self.free_pairs.pop()   # list.pop and list.append are atomic, no lock is needed
+        except IndexError:
+            return (self.lexer.clone(), copy.copy(self.parser))
+
+    def release(self, pair):
+        self.free_pairs.append(pair)
+
+    def parse(self, script_code):
+        return self.parse_part(script_code, 0)[0]
+
+    def parse_part(self, code, first_lineno):
+        '''Parses code which begins at line first_lineno of a script. Returns the module and the line number the lexer has
+        reached at the end of the code (the line breaks inside some tokens, eg. 'end\\non', aren't counted).'''
+        lexer, parser = pair = self.acquire()
+        try:
+            lexer.lineno = first_lineno
+            lexer.filename = 'current file'  # filepath
+            data = code.replace('\r', '')
+            return parser.parse(data, lexer=lexer, tracking=True), lexer.lineno
+        finally:
+            lexer.input('')   # don't keep a reference to the script in the free pair
+            self.release(pair)
+
+# 'table' is the KSPLexer, 'ply' the lexer generated by PLY from the same rules (they produce the same tokens)
+parser_pools = {'table': ParserPool(KSPLexer(), parser), 'ply': ParserPool(lex.lexer, parser)}
+default_lexer_backend = 'table'
+
+def parse(script_code, lexer_backend=None):
+    return parser_pools[lexer_backend or default_lexer_backend].parse(script_code)
+
+def parse_part(code, first_lineno, lexer_backend=None):
+    return parser_pools[lexer_backend or default_lexer_backend].parse_part(code, first_lineno)
 
 ##import os
 ##visitor = ASTVisitorDotGenerator(module)
@@ -5,7 +5,7 @@
 #
 # This file adds a selection of extra syntax, functions and macros that aim to make programming in the
 # Kontakt scripting language nicer. These functions are executed very near the beginning of the
-# compiling process. They work by scanning through the deque of Line objects, and using regex, the
+# compiling process. They work by scanning through the ksp_compiler.LineBuffer of Line objects, and using regex, the
 # line commands are manipulated or added to.
 
 #=================================================================================================
@@ -21,6 +21,7 @@ import copy
 import re
 import math
 import collections
+import functools
 import ksp_compiler
 from simple_eval import SimpleEval
 import time
@@ -28,10 +29,11 @@ from time import strftime, localtime
 
 #=================================================================================================
 varPrefixRe = r"[?~%!@$]"
+varPrefixCharRe = re.compile(varPrefixRe)
 variableNameRe = r'(?P<whole>(?P<prefix>\b|[?~$%!@])(?P<name>[a-zA-Z0-9_][a-zA-Z0-9_\.]*))\b' # A variable name
 variableNameUnRe = r'((\b|[?~$%!@])[0-9]*[a-zA-Z0-9_][a-zA-Z0-9_]*(\.[a-zA-Z_0-9]+)*)\b' # Same as above but without names
 persistenceRe = r"(?:\b(?P<persistence>pers|instpers|read)\s+)?"
-nameInDeclareStmtRe = r"%s\s*(?=[\[\(\:]|$)" % variableNameRe # Match the variable name in a whole declare statement.
+nameInDeclareStmtRe = re.compile(r"%s\s*(?=[\[\(\:]|$)" % variableNameRe) # Match the variable name in a whole declare statement.
 
 stringOrPlaceholderRe = r'({\d+}|\"[^"]*\")'
 variableOrInt = r"[^\]]+" # Something that is not a square bracket closing
@@ -43,17 +45,35 @@ whileRe = re.compile(r"^while(?:\(|\s+)")
 endWhileRe = re.compile(r"^end\s+while$")
 ifRe = re.compile(r"^if(?:\s+|\()")
 endIfRe = re.compile(r"^end\s+if$")
-familyStartRe = r"^family\s+(?P<famname>.+)$"
-familyEndRe = r"^end\s+family$"
-initRe = r"^on\s+init$"
-endOnRe = r"^end\s+on$"
+familyStartRe = re.compile(r"^family\s+(?P<famname>.+)$")
+familyEndRe = re.compile(r"^end\s+family$")
+initRe = re.compile(r"^on\s+init$")
+endOnRe = re.compile(r"^end\s+on$")
+endFunctionRe = re.compile(r"^end\s+(function|taskfunc)$")
+squareBracketsRe = re.compile(r"[\[\]]")
 
 concatSyntax = "concat" # The name of the function to concat arrays.
 stringEvaluator = SimpleEval() # Object used to evaluate strings as maths expressions.
 
+# The patterns above are compiled once. Patterns built from names found in the script (struct members, incrementers, arrays...)
+# are compiled through compiledRe instead of being passed to the re module as strings, as its cache only holds a few hundred
+# patterns and big scripts would have them compiled again on every line.
+@functools.lru_cache(maxsize=4096)
+def compiledRe(pattern):
+	""" Returns the compiled pattern, keeping the most recently used ones. """
+	return re.compile(pattern)
+
+def wholeWordRe(name):
+	""" Returns the compiled pattern that matches name as a whole word. """
+	return compiledRe(r"\b%s\b" % name)
+
+def regexCacheInfo():
+	""" Returns the hits, misses, maxsize and currsize of the cache of compiledRe. """
+	return compiledRe.cache_info()
+
 #=================================================================================================
 def pre_macro_functions(lines):
-	""" This function is called before the macros have been expanded. lines is a collections.deque
+	""" This function is called before the macros have been expanded. lines is a ksp_compiler.LineBuffer
 	of Line objects - see ksp_compiler.py."""
 	createBuiltinDefines(lines)
 	removeActivateLoggerPrint(lines)
@@ -61,26 +81,144 @@ def pre_macro_functions(lines):
 	# Define literals are only avilable for backwards compatibility as regular defines now serve this purpose.
 	handleDefineLiterals(lines)
 
-def macro_iter_functions(lines):
-	""" Will process macro iteration and return true if any were found """
-	return (handleIterateMacro(lines) or handleLiterateMacro(lines))
+def macro_iteration_handlers():
+	""" Returns the (pattern, unroll) pairs used by ksp_compiler.expand_macros to unroll iterate_macro and literate_macro
+	lines while expanding macros. Each round unrolls the lines of the first pair that has any; unroll(line, match) returns
+	the new lines. """
+	return [(iterateMacroRe, unrollIterateMacro), (literateMacroRe, unrollLiterateMacro)]
 
 def post_macro_functions(lines):
 	""" This function is called after the regular macros have been expanded. lines is a
-	collections.deque of Line objects - see ksp_compiler.py."""
-	handleIncrementer(lines)
-	handleConstBlock(lines)
-	handleStructs(lines)
-	handleUIArrays(lines)
-	handleSameLineDeclaration(lines)
-	handleMultidimensionalArrays(lines)
-	handleListBlocks(lines)
-	handleOpenSizeArrays(lines)
-	handlePersistence(lines)
-	handleLists(lines)
-	handleUIFunctions(lines)
-	handleStringArrayInitialisation(lines)
-	handleArrayConcat(lines)
+	ksp_compiler.LineBuffer of Line objects - see ksp_compiler.py."""
+	runStages(lines, [
+		IncrementerStage(),
+		ConstBlockStage(),
+		StructStage(),
+		UIArrayStage(),
+		SameLineDeclarationStage(),
+		MultidimensionalArrayStage(),
+		ListBlockStage(),
+		OpenSizeArrayStage(),
+		PersistenceStage(),
+		ListStage(),
+		UIFunctionStage(),
+		StringArrayInitialisationStage(),
+		ArrayConcatStage()])
+
+#=================================================================================================
+# The post macro functions are stages of a pipeline. Each line is classified once by its keyword (the word
+# characters at the start of the stripped command) and only passed to the stages interested in that keyword.
+# The lines a stage outputs go on to the next stage straight away, so the stages share one pass over the
+# lines instead of each building a new list. Stages that need global information (the whole input before
+# processing the first line or the whole output after the last one) declare it, and the pipeline only starts
+# a new pass at those stages.
+keywordRe = re.compile(r"\w*")
+
+class PreprocessorStage(object):
+	keywords = ()          # The line is passed to the stage if its keyword starts with one of these,
+	containing = None      # or if its stripped command contains this string.
+	allLines = False       # Set this while the stage needs to see every line, e.g. inside of a block.
+	needsPrescan = False   # If set, prescan() is given all of the input lines before the first is processed.
+	needsFinish = False    # If set, finish() is given all of the output lines after the last one is processed.
+	needsArrays = False    # If set, self.arrays is the ArrayDeclarationIndex shared by the stages that need it, built from the
+	                       # lines entering the first of them.
+
+	def __init__(self):
+		self.familyScopes = FamilyScopeStack() # Of the family start and end lines passed to the stage so far.
+
+	def isInterested(self, keyword):
+		return keyword.startswith(self.keywords)
+
+	def prescan(self, lines):
+		pass
+
+	def process(self, line, text, keyword):
+		""" Called with the Line object, its stripped command and its keyword. Return None to pass the line on
+		unchanged, or a list of the lines to pass on instead. """
+		return None
+
+	def finish(self, lines):
+		return lines
+
+	def rememberFamilyLine(self, line, text):
+		""" Stages using getFamilyPrefix must call this for the lines with the keywords family and end. """
+		if "family" in text:
+			self.familyScopes.append(line)
+
+	def getFamilyPrefix(self):
+		""" Return the family prefix of the current line. """
+		return self.familyScopes.prefix()
+
+def runStages(lines, stages):
+	""" Run the lines through the stages and replace the contents of lines with the result. """
+	passes = []
+	needsArrays = False
+	for stage in stages:
+		if not passes or stage.needsPrescan or passes[-1][-1].needsFinish or (stage.needsArrays and not needsArrays):
+			passes.append([])
+		passes[-1].append(stage)
+		needsArrays = needsArrays or stage.needsArrays
+	newLines = lines
+	arrays = None
+	for passStages in passes:
+		if arrays is None and passStages[0].needsArrays:
+			arrays = ArrayDeclarationIndex(newLines)
+		for stage in passStages:
+			if stage.needsArrays:
+				stage.arrays = arrays
+		passStages[0].prescan(newLines)
+		newLines = runFusedStages(newLines, passStages)
+		newLines = passStages[-1].finish(newLines)
+	replaceLines(lines, newLines)
+
+def runFusedStages(lines, stages):
+	""" Pass each line through all of the stages and return the list of output lines. """
+	newLines = []
+	numStages = len(stages)
+	# The keywords only consist of word characters, so a line is of interest to a stage if its stripped command starts
+	# with one of the keywords. Most lines are not of interest to any stage and are filtered out with a single startswith.
+	allKeywords = tuple(keyword for stage in stages for keyword in stage.keywords)
+	routes = {} # For each keyword of interest, the indices of the stages that are interested in it.
+	containingStages = [stageIdx for stageIdx in range(numStages) if stages[stageIdx].containing]
+	allLinesStages = set(stageIdx for stageIdx in range(numStages) if stages[stageIdx].allLines)
+
+	def feed(line, text, stageIdx):
+		if text.startswith(allKeywords):
+			keyword = keywordRe.match(text).group(0)
+			route = routes.get(keyword)
+			if route is None:
+				route = routes[keyword] = [i for i in range(numStages) if stages[i].isInterested(keyword)]
+		else:
+			keyword = keywordRe.match(text).group(0)
+			route = ()
+		if containingStages:
+			extraStages = [i for i in containingStages if stages[i].containing in text]
+			if extraStages:
+				route = sorted(set(route).union(extraStages))
+		if allLinesStages:
+			route = sorted(allLinesStages.union(route))
+		for i in route:
+			if i < stageIdx:
+				continue
+			stage = stages[i]
+			result = stage.process(line, text, keyword)
+			if stage.allLines:
+				allLinesStages.add(i)
+			else:
+				allLinesStages.discard(i)
+			if result is not None:
+				for newLine in result:
+					feed(newLine, newLine.command.strip(), i + 1)
+				return
+		newLines.append(line)
+
+	for line in lines:
+		text = line.command.strip()
+		if allLinesStages or text.startswith(allKeywords) or any(stages[i].containing in text for i in containingStages):
+			feed(line, text, 0)
+		else:
+			newLines.append(line)
+	return newLines
 
 #=================================================================================================
 def simplfyAdditionString(string):
@@ -108,35 +246,98 @@ def tryStringEval(expression, line, name):
 	return (final)
 
 def replaceLines(original, new):
-	original.clear()
-	original.extend(new)
+	original.replace(new)
 
 def countFamily(lineText, famCount):
 	""" Checks the line for family start or end and returns the current family depth """
 	if lineText.startswith("family ") or lineText.startswith("family	"):
 		famCount += 1
 	elif famCount != 0:
-		if re.search(familyEndRe, lineText):
+		if familyEndRe.search(lineText):
 			famCount -= 1
 	return(famCount)
 
-def inspectFamilyState(lines, textLineno):
-	""" If the given line is in at least 1 family, return the family prefixes. """
-	currentFamilyNames = []
-	for i in range(len(lines)):
-		if i == textLineno:
-			if currentFamilyNames:
-				return (".".join(currentFamilyNames) + ".")
-			else:
-				return (None)
-			break
-		line = lines[i].command.strip()
-		if "family" in line:
-			m = re.search(familyStartRe, line)
-			if m:
-				currentFamilyNames.append(m.group("famname"))
-			elif re.search(familyEndRe, line):
-				currentFamilyNames.pop()
+class FamilyScope(object):
+	""" A family, and through its parent the families it is nested in. """
+	def __init__(self, name, parent):
+		self.parent = parent
+		self.prefix = (parent.prefix if parent else "") + name + "."
+
+class UnbalancedFamilyScope(object):
+	""" The scope after an end family line that doesn't close a family. """
+	def __init__(self, line):
+		self.line = line
+
+class FamilyScopeStack(object):
+	""" The family scopes opened and closed by the lines appended so far: prefix() returns the family prefix (e.g.
+	"outer.inner.") after the last line, or None if it is not in a family. """
+	def __init__(self, lines=()):
+		self.scope = None # The innermost family after the last line, its parents are the families it is nested in.
+		for line in lines:
+			self.append(line)
+
+	def append(self, line):
+		text = line.command.strip()
+		if not "family" in text or isinstance(self.scope, UnbalancedFamilyScope):
+			return
+		m = familyStartRe.search(text)
+		if m:
+			self.scope = FamilyScope(m.group("famname"), self.scope)
+		elif familyEndRe.search(text):
+			self.scope = self.scope.parent if self.scope else UnbalancedFamilyScope(line)
+
+	def prefix(self):
+		if isinstance(self.scope, UnbalancedFamilyScope):
+			raise ksp_compiler.ParseException(self.scope.line, "end family without a matching family.\n")
+		if self.scope:
+			return self.scope.prefix
+		return None
+
+class ArrayDeclaration(object):
+	""" An array declared in the script. The name is without the prefix symbol, size is the text between the brackets. """
+	def __init__(self, name, prefix, size, line, inInit):
+		self.name = name
+		self.prefix = prefix
+		self.size = size
+		self.line = line
+		self.inInit = inInit
+
+class ArrayDeclarationIndex(object):
+	""" The arrays declared in a list of lines, by name. It is built once by runStages for the stages that set needsArrays,
+	which look up arrays in it instead of scanning the lines, and add the declarations they build to it. A stage can also
+	fill one with the declarations passed to it so far. """
+	arrayDeclareRe = re.compile(r"^declare\s+%s%s\s*(?:\[(%s)\])" % (persistenceRe, variableNameUnRe, variableOrInt))
+
+	def __init__(self, lines=()):
+		self.declarations = {} # For each name, its declarations in the order they were added.
+		initState = 0 # 0 before the init callback, 1 in it and 2 after it.
+		for line in lines:
+			text = line.command.strip()
+			if initState == 0:
+				if text.startswith("on") and initRe.search(text):
+					initState = 1
+			elif initState == 1 and text.startswith("end") and endOnRe.search(text):
+				initState = 2
+			if text.startswith("declare"):
+				self.add(line, initState == 1)
+
+	def add(self, line, inInit=False):
+		""" Add the array declared by the line, if any, and return its ArrayDeclaration. """
+		m = self.arrayDeclareRe.search(line.command.strip())
+		if not m:
+			return None
+		prefix = m.group(3) if m.group(3) else ""
+		declaration = ArrayDeclaration(varPrefixCharRe.sub("", m.group(2)), prefix, m.group(5), line, inInit)
+		self.declarations.setdefault(declaration.name, []).append(declaration)
+		return declaration
+
+	def find(self, name, inInit=False):
+		""" Return the first declaration of the array with the name (without a prefix symbol), optionally only looking
+		at the ones in the init callback, or None if there is none. """
+		for declaration in self.declarations.get(name, ()):
+			if declaration.inInit or not inInit:
+				return declaration
+		return None
 
 #=================================================================================================
 #=================================================================================================
@@ -155,7 +356,7 @@ class StructMember(object):
 			bracketLocation = cmd.find("[")
 			self.command = cmd[: bracketLocation + 1] + numElements + ", " + cmd[bracketLocation + 1 :]
 		else:
-			self.command = re.sub(r"\b%s\b" % self.name, "%s[%s]" % (self.name, numElements), cmd)
+			self.command = wholeWordRe(self.name).sub("%s[%s]" % (self.name, numElements), cmd)
 			if ":=" in self.command:
 				assignOperatorLocation = self.command.find(":=") + 2
 				self.command = "%s(%s)" % (self.command[ : assignOperatorLocation], self.command[assignOperatorLocation : ])
@@ -164,7 +365,7 @@ class StructMember(object):
 
 	def addNamePrefix(self, namePrefix):
 		""" Add the prefix to the member with a dot operator. """
-		self.command = re.sub(r"\b%s\b" % self.name, "%s%s.%s" % (self.prefix, namePrefix, self.name), self.command)
+		self.command = wholeWordRe(self.name).sub("%s%s.%s" % (self.prefix, namePrefix, self.name), self.command)
 
 class Struct(object):
 	def __init__(self, name):
@@ -178,53 +379,60 @@ class Struct(object):
 	def insertMember(self, location, memberObj):
 		self.members.insert(location, memberObj)
 
-def handleStructs(lines):
+class StructStage(PreprocessorStage):
 	structSyntax = "\&"
-	structs = []
-
-	def findStructs():
-		""" Find all the struct blocks and build struct objects of them. """
-		isCurrentlyInAStructBlock = False
-		for lineIdx in range(len(lines)):
-			line = lines[lineIdx].command.strip()
-
-			# Find the start of a struct block
-			if line.startswith("struct"):
-				m = re.search(r"^struct\s+%s$" % variableNameRe, line)
-				if m:
-					structObj = Struct(m.group("name"))
-					if isCurrentlyInAStructBlock:
-						raise ksp_compiler.ParseException(lines[lineIdx], "Struct definitions cannot be nested.\n")
-					isCurrentlyInAStructBlock = True
-					lines[lineIdx].command = ""
-
-			# Find the end of a struct block
-			elif line.startswith("end"):
-				if re.search(r"^end\s+struct$", line):
-					isCurrentlyInAStructBlock = False
-					structs.append(structObj)
+	structStartRe = re.compile(r"^struct\s+%s$" % variableNameRe)
+	structEndRe = re.compile(r"^end\s+struct$")
+	structTypeRe = re.compile(r"%s\s*%s" % (structSyntax, variableNameRe))
+	structMemberRe = re.compile(r"^([^%s]+\.)?%s\s*%s\s+%s" % (structSyntax, structSyntax, variableNameUnRe, variableNameUnRe))
+	structDeclareRe = re.compile(r"^declare\s+%s\s*%s\s+%s(?:\[(.*)\])?$" % (structSyntax, variableNameUnRe, variableNameUnRe))
+	needsPrescan = True
+
+	def prescan(self, lines):
+		structs = []
+
+		def findStructs():
+			""" Find all the struct blocks and build struct objects of them. """
+			isCurrentlyInAStructBlock = False
+			for lineIdx in range(len(lines)):
+				line = lines[lineIdx].command.strip()
+
+				# Find the start of a struct block
+				if line.startswith("struct"):
+					m = self.structStartRe.search(line)
+					if m:
+						structObj = Struct(m.group("name"))
+						if isCurrentlyInAStructBlock:
+							raise ksp_compiler.ParseException(lines[lineIdx], "Struct definitions cannot be nested.\n")
+						isCurrentlyInAStructBlock = True
+						lines[lineIdx].command = ""
+
+				# Find the end of a struct block
+				elif line.startswith("end"):
+					if self.structEndRe.search(line):
+						isCurrentlyInAStructBlock = False
+						structs.append(structObj)
+						lines[lineIdx].command = ""
+
+				# If in a struct, add each member as an object to the struct
+				elif isCurrentlyInAStructBlock:
+					if line:
+						if not line.startswith("declare ") and not line.startswith("declare	"):
+							raise ksp_compiler.ParseException(lines[lineIdx], "Structs may only consist of variable declarations.\n")
+						m = nameInDeclareStmtRe.search(line)
+						if m:
+							variableName = m.group("whole")
+							structDeclMatch = self.structTypeRe.search(line)
+							if structDeclMatch:
+								variableName = "%s%s %s" % ("&", structDeclMatch.group("whole"), variableName)
+						prefixSymbol = ""
+						if varPrefixCharRe.match(variableName):
+							prefixSymbol = variableName[:1]
+							variableName = variableName[1:]
+						structObj.addMember(StructMember(variableName, line.replace("%s%s" % (prefixSymbol, variableName), variableName), prefixSymbol))
 					lines[lineIdx].command = ""
+		findStructs()
 
-			# If in a struct, add each member as an object to the struct
-			elif isCurrentlyInAStructBlock:
-				if line:
-					if not line.startswith("declare ") and not line.startswith("declare	"):
-						raise ksp_compiler.ParseException(lines[lineIdx], "Structs may only consist of variable declarations.\n")
-					m = re.search(nameInDeclareStmtRe, line)
-					if m:
-						variableName = m.group("whole")
-						structDeclMatch = re.search(r"\&\s*%s" % variableNameRe, line)
-						if structDeclMatch:
-							variableName = "%s%s %s" % ("&", structDeclMatch.group("whole"), variableName)
-					prefixSymbol = ""
-					if re.match(varPrefixRe, variableName):
-						prefixSymbol = variableName[:1]
-						variableName = variableName[1:]
-					structObj.addMember(StructMember(variableName, line.replace("%s%s" % (prefixSymbol, variableName), variableName), prefixSymbol))
-				lines[lineIdx].command = ""
-	findStructs()
-
-	if structs:
 		# Make the struct names a list so they are easily searchable
 		structNames = [structs[i].name for i in range(len(structs))]
 
@@ -236,7 +444,7 @@ def handleStructs(lines):
 				stillRemainginStructs = False
 				# Struct member may themselves have struct members, so this is looped until it is fully resolved.
 				while j < len(structs[i].members) or stillRemainginStructs == True:
-					m = re.search(r"^([^%s]+\.)?%s\s*%s\s+%s" % (structSyntax, structSyntax, variableNameUnRe, variableNameUnRe), structs[i].members[j].name)
+					m = self.structMemberRe.search(structs[i].members[j].name)
 					if m:
 						structs[i].deleteMember(j)
 						structNum = structNames.index(m.group(2))
@@ -250,13 +458,13 @@ def handleStructs(lines):
 						for memberIdx in range(len(structs[structNum].members)):
 							structMember = structs[structNum].members[memberIdx]
 							varName = structVariable + "." + structMember.name
-							newCommand = re.sub(r"\b%s\b" % structMember.name, varName, structMember.command)
+							newCommand = wholeWordRe(structMember.name).sub(varName, structMember.command)
 							structs[i].insertMember(insertLocation, StructMember(varName, newCommand, structMember.prefix))
 							insertLocation += 1
 
 						# If there are still any struct member declarations, keep looping to resolve them.
 						for name in structs[i].members[j].name:
-							mm = re.search(r"^(?:[^%s]+\.)?%s\s*%s\s+%s" % (structSyntax, structSyntax, variableNameUnRe, variableNameUnRe), name)
+							mm = self.structMemberRe.search(name)
 							if mm:
 								stillRemainginStructs = True
 					j += 1
@@ -270,53 +478,57 @@ def handleStructs(lines):
 							break
 		resolveStructsWithinStructs()
 
-		def findAndHandleStructInstanceDeclarations():
-			""" Find all places where an instance of a struct has been declared and build the lines necesary. """
-			newLines = collections.deque()
-			for i in range(len(lines)):
-				line = lines[i].command.strip()
-				m = re.search(r"^declare\s+%s\s*%s\s+%s(?:\[(.*)\])?$" % (structSyntax, variableNameUnRe, variableNameUnRe), line)
-				if m:
-					structName = m.group(1)
-					declaredName = m.group(4)
-					try:
-						structIdx = structNames.index(structName)
-					except ValueError:
-						raise ksp_compiler.ParseException(lines[i], "Undeclared struct %s\n" % structName)
-
-					newMembers = copy.deepcopy(structs[structIdx].members)
-					# If necessary make the struct members into arrays.
-					arrayNumElements = m.group(7)
-					if arrayNumElements:
-						for j in range(len(newMembers)):
-							newMembers[j].makeMemberAnArray(arrayNumElements)
-						if "," in arrayNumElements:
-							arrayNumElements = ksp_compiler.split_args(arrayNumElements, lines[i])
-							for dimIdx in range(len(arrayNumElements)):
-								newLines.append(lines[i].copy("declare const %s.SIZE_D%d := %s" % (declaredName, dimIdx + 1, arrayNumElements[dimIdx])))
-						else:
-							newLines.append(lines[i].copy("declare const %s.SIZE := %s" % (declaredName, arrayNumElements)))
-
-					# Add the declared names as a prefix and add the memebers to the newLines deque
-					for j in range(len(newMembers)):
-						newMembers[j].addNamePrefix(declaredName)
-						newLines.append(lines[i].copy(newMembers[j].command))
-				else:
-					newLines.append(lines[i])
+		self.structs = structs
+		self.structNames = structNames
+		# Struct instances only need to be looked for if there are any structs.
+		if structs:
+			self.keywords = ("declare",)
+
+	def process(self, line, text, keyword):
+		""" Find the places where an instance of a struct has been declared and build the lines necesary. """
+		m = self.structDeclareRe.search(text)
+		if not m:
+			return None
+		newLines = []
+		structName = m.group(1)
+		declaredName = m.group(4)
+		try:
+			structIdx = self.structNames.index(structName)
+		except ValueError:
+			raise ksp_compiler.ParseException(line, "Undeclared struct %s\n" % structName)
+
+		newMembers = copy.deepcopy(self.structs[structIdx].members)
+		# If necessary make the struct members into arrays.
+		arrayNumElements = m.group(7)
+		if arrayNumElements:
+			for j in range(len(newMembers)):
+				newMembers[j].makeMemberAnArray(arrayNumElements)
+			if "," in arrayNumElements:
+				arrayNumElements = ksp_compiler.split_args(arrayNumElements, line)
+				for dimIdx in range(len(arrayNumElements)):
+					newLines.append(line.copy("declare const %s.SIZE_D%d := %s" % (declaredName, dimIdx + 1, arrayNumElements[dimIdx])))
+			else:
+				newLines.append(line.copy("declare const %s.SIZE := %s" % (declaredName, arrayNumElements)))
 
-			replaceLines(lines, newLines)
-		findAndHandleStructInstanceDeclarations()
+		# Add the declared names as a prefix and add the memebers to the newLines
+		for j in range(len(newMembers)):
+			newMembers[j].addNamePrefix(declaredName)
+			newLines.append(line.copy(newMembers[j].command))
+		return newLines
 
 #=================================================================================================
 # Remove print functions when the activate_logger() is not present.
+activateLoggerRe = re.compile(r"^activate_logger\s*\(")
+printRe = re.compile(r"^print\s*\(")
+
 def removeActivateLoggerPrint(lines):
 	printLineNumbers = []
 	loggerActiveFlag = False
 	for i in range(len(lines)):
 		line = lines[i].command.strip()
-		if re.search(r"^activate_logger\s*\(", line):
+		if activateLoggerRe.search(line):
 			loggerActiveFlag = True
-		if re.search(r"^print\s*\(", line):
+		if printRe.search(line):
 			printLineNumbers.append(i)
 
 	if not loggerActiveFlag:
@@ -332,29 +544,74 @@ class Incrementer(object):
 	def increaseVal(self):
 		self.iterationVal += self.step
 
-def handleIncrementer(lines):
-	iterObjs = []
-	for i in range(len(lines)):
-		line = lines[i].command.strip()
+class IncrementerStage(PreprocessorStage):
+	keywords = ("START_INC", "END_INC")
+	startIncRe = re.compile(r"^%s\s*\(\s*%s\s*\,\s*(.+)s*\,\s*(.+)\s*\)" % ("START_INC", variableNameUnRe))
+	wordRe = re.compile(r"\w+")
+	# Names that are whole words are looked up among the words of each line. The others (with a prefix symbol or a dot, or only
+	# digits which could be the values of other incrementers) are searched for with a pattern, as they always have been.
+	wordNameRe = re.compile(r"\w*[^\W\d]\w*$")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.iterObjs = []
+		self.activeWords = {} # For each name that is a word, the active incrementers with that name (outermost first).
+		self.numActivePatterns = 0 # The number of active incrementers whose names are not words.
+
+	def process(self, line, text, keyword):
+		iterObjs = self.iterObjs
 		# Check for START_INC and add the object to the array.
-		if line.startswith("START_INC"):
-			mm = re.search(r"^%s\s*\(\s*%s\s*\,\s*(.+)s*\,\s*(.+)\s*\)" % ("START_INC", variableNameUnRe), line)
+		if keyword.startswith("START_INC"):
+			mm = self.startIncRe.search(text)
 			if mm:
-				lines[i].command = ""
-				iterObjs.append(Incrementer(mm.group(1), tryStringEval(mm.group(4), lines[i], "start"), tryStringEval(mm.group(5), lines[i], "step")))
+				line.command = ""
+				iterationObj = Incrementer(mm.group(1), tryStringEval(mm.group(4), line, "start"), tryStringEval(mm.group(5), line, "step"))
+				iterObjs.append(iterationObj)
+				if self.wordNameRe.match(iterationObj.name):
+					self.activeWords.setdefault(iterationObj.name, []).append(iterationObj)
+				else:
+					self.numActivePatterns += 1
 			else:
-				raise ksp_compiler.ParseException(lines[i], "Incorrect parameters. Expected: START_INC(<name>, <start-num>, <step-num>)\n")
+				raise ksp_compiler.ParseException(line, "Incorrect parameters. Expected: START_INC(<name>, <start-num>, <step-num>)\n")
 		# If any incremeter has ended, pop the last object off the array.
-		elif line == "END_INC":
-			lines[i].command = ""
-			iterObjs.pop()
+		elif text == "END_INC":
+			line.command = ""
+			iterationObj = iterObjs.pop()
+			if self.wordNameRe.match(iterationObj.name):
+				sameName = self.activeWords[iterationObj.name]
+				sameName.pop()
+				if not sameName:
+					del self.activeWords[iterationObj.name]
+			else:
+				self.numActivePatterns -= 1
 		# If there are any iterators active, scan the line and replace occurances of the name with it's value.
 		elif iterObjs:
-			for iterationObj in iterObjs:
-				mm = re.search(r"\b%s\b" % iterationObj.name, line)
-				if mm:
-					lines[i].command = re.sub(r"\b%s\b" % iterationObj.name, str(iterationObj.iterationVal), lines[i].command)
-					iterationObj.increaseVal()
+			command = line.command
+			if self.numActivePatterns:
+				for iterationObj in iterObjs:
+					nameRe = wholeWordRe(iterationObj.name)
+					if nameRe.search(text):
+						line.command = nameRe.sub(str(iterationObj.iterationVal), line.command)
+						iterationObj.increaseVal()
+			else:
+				# Each incrementer whose name is a word of the line is increased once, and the occurances of the name are replaced
+				# by the value of the outermost one, as the inner ones with the same name find nothing left to replace.
+				values = {}
+				for word in set(self.wordRe.findall(text)):
+					sameName = self.activeWords.get(word)
+					if sameName:
+						values[word] = str(sameName[0].iterationVal)
+						for iterationObj in sameName:
+							iterationObj.increaseVal()
+				if values:
+					line.command = self.wordRe.sub(lambda m: values.get(m.group(0), m.group(0)), command)
+			if line.command == command:
+				return None
+		else:
+			return None
+		# While any incrementer is active every line needs to be scanned.
+		self.allLines = len(iterObjs) != 0
+		return [line]
 
 #=================================================================================================
 class ArrayConcat(object):
@@ -366,33 +623,25 @@ class ArrayConcat(object):
 		self.brackets = brackets
 		self.arraysToConcat = arraysToConcat.split(",")
 
-	def checkArraySize(self, origLineIdx, lines):
-		""" If the concat function is used on a declared empty size array, the size of the array needs to be calculated. """
+	def checkArraySize(self, arrays):
+		""" If the concat function is used on a declared empty size array, the size of the array is the total of the sizes
+		of the arrays to concatenate, which are looked up in arrays (an ArrayDeclarationIndex of the arrays declared before
+		the concat). """
 		if self.declare:
 			if not self.brackets:
 				raise ksp_compiler.ParseException(self.line, "No array size given. Leave brackets [] empty to have the size auto generated.\n")
 			elif not self.size:
-				def findArrays():
-					""" Scan through the lines up to this point to find all the the arrays that have been chosen to be concatenated,
-					and from these add their number of elements to determine the total size needed. """
-					sizes = []
-					arrayNameList = list(self.arraysToConcat)
-					for i in range(origLineIdx):
-						lineText = lines[i].command.strip()
-						if lineText.startswith("declare"):
-							for arr in arrayNameList:
-								try: # The regex doesn't like it when there are [] or () in the arr list.
-									mm = re.search(r"^declare\s+%s?%s\s*(\[.*\])" % (varPrefixRe, arr.strip()), lineText)
-									if mm:
-										sizes.append(mm.group(1))
-										arrayNameList.remove(arr)
-										break
-								except:
-									raise ksp_compiler.ParseException(lines[i], "Syntax error.\n")
-					if arrayNameList:  # If everything was found, then the list will be empty.
-						raise ksp_compiler.ParseException(self.line, "Undeclared array(s) in %s function: %s\n" % (concatSyntax, ', '.join(arrayNameList).strip()))
-					return(simplfyAdditionString(re.sub(r"[\[\]]", "", '+'.join(sizes))))
-				self.size = findArrays()
+				sizes = []
+				undeclared = []
+				for arr in self.arraysToConcat:
+					declaration = arrays.find(varPrefixCharRe.sub("", arr.strip()))
+					if declaration:
+						sizes.append(declaration.size)
+					else:
+						undeclared.append(arr)
+				if undeclared:
+					raise ksp_compiler.ParseException(self.line, "Undeclared array(s) in %s function: %s\n" % (concatSyntax, ', '.join(undeclared).strip()))
+				self.size = simplfyAdditionString('+'.join(sizes))
 
 	def getRawArrayDeclaration(self):
 		""" Return the command that should replace line that triggered the concat. """
@@ -424,29 +673,34 @@ class ArrayConcat(object):
 				newLines.append(self.line.copy(text.replace("#arg#", self.arraysToConcat[j]).replace("#parent#", self.arrayToFill)))
 		return(newLines)
 
-def handleArrayConcat(lines):
-	arrayConcatRe = r"(?P<declare>^\s*declare\s+)?%s\s*(?P<brackets>\[(?P<arraysize>.*)\])?\s*:=\s*%s\s*\((?P<arraylist>[^\)]*)" % (variableNameRe, concatSyntax)
-	newLines = collections.deque()
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if "concat" in line:
-			m = re.search(arrayConcatRe, line)
+class ArrayConcatStage(PreprocessorStage):
+	arrayConcatRe = re.compile(r"(?P<declare>^\s*declare\s+)?%s\s*(?P<brackets>\[(?P<arraysize>.*)\])?\s*:=\s*%s\s*\((?P<arraylist>[^\)]*)" % (variableNameRe, concatSyntax))
+	keywords = ("on", "declare")
+	containing = "concat" # The concat function can be anywhere in the line.
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.arrays = ArrayDeclarationIndex() # Of the declare lines passed to the stage so far, arrays declared later can't be concatenated.
+
+	def process(self, line, text, keyword):
+		if "concat" in text:
+			m = self.arrayConcatRe.search(text)
 			if m:
-				concatObj = ArrayConcat(m.group("whole"), m.group("declare"), m.group("brackets"), m.group("arraysize"), m.group("arraylist"), lines[lineIdx])
-				concatObj.checkArraySize(lineIdx, lines)
+				newLines = []
+				concatObj = ArrayConcat(m.group("whole"), m.group("declare"), m.group("brackets"), m.group("arraysize"), m.group("arraylist"), line)
+				concatObj.checkArraySize(self.arrays)
 				if m.group("declare"):
-					newLines.append(lines[lineIdx].copy(concatObj.getRawArrayDeclaration()))
+					newLines.append(line.copy(concatObj.getRawArrayDeclaration()))
+					self.arrays.add(newLines[0])
 				newLines.extend(concatObj.buildLines())
-				continue
+				return newLines
 		# The variables needed are declared at the start of the init callback.
-		elif line.startswith("on"):
-			if re.search(initRe, line):
-				newLines.append(lines[lineIdx])
-				newLines.append(lines[lineIdx].copy("declare concat_it"))
-				newLines.append(lines[lineIdx].copy("declare concat_offset"))
-				continue
-		newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
+		if keyword.startswith("on"):
+			if initRe.search(text):
+				return [line, line.copy("declare concat_it"), line.copy("declare concat_offset")]
+		elif keyword.startswith("declare"):
+			self.arrays.add(line)
+		return None
 
 #=================================================================================================
 class MultiDimensionalArray(object):
@@ -505,49 +759,48 @@ class MultiDimensionalArray(object):
 		return(newLines)
 
 # TODO: Check whether making this only init callback is ok.
-def handleMultidimensionalArrays(lines):
+class MultidimensionalArrayStage(PreprocessorStage):
 	multipleDimensionsRe = r"\[(?P<dimensions>[^\]]+(?:\,[^\]]+)+)\]" # Match square brackets with 2 or more comma separated dimensions.
-	multidimensionalArrayRe = r"^declare\s+%s%s\s*%s(?P<assignment>\s*:=.+)?$" % (persistenceRe, variableNameRe, multipleDimensionsRe)
-
-	newLines = collections.deque()
-	famCount = 0
-	initFlag = False
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if not initFlag:
-			if re.search(initRe, line):
-				initFlag = True
-			newLines.append(lines[lineIdx])
-		else: # Multidimensional arrays are only allowed in the init callback.
-			if re.search(endOnRe, line):
-				newLines.extend(lines[lineIdx:])
-				break
+	multidimensionalArrayRe = re.compile(r"^declare\s+%s%s\s*%s(?P<assignment>\s*:=.+)?$" % (persistenceRe, variableNameRe, multipleDimensionsRe))
+	keywords = ("on", "end", "family", "declare")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.famCount = 0
+		self.initFlag = False
+		self.initEnded = False
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		if not self.initFlag:
+			if initRe.search(text):
+				self.initFlag = True
+		elif not self.initEnded: # Multidimensional arrays are only allowed in the init callback.
+			if endOnRe.search(text):
+				self.initEnded = True
 			else:
 				# If a multidim array is found, if necessary the family prefix is added and the lines needed for the property are added.
-				famCount = countFamily(line, famCount)
-				if line.startswith("declare"):
-					m = re.search(multidimensionalArrayRe, line)
+				self.famCount = countFamily(text, self.famCount)
+				if keyword.startswith("declare") and "," in text:
+					m = self.multidimensionalArrayRe.search(text)
 					if m:
 						famPrefix = ""
-						if famCount != 0:
-							famPrefix = inspectFamilyState(lines, lineIdx)
+						if self.famCount != 0:
+							famPrefix = self.getFamilyPrefix()
 						name = m.group("name")
 						# if m.group("uiArray"):
 						# 	name = name[1:] # If it is a UI array, the single dimension array will already have the underscore, so it is removed.
-						multiDim = MultiDimensionalArray(name, m.group("prefix"), m.group("dimensions"), m.group("persistence"), m.group("assignment"), famPrefix, lines[lineIdx])
-						newLines.append(lines[lineIdx].copy(multiDim.getRawArrayDeclaration()))
-						newLines.extend(multiDim.buildPropertyAndConstants(lines[lineIdx]))
-					else:
-						newLines.append(lines[lineIdx])
-				else:
-					newLines.append(lines[lineIdx])
-
-	replaceLines(lines, newLines)
+						multiDim = MultiDimensionalArray(name, m.group("prefix"), m.group("dimensions"), m.group("persistence"), m.group("assignment"), famPrefix, line)
+						newLines = [line.copy(multiDim.getRawArrayDeclaration())]
+						newLines.extend(multiDim.buildPropertyAndConstants(line))
+						return newLines
+		return None
 
 #===========================================================================================
 class UIPropertyTemplate:
 	def __init__(self, name, argString):
 		self.name = name
+		self.nameRe = re.compile(r"^%s\b" % name)
 		self.args = argString.replace(" ", "").split(",")
 
 class UIPropertyFunction:
@@ -567,7 +820,7 @@ class UIPropertyFunction:
 			newLines.append(line.copy("%s -> %s := %s" % (self.uiId, self.functionType.args[argNum], self.args[argNum])))
 		return(newLines)
 
-def handleUIFunctions(lines):
+class UIFunctionStage(PreprocessorStage):
 	# Templates for the functions. Note the ui-id as the first arg and the functions start
 	# with'set_' is assumed to be true later on.
 	uiControlPropertyFunctionTemplates = [
@@ -585,46 +838,48 @@ def handleUIFunctions(lines):
 	"set_waveform_properties(ui-id, bar_color, zero_line_color, bg_color, bg_alpha, wave_color, wave_cursor_color, slicemarkers_color, wf_vis_mode)",
 	"set_wavetable2d_properties(ui-id, wt_zone, bg_color, bg_alpha, wave_color, wave_alpha, wave_end_color, wave_end_alpha)",
 	"set_wavetable3d_properties(ui-id, wt_zone, bg_color, bg_alpha, wavetable_color, wavetable_alpha, wavetable_end_color, wavetable_end_alpha, parallax_x, parallax_y)" ]
-
-	# Use the template string above to build a list of UIProperyTemplate objects.
-	uiFuncs = []
-	for funcTemplate in uiControlPropertyFunctionTemplates:
-		m = re.search(r"^(?P<name>[^\(]+)\(ui-id,(?P<args>[^\)]+)", funcTemplate)
-		uiFuncs.append(UIPropertyTemplate(m.group("name"), m.group("args")))
-
-	newLines = collections.deque()
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		foundProp = False
-		if line.startswith("set_"):
-			for func in uiFuncs:
-				if re.search(r"^%s\b" % func.name, line):
-					foundProp = True
-					paramString = line[line.find("(") + 1 : len(line) - 1].strip()
-					paramList = ksp_compiler.split_args(paramString, lines[lineIdx]) #re.split(commas_not_in_parenth, paramString)
-					uiPropertyObj = UIPropertyFunction(func, paramList, lines[lineIdx])
-					newLines.extend(uiPropertyObj.buildUiPropertyLines(lines[lineIdx]))
-					break
-		if not foundProp:
-			newLines.append(lines[lineIdx])
-
-	replaceLines(lines, newLines)
+	keywords = ("set_",)
+	templateRe = re.compile(r"^(?P<name>[^\(]+)\(ui-id,(?P<args>[^\)]+)")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		# Use the template string above to build a list of UIProperyTemplate objects.
+		self.uiFuncs = []
+		for funcTemplate in self.uiControlPropertyFunctionTemplates:
+			m = self.templateRe.search(funcTemplate)
+			self.uiFuncs.append(UIPropertyTemplate(m.group("name"), m.group("args")))
+
+	def process(self, line, text, keyword):
+		for func in self.uiFuncs:
+			if func.nameRe.search(text):
+				paramString = text[text.find("(") + 1 : len(text) - 1].strip()
+				paramList = ksp_compiler.split_args(paramString, line) #re.split(commas_not_in_parenth, paramString)
+				uiPropertyObj = UIPropertyFunction(func, paramList, line)
+				return uiPropertyObj.buildUiPropertyLines(line)
+		return None
 
 #=================================================================================================
-def handleSameLineDeclaration(lines):
+class SameLineDeclarationStage(PreprocessorStage):
 	""" When a variable is declared and initialised on the same line, check to see if the value needs to be
 	moved over to the next line. """
-	newLines = collections.deque()
-	famCount = 0
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		famCount = countFamily(line, famCount)
-		if line.startswith("declare"):
-			m = re.search(r"^declare\s+(?:(polyphonic|global|local)\s+)*%s%s\s*:=" % (persistenceRe, variableNameRe), line)
-			if m and not re.search(r"\b%s\s*\(" % concatSyntax, line):
+	keywords = ("declare", "family", "end")
+	assignedDeclarationRe = re.compile(r"^declare\s+(?:(polyphonic|global|local)\s+)*%s%s\s*:=" % (persistenceRe, variableNameRe))
+	concatCallRe = re.compile(r"\b%s\s*\(" % concatSyntax)
+	containsStringRe = re.compile(stringOrPlaceholderRe)
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.famCount = 0
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		self.famCount = countFamily(text, self.famCount)
+		if keyword.startswith("declare") and ":=" in text:
+			m = self.assignedDeclarationRe.search(text)
+			if m and not self.concatCallRe.search(text):
 				valueIsConstantInteger = False
-				value = line[line.find(":=") + 2 :]
-				if not re.search(stringOrPlaceholderRe, line):
+				value = text[text.find(":=") + 2 :]
+				if not self.containsStringRe.search(text):
 					try:
 						# Ideally this would check to see if the value is a Kontakt constant as those are valid
 						# inline as well...
@@ -634,15 +889,12 @@ def handleSameLineDeclaration(lines):
 						pass
 
 				if not valueIsConstantInteger:
-					preAssignmentText = line[: line.find(":=")]
+					preAssignmentText = text[: text.find(":=")]
 					variableName = m.group("name")
-					if famCount != 0:
-						variableName = inspectFamilyState(lines, lineIdx) + variableName
-					newLines.append(lines[lineIdx].copy(preAssignmentText))
-					newLines.append(lines[lineIdx].copy(variableName + " " + line[line.find(":=") :]))
-					continue
-		newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
+					if self.famCount != 0:
+						variableName = self.getFamilyPrefix() + variableName
+					return [line.copy(preAssignmentText), line.copy(variableName + " " + text[text.find(":=") :])]
+		return None
 
 #=================================================================================================
 class ConstBlock(object):
@@ -671,37 +923,38 @@ class ConstBlock(object):
 			newLines.append(line.copy("declare const %s.%s := %s" % (self.name, self.memberNames[memNum], self.memberValues[memNum])))
 		return(newLines)
 
-def handleConstBlock(lines):
-	constBlockStartRe = r"^const\s+%s$" % variableNameRe
-	constBlockEndRe = r"^end\s+const$"
-	constBlockMemberRe = r"^%s(?:$|\s*\:=\s*(?P<value>.+))" % variableNameRe
+class ConstBlockStage(PreprocessorStage):
+	constBlockStartRe = re.compile(r"^const\s+%s$" % variableNameRe)
+	constBlockEndRe = re.compile(r"^end\s+const$")
+	constBlockMemberRe = re.compile(r"^%s(?:$|\s*\:=\s*(?P<value>.+))" % variableNameRe)
+	keywords = ("const", "end")
 
-	newLines = collections.deque()
-	constBlockObj = None
-	inConstBlock = False
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if line.startswith("const"):
-			m = re.search(constBlockStartRe, line)
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.constBlockObj = None
+
+	def process(self, line, text, keyword):
+		if keyword.startswith("const"):
+			m = self.constBlockStartRe.search(text)
 			if m:
-				constBlockObj = ConstBlock(m.group("name"))
-				inConstBlock = True
-				continue
-		elif line.startswith("end"):
-			if re.search(constBlockEndRe, line):
-				if constBlockObj.memberValues:
-					newLines.extend(constBlockObj.buildLines(lines[lineIdx]))
-				inConstBlock = False
-				continue
-		elif inConstBlock:
-			m = re.search(constBlockMemberRe, line)
+				self.constBlockObj = ConstBlock(m.group("name"))
+				self.allLines = True # Every line is a member until the end of the block.
+				return []
+		elif keyword.startswith("end"):
+			if self.constBlockEndRe.search(text):
+				newLines = []
+				if self.constBlockObj.memberValues:
+					newLines.extend(self.constBlockObj.buildLines(line))
+				self.allLines = False
+				return newLines
+		elif self.allLines:
+			m = self.constBlockMemberRe.search(text)
 			if m:
-				constBlockObj.addMember(m.group("whole"), m.group("value"))
-				continue
-			elif not line.strip() == "":
-				raise ksp_compiler.ParseException(lines[lineIdx], "Incorrect syntax. In a const block, list constant names and optionally assign them a constant value.")
-		newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
+				self.constBlockObj.addMember(m.group("whole"), m.group("value"))
+				return []
+			elif not text.strip() == "":
+				raise ksp_compiler.ParseException(line, "Incorrect syntax. In a const block, list constant names and optionally assign them a constant value.")
+		return None
 
 #=================================================================================================
 class ListBlock(object):
@@ -732,29 +985,30 @@ class ListBlock(object):
 			newLines.append(line.copy("list_add(%s, %s)" % (self.name, memberName)))
 		return(newLines)
 
-def handleListBlocks(lines):
-	listBlockStartRe = r"^list\s*%s\s*(?:\[(?P<size>%s)?\])?$" % (variableNameRe, variableOrInt)
-	listBlockEndRe = r"^end\s+list$"
-	newLines = collections.deque()
-	listBlockObj = None
-	isListBlock = False
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		m = re.search(listBlockStartRe, line)
+class ListBlockStage(PreprocessorStage):
+	listBlockStartRe = re.compile(r"^list\s*%s\s*(?:\[(?P<size>%s)?\])?$" % (variableNameRe, variableOrInt))
+	listBlockEndRe = re.compile(r"^end\s+list$")
+	keywords = ("list",)
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.listBlockObj = None
+
+	def process(self, line, text, keyword):
+		m = self.listBlockStartRe.search(text)
 		if m:
-			isListBlock = True
-			listBlockObj = ListBlock(m.group("whole"), m.group("size"))
-		elif isListBlock and not line == "":
-			if re.search(listBlockEndRe, line):
-				isListBlock = False
-				if listBlockObj.members:
-					newLines.extend(listBlockObj.buildLines(lines[lineIdx]))
+			self.allLines = True # Every line is a member until the end of the block.
+			self.listBlockObj = ListBlock(m.group("whole"), m.group("size"))
+			return []
+		elif self.allLines and not text == "":
+			if self.listBlockEndRe.search(text):
+				self.allLines = False
+				if self.listBlockObj.members:
+					return list(self.listBlockObj.buildLines(line))
 			else:
-				listBlockObj.addMember(line)
-		else:
-			newLines.append(lines[lineIdx])
-
-	replaceLines(lines, newLines)
+				self.listBlockObj.addMember(text)
+			return []
+		return None
 
 #=================================================================================================
 class List(object):
@@ -833,236 +1087,214 @@ class List(object):
 		return(newLines)
 
 
-def handleLists(lines):
-	def findAllArrays(lines):
-		""" Scan the all the lines and store arrays and their sizes. """
-		arrayNames = []
-		arraySizes = []
-		initFlag = False
-		for i in range(len(lines)):
-			line = lines[i].command.strip()
-			if initFlag == False:
-				if line.startswith("on"):
-					if re.search(initRe, line):
-						initFlag = True
-			else:
-				if line.startswith("end"):
-					if re.search(endOnRe, line):
-						break
-				if line.startswith("declare"):
-					m = re.search(r"^declare\s+%s%s\s*(?:\[(%s)\])" % (persistenceRe, variableNameUnRe, variableOrInt), line)
-					if m:
-						arrayNames.append(re.sub(varPrefixRe, "", m.group(2)))
-						arraySizes.append(m.group(5))
-		return (arrayNames, arraySizes)
-	# The names and sizes are needed because the multidimensional lists need to use the sizes to calculate the total.
-	arrayNames, arraySizes = findAllArrays(lines)
-
-	newLines = collections.deque()
-	lists = {} # The list names and list objects are stored in a dict for quick searching.
-	listAddRe = r"^list_add\s*\(\s*%s\s*,(?P<value>.+)\)$" % variableNameRe
-	listDeclareRe = r"^\s*declare\s+%slist\s*%s\s*(?:\[(?P<size>[^\]]+)?\])?" % (persistenceRe, variableNameRe)
+class ListStage(PreprocessorStage):
+	listAddRe = re.compile(r"^list_add\s*\(\s*%s\s*,(?P<value>.+)\)$" % variableNameRe)
+	listDeclareRe = re.compile(r"^\s*declare\s+%slist\s*%s\s*(?:\[(?P<size>[^\]]+)?\])?" % (persistenceRe, variableNameRe))
 	listDeclareTag = "LIST=>" # A tag is left on the list declaration lines as these need to be resolved at the end.
-	isInInit = False
-	preInit = True
-	addInitVar = False
-	loopBlockCounter = 0
-	famCount = 0
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if isInInit == False:
-			if preInit:
-				if line.startswith("on"):
-					if re.search(initRe, line):
-						preInit = False
-						isInInit = True
+	keywords = ("on", "list_add", "end", "for", "while", "if", "family", "declare")
+	needsFinish = True
+	needsArrays = True # The arrays added to multidimensional lists are looked up for their sizes.
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.lists = {} # The list names and list objects are stored in a dict for quick searching.
+		self.isInInit = False
+		self.preInit = True
+		self.loopBlockCounter = 0
+		self.famCount = 0
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		if self.isInInit == False:
+			addInitVar = False
+			if self.preInit:
+				if keyword.startswith("on"):
+					if initRe.search(text):
+						self.preInit = False
+						self.isInInit = True
 						addInitVar = True
-			if line.startswith("list_add"):
-				if re.search(listAddRe, line):
-					raise ksp_compiler.ParseException(lines[lineIdx], "list_add() can only be used in the init callback.\n")
-			newLines.append(lines[lineIdx])
+			if keyword.startswith("list_add"):
+				if self.listAddRe.search(text):
+					raise ksp_compiler.ParseException(line, "list_add() can only be used in the init callback.\n")
 			if addInitVar:
-				newLines.append(lines[lineIdx].copy("declare list_it"))
-				addInitVar = False
-			continue
-		else:
-			# Check for the end of the init callback
-			if line.startswith("end"):
-				if re.search(endOnRe, line):
-					isInInit = False
-					newLines.append(lines[lineIdx])
-					continue
-
-			def findLoop(lineText, loopCount):
-				""" Check for any fors, whiles or ifs. This is layed out in this fashion for speed reasons. """
-				startVal = loopCount
-				if lineText.startswith("for"):
-					if re.search(forRe, lineText):
-						loopCount += 1
-				elif lineText.startswith("while"):
-					if re.search(whileRe, lineText):
-						loopCount += 1
-				elif lineText.startswith("if"):
-					if re.search(ifRe, lineText):
-						loopCount += 1
-				elif loopCount != 0:
-					if lineText.startswith("end"):
-						if re.search(endForRe, lineText):
-							loopCount -= 1
-						elif re.search(endIfRe, lineText):
-							loopCount -= 1
-						elif re.search(endWhileRe, lineText):
-							loopCount -= 1
-				return(loopCount, startVal != loopCount)
-			shouldExit = False
-			loopBlockCounter, shouldExit = findLoop(line, loopBlockCounter)
-			if shouldExit:
-				newLines.append(lines[lineIdx])
-				continue
-
-			famCount = countFamily(line, famCount)
-			# Check for a list declaration
-			if line.startswith("declare"):
-				m = re.search(listDeclareRe, line)
-				if m:
-					name = m.group("name")
-					famPre = ""
-					if famCount != 0:
-						famPre = inspectFamilyState(lines, lineIdx)
-					isMatrix = False
-					if m.group("size"):
-						isMatrix = "," in m.group("size")
-					listObj = List(name, m.group("prefix"), m.group("persistence"), isMatrix, famPre)
-					name = "%s%s" % (famPre, name)
-					lists[name] = listObj
-					newLines.append(lines[lineIdx].copy("%s%s" % (listDeclareTag, name))) # Mark this line as we will need to go back and fill in the declaration later.
-					continue
-
-			# Check for a list_add
-			elif line.startswith("list_add"):
-				m = re.search(listAddRe, line)
-				if m:
-					# if loopBlockCounter != 0:
-					# 	raise ksp_compiler.ParseException(lines[lineIdx], "list_add() cannot be used in loops or if statements.\n")
-					name = m.group("name")
-					value = m.group("value").strip()
-					try:
-						listObj = lists[name]
-					except KeyError:
-						raise ksp_compiler.ParseException(lines[lineIdx], "Undeclared list: %s\n" % name)
-					if listObj.isMatrix:
-						try:
-							arrayIdx = arrayNames.index(re.sub(varPrefixRe, "", value))
-							newLines.extend(listObj.getArrayListAddLines(value, lines[lineIdx], arrayNames[arrayIdx], arraySizes[arrayIdx]))
-						except ValueError:
-							newLines.append(listObj.getListAddLine(value, lines[lineIdx]))
-							pass
-					else:
-						newLines.append(listObj.getListAddLine(value, lines[lineIdx]))
-					continue
-		newLines.append(lines[lineIdx])
-
-	# Replace the list declartion tags with the actual values.
-	newerLines = collections.deque()
-	for line in newLines:
-		if line.command.startswith(listDeclareTag):
-			listObj = lists[line.command[len(listDeclareTag) :]]
-			if listObj.inc != "0":
-				newerLines.extend(lists[line.command[len(listDeclareTag) :]].getListDeclaration(line))
-		else:
-			newerLines.append(line)
-
-	replaceLines(lines, newerLines)
+				return [line, line.copy("declare list_it")]
+			return None
+
+		# Check for the end of the init callback
+		if keyword.startswith("end"):
+			if endOnRe.search(text):
+				self.isInInit = False
+				return None
+
+		def findLoop(lineText, loopCount):
+			""" Check for any fors, whiles or ifs. This is layed out in this fashion for speed reasons. """
+			startVal = loopCount
+			if lineText.startswith("for"):
+				if forRe.search(lineText):
+					loopCount += 1
+			elif lineText.startswith("while"):
+				if whileRe.search(lineText):
+					loopCount += 1
+			elif lineText.startswith("if"):
+				if ifRe.search(lineText):
+					loopCount += 1
+			elif loopCount != 0:
+				if lineText.startswith("end"):
+					if endForRe.search(lineText):
+						loopCount -= 1
+					elif endIfRe.search(lineText):
+						loopCount -= 1
+					elif endWhileRe.search(lineText):
+						loopCount -= 1
+			return(loopCount, startVal != loopCount)
+		shouldExit = False
+		self.loopBlockCounter, shouldExit = findLoop(text, self.loopBlockCounter)
+		if shouldExit:
+			return None
+
+		self.famCount = countFamily(text, self.famCount)
+		# Check for a list declaration
+		if keyword.startswith("declare"):
+			m = "list" in text and self.listDeclareRe.search(text)
+			if m:
+				name = m.group("name")
+				famPre = ""
+				if self.famCount != 0:
+					famPre = self.getFamilyPrefix()
+				isMatrix = False
+				if m.group("size"):
+					isMatrix = "," in m.group("size")
+				listObj = List(name, m.group("prefix"), m.group("persistence"), isMatrix, famPre)
+				name = "%s%s" % (famPre, name)
+				self.lists[name] = listObj
+				return [line.copy("%s%s" % (self.listDeclareTag, name))] # Mark this line as we will need to go back and fill in the declaration later.
+
+		# Check for a list_add
+		elif keyword.startswith("list_add"):
+			m = self.listAddRe.search(text)
+			if m:
+				# if loopBlockCounter != 0:
+				# 	raise ksp_compiler.ParseException(line, "list_add() cannot be used in loops or if statements.\n")
+				name = m.group("name")
+				value = m.group("value").strip()
+				try:
+					listObj = self.lists[name]
+				except KeyError:
+					raise ksp_compiler.ParseException(line, "Undeclared list: %s\n" % name)
+				if listObj.isMatrix:
+					declaration = self.arrays.find(varPrefixCharRe.sub("", value), inInit=True)
+					if declaration:
+						return list(listObj.getArrayListAddLines(value, line, declaration.name, declaration.size))
+					return [listObj.getListAddLine(value, line)]
+				else:
+					return [listObj.getListAddLine(value, line)]
+		return None
+
+	def finish(self, lines):
+		# Replace the list declartion tags with the actual values.
+		newLines = []
+		for line in lines:
+			if line.command.startswith(self.listDeclareTag):
+				listObj = self.lists[line.command[len(self.listDeclareTag) :]]
+				if listObj.inc != "0":
+					for newLine in listObj.getListDeclaration(line):
+						self.arrays.add(newLine, True)
+						newLines.append(newLine)
+			else:
+				newLines.append(line)
+		return newLines
 
 #=================================================================================================
-def handleOpenSizeArrays(lines):
+class OpenSizeArrayStage(PreprocessorStage):
 	""" When an array size is left with an open number of elements, use the list of initialisers to provide the array size.
 	Const variables are also generated for the array size. """
-	openArrayRe = r"^\s*declare\s+%s%s\s*\[\s*\]\s*:=\s*\(" % (persistenceRe, variableNameRe)
-	newLines = collections.deque()
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		m = re.search(openArrayRe, line)
+	openArrayRe = re.compile(r"^\s*declare\s+%s%s\s*\[\s*\]\s*:=\s*\(" % (persistenceRe, variableNameRe))
+	keywords = ("declare",)
+
+	def process(self, line, text, keyword):
+		m = "[" in text and self.openArrayRe.search(text)
 		if m:
-			stringList = ksp_compiler.split_args(line[line.find("(") + 1 : len(line) - 1], line)
+			stringList = ksp_compiler.split_args(text[text.find("(") + 1 : len(text) - 1], text)
 			numElements = len(stringList)
 			name = m.group("name")
-			newLines.append(lines[lineIdx].copy(line[: line.find("[") + 1] + str(numElements) + line[line.find("[") + 1 :]))
-			newLines.append(lines[lineIdx].copy("declare const %s.SIZE := %s" % (name, str(numElements))))
-		else:
-			newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
+			return [line.copy(text[: text.find("[") + 1] + str(numElements) + text[text.find("[") + 1 :]),
+				line.copy("declare const %s.SIZE := %s" % (name, str(numElements)))]
+		return None
 
 #=================================================================================================
-def handleStringArrayInitialisation(lines):
+class StringArrayInitialisationStage(PreprocessorStage):
 	""" Convert the single-line list of strings to one string per line for Kontakt to understand. """
-	stringArrayRe = r"^declare\s+%s\s*\[(?P<arraysize>[^\]]+)\]\s*:=\s*\((?P<initlist>.+)\)$" % variableNameRe
-	stringListRe = r"\s*%s(\s*,\s*%s)*\s*" % (stringOrPlaceholderRe, stringOrPlaceholderRe)
-	newLines = collections.deque()
-	famCount = 0
-	for i in range(len(lines)):
-		line = lines[i].command.strip()
-		famCount = countFamily(line, famCount)
-		if line.startswith("on"):
-			if re.search(initRe, line):
-				newLines.append(lines[i])
-				newLines.append(lines[i].copy("declare string_it"))
-				continue
-		if line.startswith("declare"):
-			m = re.search(stringArrayRe, line)
+	stringArrayRe = re.compile(r"^declare\s+%s\s*\[(?P<arraysize>[^\]]+)\]\s*:=\s*\((?P<initlist>.+)\)$" % variableNameRe)
+	stringListRe = re.compile(r"\s*%s(\s*,\s*%s)*\s*" % (stringOrPlaceholderRe, stringOrPlaceholderRe))
+	keywords = ("on", "declare", "family", "end")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.famCount = 0
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		self.famCount = countFamily(text, self.famCount)
+		if keyword.startswith("on"):
+			if initRe.search(text):
+				return [line, line.copy("declare string_it")]
+		if keyword.startswith("declare") and "!" in text:
+			m = self.stringArrayRe.search(text)
 			if m:
 				if m.group("prefix") == "!":
-					if not re.search(stringListRe, m.group("initlist")):
-						raise ksp_compiler.ParseException(lines[i], "Expected integers, got strings.\n")
-					stringList = ksp_compiler.split_args(m.group("initlist"), lines[i])
+					if not self.stringListRe.search(m.group("initlist")):
+						raise ksp_compiler.ParseException(line, "Expected integers, got strings.\n")
+					stringList = ksp_compiler.split_args(m.group("initlist"), line)
 					name = m.group("name")
-					if famCount != 0:
-						name = inspectFamilyState(lines, i) + name
-					newLines.append(lines[i].copy(line[: line.find(":")]))
+					if self.famCount != 0:
+						name = self.getFamilyPrefix() + name
+					newLines = [line.copy(text[: text.find(":")])]
 					if len(stringList) != 1:
 						for ii in range(len(stringList)):
-							newLines.append(lines[i].copy("%s[%s] := %s" % (name, str(ii), stringList[ii])))
+							newLines.append(line.copy("%s[%s] := %s" % (name, str(ii), stringList[ii])))
 					else:
-						newLines.append(lines[i].copy("for string_it := 0 to %s - 1" % m.group("arraysize")))
-						newLines.append(lines[i].copy("%s[string_it] := %s" % (name, "".join(stringList))))
-						newLines.append(lines[i].copy("end for"))
-					continue
-		newLines.append(lines[i])
-	replaceLines(lines, newLines)
+						newLines.append(line.copy("for string_it := 0 to %s - 1" % m.group("arraysize")))
+						newLines.append(line.copy("%s[string_it] := %s" % (name, "".join(stringList))))
+						newLines.append(line.copy("end for"))
+					return newLines
+		return None
 
 #=================================================================================================
-def handlePersistence(lines):
+class PersistenceStage(PreprocessorStage):
 	""" Simple adds make_persistent() or read_perisitent_var() lines when the pers or read keywords are found. """
-	newLines = collections.deque()
-	famCount = 0
-	for i in range(len(lines)):
-		line = lines[i].command.strip()
-		famCount = countFamily(line, famCount)
-		if line.startswith("declare"):
+	keywords = ("declare", "family", "end")
+	persistenceWordRe = re.compile(r"\b(?P<persistence>pers|instpers|read)\b")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.famCount = 0
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		self.famCount = countFamily(text, self.famCount)
+		if keyword.startswith("declare") and ("pers" in text or "read" in text) and not "[[" in text: # UI arrays handle their own persistence.
 			# The name of the variable is assumed to either be the first word before a [ or ( or before the end of the line
-			m = re.search(r"\b(?P<persistence>pers|instpers|read)\b" , line)
+			m = self.persistenceWordRe.search(text)
 			if m:
 				persWord = m.group("persistence")
-				m = re.search(nameInDeclareStmtRe, line)
+				m = nameInDeclareStmtRe.search(text)
 				if m:
 					variableName = m.group("name")
-					if famCount != 0: # Counting the family state is much faster than inspecting on every line.
-						famPre = inspectFamilyState(lines, i)
+					if self.famCount != 0: # Counting the family state is much faster than inspecting on every line.
+						famPre = self.getFamilyPrefix()
 						if famPre:
 							variableName = famPre + variableName.strip()
 					variableName = m.group("prefix") + variableName
-					newLines.append(lines[i].copy(re.sub(r"\b%s\b" % persWord, "", line)))
+					newLines = [line.copy(wholeWordRe(persWord).sub("", text))]
 					if persWord == "pers":
-						newLines.append(lines[i].copy("make_persistent(%s)" % variableName))
+						newLines.append(line.copy("make_persistent(%s)" % variableName))
 					if persWord == "instpers":
-						newLines.append(lines[i].copy("make_instr_persistent(%s)" % variableName))
+						newLines.append(line.copy("make_instr_persistent(%s)" % variableName))
 					if persWord == "read":
-						newLines.append(lines[i].copy("make_persistent(%s)" % variableName))
-						newLines.append(lines[i].copy("read_persistent_var(%s)" % variableName))
-					continue
-		newLines.append(lines[i])
-
-	replaceLines(lines, newLines)
+						newLines.append(line.copy("make_persistent(%s)" % variableName))
+						newLines.append(line.copy("read_persistent_var(%s)" % variableName))
+					return newLines
+		return None
 
 #=================================================================================================
 class IterateMacro(object):
@@ -1094,26 +1326,16 @@ class IterateMacro(object):
 
 		return(newLines)
 
-def handleIterateMacro(lines):
-	scan = False
-	newLines = collections.deque()
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if line.startswith("iterate_macro"):
-			scan = True
-			m = re.search(r"^iterate_macro\s*\((?P<macro>.+)\)\s*:=\s*(?P<min>.+)\b(?P<direction>to|downto)(?P<max>(?:.(?!\bstep\b))+)(?:\s+step\s+(?P<step>.+))?$", line)
-			if m:
-				iterateObj = IterateMacro(m.group("macro"), m.group("min"), m.group("max"), m.group("step"), m.group("direction"), lines[lineIdx])
-				newLines.extend(iterateObj.buildLines())
-			else:
-				newLines.append(lines[lineIdx])
-		else:
-			newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
+iterateMacroRe = re.compile(r"^iterate_macro\s*\((?P<macro>.+)\)\s*:=\s*(?P<min>.+)\b(?P<direction>to|downto)(?P<max>(?:.(?!\bstep\b))+)(?:\s+step\s+(?P<step>.+))?$")
 
-	return scan
+def unrollIterateMacro(line, m):
+	""" Returns the lines of the iterate_macro line matched by m (a match of iterateMacroRe). """
+	iterateObj = IterateMacro(m.group("macro"), m.group("min"), m.group("max"), m.group("step"), m.group("direction"), line)
+	return list(iterateObj.buildLines())
 
 #=================================================================================================
+modRe = re.compile(r"\bmod\b")
+
 class DefineConstant(object):
 	def __init__(self, name, value, argString, line):
 		self.name = name
@@ -1125,7 +1347,10 @@ class DefineConstant(object):
 		if argString:
 			self.args = ksp_compiler.split_args(argString, line)
 		self.line = line
-		if re.search(r"\b%s\b" % self.name, self.value):
+		# The patterns are compiled once, with thousands of defines they would not stay in the cache of the re module.
+		self.nameRe = re.compile(r"\b%s\b" % self.name)
+		self.argRes = None
+		if self.nameRe.search(self.value):
 			raise ksp_compiler.ParseException(self.line, "Define constant cannot call itself.")
 
 	def getName(self):
@@ -1143,7 +1368,7 @@ class DefineConstant(object):
 		nonMath = ["\"", "\'"]
 		if not any(s in newVal for s in nonMath):
 			try:
-				val = re.sub(r"\bmod\b", "%", self.value)
+				val = modRe.sub("%", self.value)
 				newVal = str(stringEvaluator.eval(val))
 			except:
 				pass
@@ -1154,11 +1379,11 @@ class DefineConstant(object):
 		newCommand = command
 		if self.name in command:
 			if not self.args:
-				newCommand = re.sub(r"\b%s\b" % self.name, self.value, command)
+				newCommand = self.nameRe.sub(self.value, command)
 			else:
 				lineObj = line or self.line
 				
-				matchIt = re.finditer(r"\b%s\b" % self.name, command)
+				matchIt = self.nameRe.finditer(command)
 				for match in matchIt:
 					# Parse the match
 					matchPos = match.start()
@@ -1193,25 +1418,112 @@ class DefineConstant(object):
 							raise ksp_compiler.ParseException(lineObj, "Incorrect number of arguments in define macro: %s. Expected %d, got %d.\n" % (foundString, len(self.args), len(foundArgs)))
 
 					# Build the new value using the given args
+					if self.argRes is None:
+						self.argRes = [re.compile(arg if arg.startswith("#") and arg.endswith("#") else r"\b%s\b" % arg) for arg in self.args]
 					newVal = self.value
-					for argIdx, arg in enumerate(self.args):
-						if arg.startswith("#") and arg.endswith("#"):
-							newVal = re.sub(arg, foundArgs[argIdx], newVal)
-						else:
-							newVal = re.sub(r"\b%s\b" % arg, foundArgs[argIdx], newVal)
+					for argIdx, argRe in enumerate(self.argRes):
+						newVal = argRe.sub(foundArgs[argIdx], newVal)
 					newCommand = newCommand.replace(foundString, newVal)
 		return(newCommand)
 
+class DefineSubstituter(object):
+	""" Substitutes all of the define constants in a command, in the order they were declared (the same as calling
+	substituteValue for each of them). A define whose name only has word characters can only be substituted where its name
+	is a whole word of the command, so all of these defines are looked up at once in a dict by the words of the command.
+	Names with other characters (dots, prefix symbols) are matched as regular expressions, so those defines are still checked
+	one by one. If a define changes the command, the words are looked up again for the defines after it. """
+	wordRe = re.compile(r"\w+")
+	wordNameRe = re.compile(r"\w+$")
+
+	def __init__(self, defineConstants):
+		self.defineConstants = defineConstants
+		self.wordNames = {} # Maps each name only made up of word characters to the indices of the defines with that name.
+		self.otherNames = [] # The indices of the remaining defines.
+		for i, defineObj in enumerate(defineConstants):
+			if self.wordNameRe.match(defineObj.name):
+				self.wordNames.setdefault(defineObj.name, []).append(i)
+			else:
+				self.otherNames.append(i)
+
+	def findDefines(self, command, after):
+		""" Return the sorted indices (greater than after) of the defines that could be used in the command. """
+		found = []
+		wordNames = self.wordNames
+		for word in set(self.wordRe.findall(command)):
+			if word in wordNames:
+				found.extend(wordNames[word])
+		for i in self.otherNames:
+			defineObj = self.defineConstants[i]
+			if defineObj.name in command and defineObj.nameRe.search(command):
+				found.append(i)
+		return sorted(i for i in found if i > after)
+
+	def substitute(self, command, line=None, owner=None):
+		""" Return the command with the defines substituted. If line is given, its command is updated after each
+		substitution (so that errors show the command at that point). owner is the define the command is the value of,
+		its value is updated after each substitution too, as it is used when the owner itself is substituted. """
+		defines = self.findDefines(command, -1)
+		pos = 0
+		while pos < len(defines):
+			i = defines[pos]
+			pos += 1
+			newCommand = self.defineConstants[i].substituteValue(command, self.defineConstants, line)
+			if newCommand != command:
+				command = newCommand
+				if line:
+					line.command = command
+				if owner:
+					owner.setValue(command)
+				defines = self.findDefines(command, i)
+				pos = 0
+		return command
+
+def resolveDefineConstants(defineConstants, substituter):
+	""" Replace all occurances where other defines are used in define values and evaluate the values. The defines are
+	resolved in dependency order, each one after the defines its value uses, so every value is resolved once whatever the
+	order of the declarations. A cycle of defines using each other is reported with the whole chain. """
+	dependencies = []
+	for i, defineObj in enumerate(defineConstants):
+		dependencies.append([j for j in substituter.findDefines(defineObj.getValue(), -1) if j != i])
+	resolved = [False] * len(defineConstants)
+	inProgress = [False] * len(defineConstants)
+	# A depth first search with an explicit stack of (define index, iterator over its dependencies), as the chains of defines can
+	# be longer than the recursion limit.
+	for first in range(len(defineConstants)):
+		if resolved[first]:
+			continue
+		stack = [(first, iter(dependencies[first]))]
+		inProgress[first] = True
+		while stack:
+			i, remaining = stack[-1]
+			for j in remaining:
+				if inProgress[j]:
+					chainStart = [k for (k, it) in stack].index(j)
+					chain = [defineConstants[k].name for (k, it) in stack[chainStart:]] + [defineConstants[j].name]
+					raise ksp_compiler.ParseException(defineConstants[j].line, "Define constants cannot refer to each other in a cycle: %s\n" % " -> ".join(chain))
+				if not resolved[j]:
+					inProgress[j] = True
+					stack.append((j, iter(dependencies[j])))
+					break
+			else:
+				stack.pop()
+				defineObj = defineConstants[i]
+				substituter.substitute(defineObj.getValue(), owner=defineObj)
+				defineObj.evaluateValue()
+				inProgress[i] = False
+				resolved[i] = True
+
+defineRe = re.compile(r"^define\s+%s\s*(?:\((?P<args>.+)\))?\s*:=(?P<val>.+)$" % variableNameRe)
+
 def handleDefineConstants(lines):
-	defineRe = r"^define\s+%s\s*(?:\((?P<args>.+)\))?\s*:=(?P<val>.+)$" % variableNameRe
-	defineConstants = collections.deque()
-	newLines = collections.deque()
+	defineConstants = []
+	newLines = []
 
 	# Scan through all the lines to find define declarations.
 	for lineIdx in range(len(lines)):
 		line = lines[lineIdx].command.strip()
 		if line.startswith("define"):
-			m = re.search(defineRe, line)
+			m = defineRe.search(line)
 			if m:
 				defineObj = DefineConstant(m.group("whole"), m.group("val").strip(), m.group("args"), lines[lineIdx])
 				defineConstants.append(defineObj)
@@ -1219,17 +1531,12 @@ def handleDefineConstants(lines):
 		newLines.append(lines[lineIdx])
 
 	if defineConstants:
-		# Replace all occurances where other defines are used in define values.
-		for i in range(len(defineConstants)):
-			for j in range(len(defineConstants)):
-				defineConstants[i].setValue(defineConstants[j].substituteValue(defineConstants[i].getValue(), defineConstants))
-			defineConstants[i].evaluateValue()
+		substituter = DefineSubstituter(defineConstants)
+		resolveDefineConstants(defineConstants, substituter)
 
 		# For each line, replace any places the defines are used.
-		for lineIdx in range(len(newLines)):
-			line = newLines[lineIdx].command
-			for defineConst in defineConstants:
-				newLines[lineIdx].command = defineConst.substituteValue(newLines[lineIdx].command, defineConstants, newLines[lineIdx])
+		for lineObj in newLines:
+			lineObj.command = substituter.substitute(lineObj.command, lineObj)
 	replaceLines(lines, newLines)
 
 def createBuiltinDefines(lines):
@@ -1239,9 +1546,9 @@ def createBuiltinDefines(lines):
 	timenames = ['__SEC__','__MIN__','__HOUR__','__HOUR12__','__AMPM__','__DAY__','__MONTH__','__YEAR__','__YEAR2__','__LOCALE_MONTH__','__LOCALE_MONTH_ABBR__','__LOCALE_DATE__','__LOCALE_TIME__']
 	defines = ['define {0} := \"{1}\"'.format(timenames[i], strftime(timecodes[i], localtime())) for i in range(len(timecodes))]
 
-	newLines = collections.deque()
+	newLines = []
 
-	# append our defines on top of the script in a temporary deque
+	# append our defines on top of the script in a temporary list
 	for string in defines:
 		newLines.append(lines[0].copy(string))
 
@@ -1249,7 +1556,7 @@ def createBuiltinDefines(lines):
 	for line in lines:
 		newLines.append(line)
 
-	# replace original deque with modified one
+	# replace the original lines with the modified ones
 	replaceLines(lines, newLines)
 
 #=================================================================================================
@@ -1276,50 +1583,71 @@ class UIArray(object):
 		""" Get the command string for declaring the raw ID array. """
 		return("declare %s[%s]" % (self.name, self.dimensionsString))
 
-	def buildLines(self, line):
-		""" Return the deque of lines for the ui declaration (just a load of declare ui and get_ui_id()). """
-		newLines = collections.deque()
-		for i in range(self.numElements):
-			uiName = self.underscore + self.name
-			if self.uiType == "ui_table" or self.uiType == "ui_xy":
-				text = "declare %s %s %s %s" % (self.persistence, self.uiType, self.prefixSymbol + uiName + str(i), self.tableSize + self.uiParams)
-			else:
-				text = "declare %s %s %s %s" % (self.persistence, self.uiType, self.prefixSymbol + uiName + str(i), self.uiParams)
-			newLines.append(line.copy(text))
+	def buildLines(self, line, compact):
+		""" Return the lines for the ui declaration (a load of declare ui and get_ui_id()). If compact is set all of
+		the controls are declared on one line, e.g. declare ui_knob knobs0[[512 pers]] (0, 100, 1), which the parser keeps as
+		one node that is only expanded to a declare (and make_persistent() etc.) per control when the code is emitted. """
+		uiName = self.underscore + self.name
+		tableSize = ""
+		if self.uiType == "ui_table" or self.uiType == "ui_xy":
+			tableSize = self.tableSize
+		if compact:
+			persistence = ""
+			if self.persistence:
+				persistence = " " + self.persistence
+			newLines = [line.copy("declare %s %s[[%d%s]] %s" % (self.uiType, self.prefixSymbol + uiName + "0", self.numElements, persistence, tableSize + self.uiParams))]
+		else:
+			newLines = []
+			for i in range(self.numElements):
+				text = "declare %s %s %s %s" % (self.persistence, self.uiType, self.prefixSymbol + uiName + str(i), tableSize + self.uiParams)
+				newLines.append(line.copy(text))
 		newLines.append(line.copy("for preproc_i := 0 to %s" % (self.numElements - 1)))
 		newLines.append(line.copy("%s[preproc_i] := get_ui_id(%s) + preproc_i" % (self.familyPrefix + uiName, self.familyPrefix + uiName + '0')))
 		newLines.append(line.copy("end for"))
 		return(newLines)
 
-def handleUIArrays(lines):
+class UIArrayStage(PreprocessorStage):
 	uiTypeRe = r"\b(?P<uitype>ui_\w*)\b"
-	uiArrayRe = r"^declare\s+%s%s\s+%s\s*\[(?P<arraysize>[^\]]+)\]\s*(?P<tablesize>\[[^\]]+\]\s*)?(?P<uiparams>\(.*)?" % (persistenceRe, uiTypeRe, variableNameRe)
-	newLines = collections.deque()
-	famCount = 0
-	for lineNum in range(len(lines)):
-		line = lines[lineNum].command.strip()
-		famCount = countFamily(line, famCount)
-		if line.startswith("on"):
-			if re.search(initRe, line):
-				newLines.append(lines[lineNum])
-				newLines.append(lines[lineNum].copy("declare preproc_i"))
-				continue
-		elif line.startswith("decl"):
-			m = re.search(uiArrayRe, line)
+	uiArrayRe = re.compile(r"^declare\s+%s%s\s+%s\s*\[(?P<arraysize>[^\]]+)\]\s*(?P<tablesize>\[[^\]]+\]\s*)?(?P<uiparams>\(.*)?" % (persistenceRe, uiTypeRe, variableNameRe))
+	keywords = ("on", "decl", "family", "end", "function", "taskfunc")
+
+	def __init__(self):
+		PreprocessorStage.__init__(self)
+		self.famCount = 0
+		self.functionDepth = 0
+
+	def process(self, line, text, keyword):
+		self.rememberFamilyLine(line, text)
+		self.famCount = countFamily(text, self.famCount)
+		if keyword.startswith("on"):
+			if initRe.search(text):
+				return [line, line.copy("declare preproc_i")]
+		elif keyword == "function" or keyword == "taskfunc":
+			self.functionDepth += 1
+		elif keyword == "end":
+			if endFunctionRe.search(text):
+				self.functionDepth -= 1
+		elif keyword.startswith("decl") and "ui_" in text:
+			m = self.uiArrayRe.search(text)
 			if m:
 				uiType = m.group("uitype")
 				famPre = None
-				if famCount != 0:
-					famPre = inspectFamilyState(lines, lineNum)
+				if self.famCount != 0:
+					famPre = self.getFamilyPrefix()
 				if ((uiType == "ui_table" or uiType == "ui_xy") and m.group("tablesize")) or (uiType != "ui_table" and uiType != "ui_xy"):
-					arrayObj = UIArray(m.group("name"), uiType, m.group("arraysize"), m.group("persistence"), famPre, m.group("uiparams"), m.group("tablesize"), m.group("prefix"), lines[lineNum])
-					newLines.append(lines[lineNum].copy(arrayObj.getRawArrayDeclaration()))
-					newLines.extend(arrayObj.buildLines(lines[lineNum]))
-					continue
-		newLines.append(lines[lineNum])
-	replaceLines(lines, newLines)
+					arrayObj = UIArray(m.group("name"), uiType, m.group("arraysize"), m.group("persistence"), famPre, m.group("uiparams"), m.group("tablesize"), m.group("prefix"), line)
+					newLines = [line.copy(arrayObj.getRawArrayDeclaration())]
+					# The controls declared in functions may be renamed one by one, so they are only kept on one line outside of functions.
+					newLines.extend(arrayObj.buildLines(line, compact=self.functionDepth == 0))
+					return newLines
+		return None
 
 #=================================================================================================
+defineLiteralsRe = re.compile(r"^define\s+literals\s+")
+defineLiteralsAssignmentRe = re.compile(r"^define\s+literals\s+" + variableNameUnRe + r"\s*:=")
+defineLiteralsValueRe = re.compile(r"^\((([a-zA-Z_][a-zA-Z0-9_.]*)?(\s*,\s*[a-zA-Z_][a-zA-Z0-9_.]*)*)\)$")
+notNewlineRe = re.compile(r'[^\r\n]')
+
 def handleDefineLiterals(lines):
 	""" Finds all define literals, and just replaces their occurances with the list of literals. """
 	defineTitles = []
@@ -1328,9 +1656,9 @@ def handleDefineLiterals(lines):
 	for index in range(len(lines)):
 		line = lines[index].command.strip()
 		if line.startswith("define"):
-			if re.search(r"^define\s+literals\s+", line):
-				if re.search(r"^define\s+literals\s+" + variableNameUnRe + r"\s*:=", line):
-					textWithoutDefine = re.sub(r"^define\s+literals\s*", "", line)
+			if defineLiteralsRe.search(line):
+				if defineLiteralsAssignmentRe.search(line):
+					textWithoutDefine = defineLiteralsRe.sub("", line)
 					colonBracketPos = textWithoutDefine.find(":=")
 
 					# before the assign operator is the title
@@ -1339,7 +1667,7 @@ def handleDefineLiterals(lines):
 
 					# after the assign operator is the value
 					value = textWithoutDefine[colonBracketPos + 2 : ].strip()
-					m = re.search(r"^\((([a-zA-Z_][a-zA-Z0-9_.]*)?(\s*,\s*[a-zA-Z_][a-zA-Z0-9_.]*)*)\)$", value)
+					m = defineLiteralsValueRe.search(value)
 					if not m:
 						raise ksp_compiler.ParseException(lines[index], "Syntax error in define literals: Comma separated identifier list in () expected.\n")
 
@@ -1349,7 +1677,7 @@ def handleDefineLiterals(lines):
 
 					defineLinePos.append(index)
 					# remove the line
-					lines[index].command = re.sub(r'[^\r\n]', '', line)
+					lines[index].command = notNewlineRe.sub('', line)
 				else:
 					raise ksp_compiler.ParseException(lines[index], "Syntax error in define literals.\n")
 
@@ -1359,30 +1687,18 @@ def handleDefineLiterals(lines):
 		for lineObj in lines:
 			line = lineObj.command
 			for index, item in enumerate(defineTitles):
-				if re.search(r"\b" + item + r"\b", line):
+				if wholeWordRe(item).search(line):
 					# character_before = line[line.find(item) - 1 : line.find(item)]
 					# if character_before.isalpha() == False and character_before.isdiget() == False:
 					lineObj.command = lineObj.command.replace(item, str(defineValues[index]))
 
 #=================================================================================================
-def handleLiterateMacro(lines):
-	scan = False
-	newLines = collections.deque()
-	for lineIdx in range(len(lines)):
-		line = lines[lineIdx].command.strip()
-		if line.startswith("literate_macro"):
-			scan = True
-			m = re.search(r"^literate_macro\s*\((?P<macro>.+)\)\s+on\s+(?P<target>.+)$", line)
-			if m:
-				name = m.group("macro")
-				targets = ksp_compiler.split_args(m.group("target"), lines[lineIdx])
-				if not "#l#" in name:
-					for text in targets:
-						newLines.append(lines[lineIdx].copy("%s(%s)" % (name, text)))
-				else:
-					for index, text in enumerate(targets):
-						newLines.append(lines[lineIdx].copy(name.replace("#l#", text).replace("#n#", str(index))))
-				continue
-		newLines.append(lines[lineIdx])
-	replaceLines(lines, newLines)
-	return scan
+literateMacroRe = re.compile(r"^literate_macro\s*\((?P<macro>.+)\)\s+on\s+(?P<target>.+)$")
+
+def unrollLiterateMacro(line, m):
+	""" Returns the lines of the literate_macro line matched by m (a match of literateMacroRe). """
+	name = m.group("macro")
+	targets = ksp_compiler.split_args(m.group("target"), line)
+	if not "#l#" in name:
+		return [line.copy("%s(%s)" % (name, text)) for text in targets]
+	return [line.copy(name.replace("#l#", text).replace("#n#", str(index))) for index, text in enumerate(targets)]
@@ -12,7 +12,7 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from ksp_compiler import ParseException, KSPCompiler
+from ksp_compiler import ParseException, KSPCompiler, ImportCache
 import unittest
 
 def default_read_file_func(filepath):
@@ -692,6 +692,38 @@ class MacroInlining(unittest.TestCase):
             end on'''
         self.assertRaises(ParseException, do_compile, code)
 
+    def testIterationMacrosInsideMacros(self):
+        code = '''
+macro knob(#n#)
+    declare ui_knob k#n#(0, 10, 1)
+    on ui_control(k#n#)
+        message(#n#)
+    end on
+end macro
+
+macro knobs(#name#)
+    literate_macro(message("#l#")) on #name#, b
+    iterate_macro(knob) := 0 to 1
+end macro
+
+on init
+    knobs(a)
+end on'''
+        compiler = KSPCompiler(code, None, compact=False)
+        compiler.do_imports_and_convert_to_line_objects()
+        compiler.extract_macros()
+        compiler.expand_macros()
+        self.assertEqual([line.command.strip() for line in compiler.lines if line.command.strip()],
+                         ['on init', 'message("a")', 'message("b")', 'declare ui_knob k0(0, 10, 1)', 'declare ui_knob k1(0, 10, 1)', 'end on',
+                          'on ui_control(k0)', 'message(0)', 'end on', 'on ui_control(k1)', 'message(1)', 'end on'])
+
+    def testMalformedIterationMacroIsASyntaxError(self):
+        code = '''
+on init
+    iterate_macro(foo) := 1 2
+end on'''
+        self.assertRaises(ParseException, do_compile, code)
+
 ##    def testMacrosInvokingEachOtherNotSupported(self):
 ##        code = '''
 ##            macro foo(x)
@@ -707,6 +739,57 @@ class MacroInlining(unittest.TestCase):
 ##            end on'''
 ##        self.assertRaises(ParseException, do_compile, code)
 
+    def testNestedMacroCallbackOrder(self):
+        code = '''
+            macro outer(#n#)
+              declare ui_button #n#_a
+              on ui_control(#n#_a)
+                inner(#n#_c)
+              end on
+              inner(#n#_b)
+              message("outer #n#")
+            end macro
+
+            macro inner(#n#)
+              declare ui_button #n#
+              on ui_control(#n#)
+                message("inner #n#")
+              end on
+            end macro
+
+            on init
+                outer(x)
+                outer(y)
+            end on'''
+        compiler = KSPCompiler(code, None, compact=True)
+        compiler.compile()
+        output = compiler.compiled_code.replace('\r', '')
+        # the callbacks of each level of macro expansion are placed after those of the previous level
+        callbacks = [line for line in output.split('\n') if line.startswith('on ui_control')]
+        self.assertEqual(callbacks, ['on ui_control($%s)' % name for name in ('x_a', 'y_a', 'x_b', 'y_b', 'x_c', 'y_c')])
+        self.assertTrue('declare ui_button $x_a\ndeclare ui_button $x_b\nmessage("outer x")\ndeclare ui_button $y_a' in output)
+
+    def testMacroTemplateMatchesSubstitution(self):
+        from ksp_compiler import Macro, Line, Location
+        lines = ['macro foo(x, $y, a.b, #r#)', 'x.member := $y + a.b.c', 'declare lbl_#r#(x, {0})', 'message(x & "x")', 'end macro']
+        macro = Macro([Line(command, Location(None, i + 1)) for (i, command) in enumerate(lines)])
+        placeholders = {0: '"#r# label"', 1: '"arg"'}
+        for args in (['fam', '5', 'q.r', 'name'], ['x.y', '$z', '{1}', '#r#'], ['', 'a.b', 'x', '1']):
+            name_subst_dict = dict(zip(macro.parameters, args))
+            expected = macro.copy(add_location=(None, 10)).substitute_names(name_subst_dict, placeholders).lines[1:-1]
+            result = macro.expand(name_subst_dict, placeholders, (None, 10))
+            self.assertEqual([(l.command, l.locations) for l in result], [(l.command, l.locations) for l in expected])
+
+    def testLocationChainsAreShared(self):
+        from ksp_compiler import Line, Location
+        line = Line('message(x)', Location('lib.ksp', 3))
+        copy1 = line.copy(add_location=('main.ksp', 10)).copy(add_location=(None, 20))
+        copy2 = line.copy(add_location=('main.ksp', 10)).copy(add_location=(None, 20), new_command='message(y)')
+        self.assertTrue(copy1.location is copy2.location)
+        self.assertEqual(copy2.locations, [('lib.ksp', 3), ('main.ksp', 10), (None, 20)])
+        self.assertEqual((copy2.filename, copy2.lineno), ('lib.ksp', 3))
+        self.assertEqual(copy2.get_locations_string(), '<main script>:20 \r\n\n    main.ksp:10 \r\n\n        lib.ksp:3 \r\n')
+
     def testWrongNumberOfParameters(self):
         code = '''
             macro foo(x)
@@ -911,6 +994,49 @@ class FunctionInlining(unittest.TestCase):
         output = do_compile(code)
         self.assertTrue('%my_array[0] := 10' in output)
 
+class ASTCopy(unittest.TestCase):
+    def testCopyOfFunctionBody(self):
+        import ksp_parser
+        module = ksp_parser.parse('function foo(a) -> result\n  result := a * 2\n  if a > 1\n    result := a\n  end if\nend function\n')
+        func = module.blocks[0]
+        # share a node and a lexinfo between two places in the tree, the copy should keep them shared
+        stmt1, if_stmt = func.lines
+        stmt2 = if_stmt.condition_stmts_tuples[0][1][0]
+        stmt2.expression = stmt1.varref
+        stmt1.lexinfo[2].append('call')
+        copy = func.copy_body()
+        new_stmt1, new_if_stmt = copy.lines
+        new_stmt2 = new_if_stmt.condition_stmts_tuples[0][1][0]
+        self.assertTrue(new_stmt1 is not stmt1 and new_if_stmt is not if_stmt and new_stmt2 is not stmt2)
+        self.assertTrue(new_stmt2.expression is new_stmt1.varref and new_stmt1.varref is not stmt1.varref)
+        self.assertEqual(new_stmt1.lexinfo, stmt1.lexinfo)
+        self.assertTrue(new_stmt1.lexinfo[2] is not stmt1.lexinfo[2])
+        self.assertTrue(copy.lexinfo[2] is not func.lexinfo[2] and copy.parameters is func.parameters)
+        self.assertEqual([str(l) for l in copy.lines], [str(l) for l in func.lines])
+
+    def testNodesHaveNoInstanceDict(self):
+        import ksp_ast
+        code = '''
+            on init
+                declare x
+                x := double(3)
+            end on
+
+            function double(a) -> result
+                declare local tmp
+                tmp := a
+                result := tmp * 2
+            end function'''
+        compiler = KSPCompiler(code, None, compact=True, extra_syntax_checks=True, optimize=True)
+        compiler.compile()
+        stack = [compiler.module]
+        while stack:
+            node = stack.pop()
+            self.assertFalse(hasattr(node, '__dict__'), node.__class__.__name__)
+            stack.extend(child for child in node.get_childnodes() or [] if isinstance(child, ksp_ast.ASTNode))
+        node = compiler.module.blocks[0]
+        self.assertRaises(AttributeError, setattr, node, 'unknown_attribute', 1)
+
 class FunctionInvocationUsingCall(unittest.TestCase):
     def testNotAllowedInOnInit(self):
         code = '''
@@ -1888,4 +2014,568 @@ end on
             output = do_compile(code, extra_syntax_checks=True, optimize=True)
             self.assertEqual(expected_output, output)
 
+class ImportCacheTests(unittest.TestCase):
+    files = {
+        'lib.ksp': '''
+            function greet
+                message("hello" & 'world')
+            end function''',
+    }
+    code = '''
+        import "lib.ksp" as lib
+        on init
+            message("main")
+            lib.greet
+        end on'''
+
+    def compile(self, import_cache, callback=None):
+        compiler = KSPCompiler(self.code, None, compact=True, read_file_func=lambda filename: self.files[filename], import_cache=import_cache)
+        compiler.compile(callback=callback)
+        return compiler.compiled_code.replace('\r', '')
+
+    def testCachedImportGivesSameOutput(self):
+        expected_output = self.compile(None)
+        cache = ImportCache()
+        messages = []
+        self.assertEqual(self.compile(cache), expected_output)
+        self.assertEqual(self.compile(cache, callback=lambda desc, percent: messages.append(desc)), expected_output)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertTrue('import cache: 1 hit(s), 0 miss(es)' in messages)
+
+    def testImportCacheStatisticsKeepTheProgress(self):
+        progress = []
+        self.compile(ImportCache(), callback=lambda desc, percent: progress.append((desc, percent)))
+        descs = [desc for (desc, percent) in progress]
+        i = descs.index('import cache: 0 hit(s), 1 miss(es)')
+        self.assertEqual(progress[i][1], progress[descs.index('scanning and importing code')][1])
+        self.assertEqual([percent for (desc, percent) in progress], sorted(percent for (desc, percent) in progress))
+
+    def testChangedImportIsParsedAgain(self):
+        cache = ImportCache()
+        self.compile(cache)
+        self.files = {'lib.ksp': self.files['lib.ksp'].replace('world', 'there')}
+        self.assertTrue('there' in self.compile(cache))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def testDiskCache(self):
+        import shutil, tempfile
+        cache_dir = tempfile.mkdtemp()
+        try:
+            expected_output = self.compile(ImportCache(cache_dir))
+            cache = ImportCache(cache_dir)
+            self.assertEqual(self.compile(cache), expected_output)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+        finally:
+            shutil.rmtree(cache_dir)
+
+class ParseCacheTests(unittest.TestCase):
+    code = '''
+        on init
+            declare x
+            message(double(x))
+        end on
+
+        function double(value) -> result
+            result := value * 2
+        end function
+
+        on note
+            x := EVENT_NOTE
+        end on'''
+
+    def compile(self, code, parse_cache, callback=None):
+        compiler = KSPCompiler(code, None, compact=True, extra_syntax_checks=True, parse_cache=parse_cache)
+        compiler.compile(callback=callback)
+        return compiler.compiled_code.replace('\r', '')
+
+    def testCachedBlocksGiveSameOutput(self):
+        from ksp_compiler import ParseCache
+        expected_output = self.compile(self.code, None)
+        cache = ParseCache()
+        messages = []
+        self.assertEqual(self.compile(self.code, cache), expected_output)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        self.assertEqual(self.compile(self.code, cache, callback=lambda desc, percent: messages.append(desc)), expected_output)
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        self.assertTrue('parse cache: 3 hit(s), 0 miss(es)' in messages)
+
+    def testParseCacheStatisticsKeepTheProgress(self):
+        from ksp_compiler import ParseCache
+        progress = []
+        self.compile(self.code, ParseCache(), callback=lambda desc, percent: progress.append((desc, percent)))
+        percents = dict(progress)
+        self.assertTrue(percents['parse code'] > 0)
+        self.assertEqual(percents['parse cache: 0 hit(s), 3 miss(es)'], percents['parse code'])
+        self.assertEqual([percent for (desc, percent) in progress], sorted(percent for (desc, percent) in progress))
+
+    def testOnlyChangedBlocksAreParsedAgain(self):
+        from ksp_compiler import ParseCache
+        cache = ParseCache()
+        self.compile(self.code, cache)
+        # the blocks after the changed one have moved, so the line numbers in error messages have to be updated
+        code = self.code.replace('message(double(x))', 'message(double(x))\n            message(1)').replace('x := EVENT_NOTE', 'x := "a"')
+        with self.assertRaises(ParseException) as uncached:
+            self.compile(code, None)
+        with self.assertRaises(ParseException) as cached:
+            self.compile(code, cache)
+        self.assertEqual(str(cached.exception), str(uncached.exception))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testCodeWhichCantBeSplitIsParsedAtOnce(self):
+        from ksp_compiler import ParseCache
+        import ksp_parser
+        cache = ParseCache()
+        for code in ['on init\n  x := 1\nend\non\n', 'on init\nend on\nx := 1\n', 'on init\n  message("{")\nend on\n']:
+            try:
+                expected = str(ksp_parser.parse(code).blocks)
+            except ksp_parser.ParseException as e:
+                expected = e.lineno
+            try:
+                result = str(cache.parse(code).blocks)
+            except ksp_parser.ParseException as e:
+                result = e.lineno
+            self.assertEqual(result, expected)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def testBlocksCanBeParsedInWorkerProcesses(self):
+        from ksp_compiler import ParseCache
+        import multiprocessing
+        cache = ParseCache(jobs=2, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            self.assertEqual(self.compile(self.code, cache), self.compile(self.code, None))
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            # a syntax error in a block parsed by a worker is reported with the line number it has in the whole script
+            code = self.code.replace('on note', 'on note\n            x := := 1').replace('value * 2', 'value * 3')
+            with self.assertRaises(ParseException) as uncached:
+                self.compile(code, None)
+            with self.assertRaises(ParseException) as cached:
+                self.compile(code, cache)
+            self.assertEqual(str(cached.exception), str(uncached.exception))
+        finally:
+            cache.close()
+
+class CompilationContextTests(unittest.TestCase):
+
+    def get_code(self, i):
+        return '''
+            on init
+                declare x%d := %d
+                declare ui_knob knob%d(0, 100, 1)
+                message("script %d")
+                add_%d(x%d)
+            end on
 
+            function add_%d(value)
+                x%d := value + %d
+            end function''' % ((i,) * 9)
+
+    def testCompilersDoNotShareState(self):
+        first = KSPCompiler(self.get_code(1), None, compact=True)
+        second = KSPCompiler(self.get_code(2), None, compact=True)
+        first.compile()
+        second.compile()
+        self.assertTrue('$x1' in first.context.variables)
+        self.assertFalse('$x1' in second.context.variables)
+
+    def testConcurrentCompilations(self):
+        import threading
+        expected_outputs = [do_compile(self.get_code(i)) for i in range(8)]
+        outputs = {}
+        errors = []
+
+        def compile_script(i):
+            try:
+                for _ in range(5):
+                    output = do_compile(self.get_code(i))
+                    if output != expected_outputs[i]:
+                        outputs[i] = output
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=compile_script, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(outputs, {})
+
+class BatchCompileTests(unittest.TestCase):
+    def testBatchCompileWritesPragmaTargets(self):
+        import os, shutil, tempfile, codecs, multiprocessing
+        import ksp_compiler
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sources = {
+                'a.ksp': 'on init\n  declare x := 1\n  message(x)\nend on\n{ #pragma save_compiled_source a.txt}',
+                'b.ksp': 'on init\n  message("b")\nend on\n{ #pragma save_compiled_source b.txt}',
+                'bad.ksp': 'on init\n  y := 1\nend on\n{ #pragma save_compiled_source bad.txt}',
+            }
+            for filename, code in sources.items():
+                codecs.open(os.path.join(tmpdir, filename), 'w', 'latin-1').write(code)
+            manifest = os.path.join(tmpdir, 'scripts.txt')
+            codecs.open(manifest, 'w', 'utf-8').write('# scripts\na.ksp\nbad.ksp\n')
+            paths = ksp_compiler.find_batch_sources([manifest, os.path.join(tmpdir, '*.ksp')])
+            self.assertEqual([os.path.basename(p) for p in paths], ['a.ksp', 'bad.ksp', 'b.ksp'])
+
+            options = dict(compact=True, add_compiled_date_comment=False)
+            # workers started with spawn (the default on Windows and macOS) import the modules again
+            results = ksp_compiler.batch_compile(paths, options, jobs=2, mp_context=multiprocessing.get_context('spawn'))
+            results = dict((os.path.basename(r[0]), r) for r in results)
+            for filename in ('a.ksp', 'b.ksp'):
+                (source_path, output_path, error, seconds) = results[filename]
+                self.assertEqual(error, None)
+                compiler = KSPCompiler(sources[filename], tmpdir, compact=True, add_compiled_date_comment=False)
+                compiler.compile()
+                self.assertEqual(output_path, os.path.join(tmpdir, filename.replace('.ksp', '.txt')))
+                self.assertEqual(codecs.open(output_path, 'r', 'latin-1').read(), compiler.compiled_code.replace('\r', ''))
+            self.assertTrue('y has not been declared' in results['bad.ksp'][2])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'bad.txt')))
+            self.assertTrue('1 failed' in ksp_compiler.format_batch_summary(list(results.values())))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testBatchCompileFromTheCommandLineWithSpawnedWorkers(self):
+        import os, sys, shutil, tempfile, codecs, subprocess
+        import ksp_compiler
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ('a', 'b'):
+                codecs.open(os.path.join(tmpdir, name + '.ksp'), 'w', 'latin-1').write('on init\n  message("%s")\nend on\n{ #pragma save_compiled_source %s.txt}' % (name, name))
+            # run ksp_compiler.py as a script with the workers started by spawn, they then import it again as __mp_main__
+            script = os.path.abspath(ksp_compiler.__file__)
+            launcher = 'import multiprocessing, runpy, sys; multiprocessing.set_start_method("spawn"); sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name="__main__")'
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+            result = subprocess.run([sys.executable, '-c', launcher, script, '--batch', os.path.join(tmpdir, '*.ksp'), '--jobs', '2'],
+                                    env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['a.ksp', 'a.txt', 'b.ksp', 'b.txt'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ProfilingTests(unittest.TestCase):
+    code = '''
+        on init
+            declare x
+            x := double(2)
+        end on
+        function double(v) -> result
+            result := v * 2
+        end function'''
+
+    def testNoProfileByDefault(self):
+        compiler = KSPCompiler(self.code, None)
+        compiler.compile()
+        self.assertEqual(compiler.profile_results, [])
+
+    def testProfileRecordsEachTask(self):
+        import json
+        from ksp_compiler import format_profile
+        progress = []
+        compiler = KSPCompiler(self.code, None, extra_syntax_checks=True, profile=True, profile_memory=True)
+        compiler.compile(callback=lambda desc, percent: progress.append((desc, percent)))
+        self.assertEqual([task.desc for task in compiler.profile_results], [desc for (desc, percent) in progress])
+        self.assertEqual([percent for (desc, percent) in progress], sorted(percent for (desc, percent) in progress))
+        self.assertTrue(progress[-1][1] < 100)
+        tasks = dict((task.desc, task) for task in compiler.profile_results)
+        self.assertEqual(tasks['scanning and importing code'].num_nodes, None)
+        self.assertTrue(tasks['parse code'].num_nodes > 0)
+        self.assertTrue(all(task.wall_time >= 0 and task.cpu_time >= 0 and task.memory_peak >= 0 for task in compiler.profile_results))
+        report = json.loads(format_profile(compiler.profile_results, as_json=True))
+        self.assertEqual(report[-1]['task'], 'generate code')
+        self.assertTrue(format_profile(compiler.profile_results).split('\n')[-1].startswith('total'))
+
+    def testCompilingAgainStartsWithoutAnAST(self):
+        compiler = KSPCompiler(self.code, None, profile=True)
+        compiler.compile()
+        compiler.compile()
+        self.assertEqual(compiler.profile_results[0].num_nodes, None)
+
+    def testCallersMemoryTracingIsKept(self):
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            data = [bytearray(1000) for i in range(1000)]
+            traced_before = tracemalloc.get_traced_memory()[0]
+            KSPCompiler(self.code, None, profile=True, profile_memory=True).compile()
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertTrue(tracemalloc.get_traced_memory()[0] >= traced_before - 10000)
+            del data
+        finally:
+            tracemalloc.stop()
+
+class ParserTables(unittest.TestCase):
+
+    def testCachedTablesAreWrittenAndReused(self):
+        import os, shutil, tempfile
+        import ksp_parser
+        tmpdir = tempfile.mkdtemp()
+        try:
+            signature = ksp_parser.grammar_signature()
+            ksp_parser.init(tmpdir)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['ksp_lextab_%s.py' % signature, 'ksp_parser_tab_%s.pickle' % signature])
+            parser = ksp_parser.init(tmpdir)
+            ksp_parser.lex.lexer.filename = 'current file'
+            module = parser.parse('on init\n  declare x := 1\nend on\n', tracking=True)
+            self.assertEqual(len(module.blocks), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testStaleTablesAreReplaced(self):
+        import os, shutil, tempfile
+        import ksp_parser
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stale = os.path.join(tmpdir, 'ksp_parser_tab_0123.pickle')
+            open(stale, 'w').close()
+            ksp_parser.init(tmpdir)
+            self.assertFalse(os.path.exists(stale))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testParsingOnSeveralThreads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        import ksp_parser
+        def parse_script(i):
+            # the line numbers of the nodes and of syntax errors come from the lexer used for the parse
+            module = ksp_parser.parse('\n' * i + 'on init\n' + '  declare x%d := 1\n' % i * 200 + 'end on\n')
+            try:
+                ksp_parser.parse('on init\n' + '\n' * i + '  x := := 1\nend on\n')
+            except ksp_parser.ParseException as e:
+                error_lineno = e.lineno
+            return module.blocks[0].lexinfo[1], module.blocks[0].lines[-1].lexinfo[1], len(module.blocks[0].lines), error_lineno
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(parse_script, range(64)))
+        self.assertEqual(results, [(i, i + 200, 200, i + 1) for i in range(64)])
+
+    def testParserPoolHandsOutIndependentPairs(self):
+        import ksp_parser
+        pool = ksp_parser.ParserPool(ksp_parser.parser_pools['ply'].lexer, ksp_parser.parser_pools['ply'].parser)
+        pair1 = pool.acquire()
+        pair2 = pool.acquire()
+        self.assertTrue(pair1[0] is not pair2[0] and pair1[1] is not pair2[1])
+        self.assertTrue(pair1[1].action is pair2[1].action)
+        pool.release(pair1)
+        self.assertTrue(pool.acquire() is pair1)
+
+class ParserLists(unittest.TestCase):
+
+    def testListsKeepTheSourceOrder(self):
+        import ksp_parser
+        code = '''function f(a, b, c) -> r
+  r := g(a, b, c)
+end function
+
+taskfunc t(a, var b, c)
+end taskfunc
+
+on init
+  declare x
+  if x = 1
+    x := a[1, 2, 3]
+  else if x = 2
+    x := 2
+  else
+    x := 3
+  end if
+  select x
+    case 1
+      x := 1
+    case 2 to 3
+      x := 2
+  end select
+  property p[i, j] -> a[i, j]
+''' + ''.join('  declare v%d\n' % i for i in range(1000)) + 'end on\n'
+        module = ksp_parser.parse(code)
+        func, taskfunc, callback = module.blocks
+        self.assertEqual(func.parameters, ['a', 'b', 'c'])
+        self.assertEqual([str(p) for p in func.lines[0].expression.parameters], ['a', 'b', 'c'])
+        self.assertEqual((taskfunc.parameters, taskfunc.parameter_types[:3]), (['a', 'b', 'c'], ['None', 'var', 'None']))
+        if_stmt, select_stmt, property_def = callback.lines[1:4]
+        self.assertEqual([str(condition) for condition, stmts in if_stmt.condition_stmts_tuples], ['x=1', 'x=2', 'None'])
+        self.assertEqual([str(s) for s in if_stmt.condition_stmts_tuples[0][1][0].expression.subscripts], ['1', '2', '3'])
+        self.assertEqual([str(r[0]) for r, stmts in select_stmt.range_stmts_tuples], ['1', '2'])
+        self.assertEqual([str(i) for i in property_def.set_func_def.parameters], ['i', 'j', 'value_to_set'])
+        self.assertEqual([str(stmt.variable) for stmt in callback.lines[4:]], ['v%d' % i for i in range(1000)])
+
+class LexerBackends(unittest.TestCase):
+
+    def tokens(self, lexer, code):
+        lexer.input(code)
+        lexer.lineno = 0
+        return [(t.type, t.value, t.lineno, t.lexpos) for t in iter(lexer.token, None)]
+
+    def testTableLexerProducesTheSameTokensAsPLY(self):
+        import ksp_parser
+        code = '''on ui_control(knob)
+  declare %values[4] := (1, 2,... \n 3, -4)
+  declare ui_knob knobs[[8 pers]](0, 100, 1) { comment
+  over two lines }
+  if (x .and. 0x1F) # 010h and b011 = 110b or 1.5e3 >= 2 (* another
+  comment *)
+    message("a \\"quoted\\" string" & 'single' & x mod 3 & $y.z -> value)
+  end if ... \t
+  SET_CONDITION(COND) ; @label: 7abc
+end
+on'''
+        table_tokens = self.tokens(ksp_parser.KSPLexer(), code)
+        self.assertEqual(table_tokens, self.tokens(ksp_parser.lex.lexer.clone(), code))
+        types = [t[0] for t in table_tokens]
+        self.assertEqual(types[:2], ['BEGIN_CALLBACK', 'NEWLINE'])
+        self.assertEqual(table_tokens[0][1], {'name': 'ui_control', 'variable': 'knob'})
+        self.assertTrue('INIT_ARRAY' in types and 'UI_ARRAY' in types and 'END_CALLBACK' == types[-1])
+        self.assertEqual([t[1] for t in table_tokens if t[0] == 'INTEGER'][:5], [4, 31, 16, 6, 6])
+
+    def testParseWithEitherBackend(self):
+        import ksp_parser
+        code = 'on init\n  declare x := 0x10\n  x := x mod 3 .or. 2\nend on\n'
+        outputs = []
+        for backend in ('table', 'ply'):
+            module = ksp_parser.parse(code, lexer_backend=backend)
+            outputs.append((str(module.blocks[0].lines[-1]), module.blocks[0].lines[-1].lexinfo))
+        self.assertEqual(outputs[0], outputs[1])
+
+class PreprocessorPipeline(unittest.TestCase):
+
+    def testLinesAreOnlyPassedToInterestedStages(self):
+        import preprocessor_plugins
+        from ksp_compiler import Line, LineBuffer, Location
+        seen = []
+        class RecordingStage(preprocessor_plugins.PreprocessorStage):
+            keywords = ('declare',)
+            def process(self, line, text, keyword):
+                seen.append(text)
+                if text.startswith('declare pers'):
+                    return [line.copy('declare x'), line.copy('message(x)')]
+        class UppercaseStage(preprocessor_plugins.PreprocessorStage):
+            keywords = ('message',)
+            def process(self, line, text, keyword):
+                line.command = text.upper()
+        lines = LineBuffer(Line(text, Location(None, i + 1)) for (i, text) in enumerate(['on init', 'declare pers x', 'message(1)', 'end on']))
+        preprocessor_plugins.runStages(lines, [RecordingStage(), UppercaseStage()])
+        self.assertEqual(seen, ['declare pers x'])
+        self.assertEqual([line.command for line in lines], ['on init', 'declare x', 'MESSAGE(X)', 'MESSAGE(1)', 'end on'])
+        self.assertEqual([line.lineno for line in lines], [1, 2, 2, 3, 4])
+
+    def testFamilyScopeStack(self):
+        from preprocessor_plugins import FamilyScopeStack
+        from ksp_compiler import Line
+        lines = [Line(text) for text in ['declare a', 'family outer', 'declare b', 'family inner', 'declare c', 'end family', 'declare d', 'end family', 'declare e']]
+        scopes = FamilyScopeStack()
+        prefixes = []
+        for line in lines:
+            scopes.append(line)
+            prefixes.append(scopes.prefix())
+        self.assertEqual(prefixes, [None, 'outer.', 'outer.', 'outer.inner.', 'outer.inner.', 'outer.', 'outer.', None, None])
+        self.assertEqual(FamilyScopeStack(lines[:4]).prefix(), 'outer.inner.')
+        self.assertRaises(ParseException, FamilyScopeStack([Line('end family'), Line('family x')]).prefix)
+
+    def testArrayDeclarationIndex(self):
+        from preprocessor_plugins import ArrayDeclarationIndex
+        from ksp_compiler import Line
+        index = ArrayDeclarationIndex(Line(text) for text in ['declare a[1]', 'on init', 'declare pers %a[N]', 'declare x', 'end on'])
+        self.assertEqual((index.find('a').size, index.find('a').inInit), ('1', False))
+        declaration = index.find('a', inInit=True)
+        self.assertEqual((declaration.prefix, declaration.size), ('%', 'N'))
+        self.assertEqual(index.find('x'), None)
+
+    def testConcatSizesAreLookedUpInTheIndex(self):
+        from preprocessor_plugins import post_macro_functions
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['on init', 'declare pers a[N]', 'declare list l[]', 'list_add(l, 1)', 'declare b[] := concat(a, l)',
+                                                   'declare c[] := concat(b, a, a)', 'end on'])
+        post_macro_functions(lines)
+        declarations = [line.command for line in lines if line.command.startswith('declare b[') or line.command.startswith('declare c[')]
+        self.assertEqual(declarations, ['declare b[N+1]', 'declare c[N+1+N+N]'])
+
+    def testConcatOfAnArrayDeclaredLaterFails(self):
+        from preprocessor_plugins import post_macro_functions
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['on init', 'declare a[3]', 'declare later_cat[] := concat(a, b2)', 'declare b2[5]', 'end on'])
+        with self.assertRaises(ParseException) as context:
+            post_macro_functions(lines)
+        self.assertTrue('Undeclared array(s) in concat function: b2' in context.exception.message)
+
+    def testNamePatternsAreCompiledOnce(self):
+        from preprocessor_plugins import post_macro_functions, regexCacheInfo
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['struct pair', 'declare member_for_test', 'end struct', 'on init'] + ['declare &pair p%d' % i for i in range(50)] + ['end on'])
+        before = regexCacheInfo()
+        post_macro_functions(lines)
+        after = regexCacheInfo()
+        self.assertEqual([line.command for line in lines if 'member_for_test' in line.command], ['declare p%d.member_for_test' % i for i in range(50)])
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 49)
+
+    def testIncrementers(self):
+        from preprocessor_plugins import runStages, IncrementerStage
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['START_INC(i, 0, 1)', 'a[i] := b[i] + j', 'START_INC(j, 10, -2)', 'START_INC(i, 5, 5)',
+                                                   'message(i & j & "i")', 'START_INC(x.y, 0, 1)', 'message(x.y & i)', 'END_INC', 'END_INC', 'END_INC',
+                                                   'message(i_2 & j)', 'END_INC', 'message(i)'])
+        runStages(lines, [IncrementerStage()])
+        self.assertEqual([line.command for line in lines if line.command],
+                         ['a[0] := b[0] + j', 'message(1 & 10 & "1")', 'message(0 & 2)', 'message(i_2 & j)', 'message(i)'])
+
+class DefineConstants(unittest.TestCase):
+
+    def testSubstitutionInDeclarationOrder(self):
+        from preprocessor_plugins import handleDefineConstants
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in [
+            'define WIDTH := 10',
+            'define AREA(x) := x * WIDTH',
+            'define ui.size := WIDTH + 1',
+            'define LATE := EARLY',
+            'define EARLY := 3',
+            'message(AREA(2) & ui.size & WIDTH_2 & LATE & EARLY)'])
+        handleDefineConstants(lines)
+        self.assertEqual([line.command for line in lines], ['message(2 * 10 & 11 & WIDTH_2 & 3 & 3)'])
+
+    def testValuesAreResolvedInDependencyOrder(self):
+        from preprocessor_plugins import handleDefineConstants
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['define TOTAL := HALF * 2', 'define HALF := WIDTH / 2', 'define WIDTH := 10', 'message(TOTAL)'])
+        handleDefineConstants(lines)
+        self.assertEqual([line.command for line in lines], ['message(10)'])
+
+    def testCycleIsReportedWithTheChain(self):
+        from preprocessor_plugins import handleDefineConstants
+        from ksp_compiler import Line, LineBuffer
+        lines = LineBuffer(Line(text) for text in ['define A := B + 1', 'define B := C + 1', 'define C := A + 1', 'message(A)'])
+        with self.assertRaises(ParseException) as cm:
+            handleDefineConstants(lines)
+        self.assertTrue('A -> B -> C -> A' in str(cm.exception))
+
+class UIArrays(unittest.TestCase):
+
+    def testControlsAreDeclaredWhenEmitted(self):
+        code = '''
+on init
+    family fam
+        declare pers ui_knob knobs[2](0, 100, 1)
+    end family
+    message(fam.knobs1)
+end on'''
+        compiler = KSPCompiler(code, None, compact=False)
+        compiler.compile()
+        output = [line.strip() for line in compiler.compiled_code.split('\n')]
+        start = output.index('declare %fam__knobs[2]')
+        self.assertEqual(output[start:start + 6], ['declare %fam__knobs[2]',
+                                                   'declare ui_knob $fam__knobs0(0, 100, 1)', 'make_persistent($fam__knobs0)',
+                                                   'declare ui_knob $fam__knobs1(0, 100, 1)', 'make_persistent($fam__knobs1)',
+                                                   '$preproc_i := 0'])
+
+    def testDeclarationIsOneNodeUntilEmitted(self):
+        compiler = KSPCompiler('on init\n    declare ui_button buttons[512]\nend on', None, extra_syntax_checks=True)
+        compiler.compile()
+        declarations = [node for node in compiler.module.on_init.lines if getattr(node, 'ui_array_size', None)]
+        self.assertEqual([str(node.variable) for node in declarations], ['$buttons0'])
+        self.assertEqual(declarations[0].ui_array_size, 512)
+        self.assertEqual(compiler.compiled_code.count('declare ui_button'), 512)
+
+    def testErrorsPointToTheDeclaration(self):
+        code = 'on init\n    declare x\n    declare ui_knob knobs[4](0, 1)\nend on'
+        with self.assertRaises(ParseException) as cm:
+            do_compile(code, extra_syntax_checks=True)
+        self.assertEqual(cm.exception.line.lineno, 3)
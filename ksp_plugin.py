@@ -23,6 +23,8 @@ except Exception:
     pass
 
 last_compiler = None
+import_cache = ksp_compiler.ImportCache()   # parsed imported files are reused between compilations
+parse_cache = ksp_compiler.ParseCache()     # so are the ASTs of the callbacks and functions which haven't changed
 
 class KspRecompile(sublime_plugin.ApplicationCommand):
     def is_enabled(self):
@@ -180,7 +182,9 @@ class CompileKspThread(threading.Thread):
                                                      extra_syntax_checks=check,
                                                      optimize=optimize and check,
                                                      check_empty_compound_statements=check_empty_compound_statements,
-                                                     add_compiled_date_comment=add_compiled_date_comment)
+                                                     add_compiled_date_comment=add_compiled_date_comment,
+                                                     import_cache=import_cache,
+                                                     parse_cache=parse_cache)
             if self.compiler.compile(callback=self.compile_on_progress):
                 last_compiler = self.compiler
                 code = self.compiler.compiled_code